@@ -16,6 +16,5 @@ class RequireAPIKeyMixin(object):
             return JsonResponse(
                 {'error': 'You must supply a valid API key in the X-Api-Key header'},
                 status=403,
-                json_dumps_params={'indent': 4},
             )
         return super(RequireAPIKeyMixin, self).dispatch(request, *args, **kwargs)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+'''Benchmarks of the API against generated data
+
+The data is a number of "entities", each of which has an identifier
+in every benchmark scheme; the first scheme's identifier of each
+entity is claimed to be equivalent to each of its others. Some of
+those pairs have a longer history of claims that deprecate and restore
+them, some end up deprecated, and some entities were at some point
+mapped to the wrong identifier, which was then deprecated. The data
+can be topped up to a larger number of entities, so the benchmarks
+can be run at several sizes in turn.
+
+Each benchmark makes one kind of request, first once while counting
+the SQL queries it makes (which should be within the benchmark's
+budget, and mustn't grow with the size of the data), and then a
+number of times while timing it. Lookup responses aren't served from
+the lookup cache, which is replaced by an empty private one for each
+request. The results can be written as JSON and compared with those
+from an earlier run to look for regressions.'''
+
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import io
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connections
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from api_keys.models import APIKey
+
+from .models import EquivalenceClaim, Identifier, Scheme
+
+
+SCHEME_NAME_PREFIX = 'benchmark-'
+API_KEY_NOTES = 'Used by the benchmark command'
+
+SAVEPOINT_SQL_RE = re.compile(r'^(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT) ')
+
+# A fixed starting point for the generated claims' timestamps, so that
+# data topped up later has later claims:
+EPOCH = datetime(2018, 1, 1, tzinfo=timezone.utc)
+
+
+def benchmark_schemes(scheme_count):
+    return [
+        Scheme.objects.get_or_create(name='{0}{1}'.format(SCHEME_NAME_PREFIX, i))[0]
+        for i in range(scheme_count)
+    ]
+
+
+def entity_value(scheme_index, entity):
+    return 'S{0}:{1:09d}'.format(scheme_index, entity)
+
+
+def entity_count(schemes):
+    '''Return the number of entities that have been generated so far'''
+    return Identifier.objects.filter(scheme=schemes[0]).count()
+
+
+def generate_claims(schemes, first_entity, last_entity, history_depth=4,
+                    deprecated_fraction=0.1, wrong_fraction=0.05, seed=0):
+    '''Generate claims (as import_claims records) for a range of entities'''
+    rng = random.Random('{0}-{1}'.format(seed, first_entity))
+    created = EPOCH + timedelta(seconds=first_entity * 100)
+    for entity in range(first_entity, last_entity):
+        value_a = entity_value(0, entity)
+        for scheme_index, scheme in enumerate(schemes[1:], start=1):
+            value_b = entity_value(scheme_index, entity)
+            # Claims alternately adding and deprecating the pair, ending
+            # with it added:
+            states = [i % 2 == 1 for i in range(rng.randint(0, history_depth // 2) * 2 + 1)]
+            if rng.random() < deprecated_fraction and not states[-1]:
+                states.append(True)
+            if rng.random() < wrong_fraction:
+                wrong_value = entity_value(
+                    scheme_index, rng.randrange(max(last_entity, 1)))
+                for deprecated in (False, True):
+                    created += timedelta(seconds=1)
+                    yield {
+                        'scheme_a': schemes[0].id, 'value_a': value_a,
+                        'scheme_b': scheme.id, 'value_b': wrong_value,
+                        'deprecated': deprecated, 'comment': 'Mistaken',
+                        'created': created.isoformat(),
+                    }
+            for deprecated in states:
+                created += timedelta(seconds=1)
+                yield {
+                    'scheme_a': schemes[0].id, 'value_a': value_a,
+                    'scheme_b': scheme.id, 'value_b': value_b,
+                    'deprecated': deprecated, 'comment': '',
+                    'created': created.isoformat(),
+                }
+
+
+def generate_data(scheme_count, entities, workers=1, **kwargs):
+    '''Top up the benchmark data to the given number of entities
+
+    Returns the benchmark schemes. The claims are written to a
+    temporary file and loaded with import_claims, as a large import
+    would be.'''
+    schemes = benchmark_schemes(scheme_count)
+    existing = entity_count(schemes)
+    if existing >= entities:
+        return schemes
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'claims.jsonl')
+        with io.open(filename, 'w', encoding='utf-8') as f:
+            for record in generate_claims(schemes, existing, entities, **kwargs):
+                f.write(json.dumps(record) + '\n')
+        call_command(
+            'import_claims', filename, workers=workers, stdout=StringIO())
+    finally:
+        shutil.rmtree(directory)
+    return schemes
+
+
+class Benchmark(object):
+    '''A kind of request to time
+
+    max_queries is the most SQL queries it may make. make_request is
+    called with the benchmark's context and a random number generator
+    and should return the method, path and any body of a request.'''
+
+    def __init__(self, name, max_queries, make_request, needs_api_key=False):
+        self.name = name
+        self.max_queries = max_queries
+        self.make_request = make_request
+        self.needs_api_key = needs_api_key
+
+
+def random_value(context, rng, scheme_index=0):
+    return entity_value(scheme_index, rng.randrange(context['entities']))
+
+
+def claim_body(context, rng):
+    context['new_claims'] += 1
+    return json.dumps({
+        'identifier_a': {
+            'scheme_id': context['schemes'][0].id,
+            'value': random_value(context, rng),
+        },
+        'identifier_b': {
+            'scheme_id': context['schemes'][-1].id,
+            'value': 'new:{0}:{1}'.format(context['run_id'], context['new_claims']),
+        },
+        'comment': 'Benchmark claim',
+    })
+
+
+BENCHMARKS = [
+    Benchmark('identifier_lookup', 5, lambda context, rng: (
+        'GET', '/identifier/{0}/{1}'.format(
+            context['schemes'][0].id, random_value(context, rng)), None)),
+    Benchmark('identifier_lookup_by_name', 5, lambda context, rng: (
+        'GET', '/identifier/{0}/{1}'.format(
+            context['schemes'][1].name, random_value(context, rng, 1)), None)),
+    Benchmark('identifier_lookup_transitive', 7, lambda context, rng: (
+        'GET', '/identifier/{0}/{1}?transitive=1'.format(
+            context['schemes'][1].id, random_value(context, rng, 1)), None)),
+    Benchmark('identifier_lookup_as_of', 5, lambda context, rng: (
+        'GET', '/identifier/{0}/{1}?as_of={2}'.format(
+            context['schemes'][0].id, random_value(context, rng), context['as_of']), None)),
+    Benchmark('scheme_list', 2, lambda context, rng: ('GET', '/scheme', None)),
+    Benchmark('scheme_page', 3, lambda context, rng: (
+        'GET', '/scheme/{0}?limit=1000&after={1}'.format(
+            context['schemes'][0].id, random_value(context, rng)), None)),
+    Benchmark('scheme_page_to_one_scheme', 3, lambda context, rng: (
+        'GET', '/scheme/{0}?limit=1000&after={1}&target_scheme={2}'.format(
+            context['schemes'][0].id, random_value(context, rng),
+            context['schemes'][1].id), None)),
+    Benchmark('scheme_page_as_of', 3, lambda context, rng: (
+        'GET', '/scheme/{0}?limit=1000&after={1}&as_of={2}'.format(
+            context['schemes'][0].id, random_value(context, rng), context['as_of']), None)),
+    Benchmark('equivalence_claim_create', 15, lambda context, rng: (
+        'POST', '/equivalence-claim', claim_body(context, rng)), needs_api_key=True),
+]
+
+
+@contextmanager
+def count_queries():
+    '''Count the queries made on every database connection in the block'''
+    contexts = [CaptureQueriesContext(connections[alias]) for alias in connections]
+    for context in contexts:
+        context.__enter__()
+    counted = []
+    try:
+        yield counted
+    finally:
+        for context in contexts:
+            context.__exit__(None, None, None)
+        # Savepoints are only made when the request is already in a
+        # transaction (e.g. in tests), so leave them out:
+        counted.append(sum(
+            1 for context in contexts for query in context.captured_queries
+            if not SAVEPOINT_SQL_RE.search(query['sql'])))
+
+
+def make_request(client, method, path, body, api_key):
+    headers = {'HTTP_X_API_KEY': api_key} if api_key else {}
+    # A new empty lookup cache for each request, so responses are built:
+    with override_settings(
+            ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver'],
+            CACHES=dict(settings.CACHES, lookups={
+                'BACKEND': 'id_mappings.cache_backends.LRULocMemCache',
+                'LOCATION': 'benchmark-{0}'.format(random.random()),
+            })):
+        if method == 'GET':
+            response = client.get(path, **headers)
+        else:
+            response = client.post(path, body, content_type='application/json', **headers)
+        if response.streaming:
+            b''.join(response.streaming_content)
+    if response.status_code >= 400:
+        raise ValueError('{0} {1} returned {2}'.format(method, path, response.status_code))
+    return response
+
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_benchmark(benchmark, context, repeat, rng):
+    '''Return the query count and timings of a benchmark's requests'''
+    client = Client()
+    api_key = context['api_key'] if benchmark.needs_api_key else None
+    with count_queries() as counted:
+        make_request(client, *benchmark.make_request(context, rng), api_key=api_key)
+    timings = []
+    for _ in range(repeat):
+        request = benchmark.make_request(context, rng)
+        start = time.time()
+        make_request(client, *request, api_key=api_key)
+        timings.append((time.time() - start) * 1000)
+    return {
+        'queries': counted[0],
+        'max_queries': benchmark.max_queries,
+        'repeat': repeat,
+        'min_ms': round(min(timings), 3),
+        'median_ms': round(percentile(timings, 0.5), 3),
+        'p95_ms': round(percentile(timings, 0.95), 3),
+        'max_ms': round(max(timings), 3),
+    }
+
+
+def run_benchmarks(schemes, repeat=20, seed=0, names=None):
+    '''Run the benchmarks against the data generated so far'''
+    api_key = APIKey.objects.filter(notes=API_KEY_NOTES).first() or \
+        APIKey.objects.create(
+            key='benchmark-{0}'.format(random.getrandbits(64)), notes=API_KEY_NOTES)
+    entities = entity_count(schemes)
+    context = {
+        'schemes': schemes,
+        'entities': entities,
+        # Half way through the generated claims:
+        'as_of': (EPOCH + timedelta(seconds=entities * 50)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'api_key': api_key.key,
+        'run_id': '{0:x}'.format(random.getrandbits(32)),
+        'new_claims': 0,
+    }
+    rng = random.Random(seed)
+    results = {}
+    for benchmark in BENCHMARKS:
+        if names and benchmark.name not in names:
+            continue
+        results[benchmark.name] = run_benchmark(benchmark, context, repeat, rng)
+    return {
+        'entities': context['entities'],
+        'schemes': len(schemes),
+        'identifiers': Identifier.objects.filter(scheme__in=schemes).count(),
+        'claims': EquivalenceClaim.objects.filter(
+            identifier_a__scheme=schemes[0]).count(),
+        'benchmarks': results,
+    }
+
+
+def over_budget(results):
+    '''Return a description of each benchmark that made too many queries'''
+    return [
+        '{0} with {1} entities made {2} queries (budget {3})'.format(
+            name, run['entities'], result['queries'], result['max_queries'])
+        for run in results['runs']
+        for name, result in sorted(run['benchmarks'].items())
+        if result['queries'] > result['max_queries']
+    ]
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.PROJECT_ROOT,
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_results, new_results, threshold=0.2):
+    '''Return the changes in median time between two sets of results
+
+    Each is a (name, entities, old median, new median, regressed)
+    tuple, where regressed says whether it's more than threshold (as
+    a fraction) slower. Only benchmarks run at the same size in both
+    are compared.'''
+    old_runs = {run['entities']: run for run in old_results['runs']}
+    changes = []
+    for run in new_results['runs']:
+        old_run = old_runs.get(run['entities'])
+        if old_run is None:
+            continue
+        for name, result in sorted(run['benchmarks'].items()):
+            old_result = old_run['benchmarks'].get(name)
+            if old_result is None:
+                continue
+            old_median, new_median = old_result['median_ms'], result['median_ms']
+            changes.append((
+                name, run['entities'], old_median, new_median,
+                new_median > old_median * (1 + threshold)))
+    return changes
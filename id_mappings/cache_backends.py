@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+'''Cache backends that evict the least recently used entries
+
+Django's own local-memory and file-based backends make room for new
+entries by deleting arbitrary ones, which throws away popular
+entries as readily as ones that will never be asked for again.
+These versions keep track of when each entry was last used and
+evict the least recently used entries first, so the size of the
+cache can be bounded by MAX_ENTRIES without hurting the hit rate
+much.'''
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import errno
+import os
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache, dummy
+from django.utils.synch import RWLock
+
+
+# Like the stores in django.core.cache.backends.locmem, but ordered
+# from least to most recently used:
+_caches = {}
+_expire_info = {}
+_locks = {}
+
+
+class LRULocMemCache(LocMemCache):
+
+    def __init__(self, name, params):
+        super(LRULocMemCache, self).__init__(name, params)
+        self._cache = _caches.setdefault(name, OrderedDict())
+        self._expire_info = _expire_info.setdefault(name, {})
+        self._lock = _locks.setdefault(name, RWLock())
+
+    def get(self, key, default=None, version=None, acquire_lock=True):
+        value = super(LRULocMemCache, self).get(
+            key, default=default, version=version, acquire_lock=acquire_lock)
+        key = self.make_key(key, version=version)
+        with (self._lock.writer() if acquire_lock else dummy()):
+            if key in self._cache:
+                self._cache[key] = self._cache.pop(key)
+        return value
+
+    def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        self._cache.pop(key, None)
+        super(LRULocMemCache, self)._set(key, value, timeout)
+
+    def _cull(self):
+        while self._cache and len(self._cache) >= self._max_entries:
+            self._delete(next(iter(self._cache)))
+
+
+class LRUFileBasedCache(FileBasedCache):
+    '''A file-based cache that uses modification times to track use'''
+
+    def get(self, key, default=None, version=None):
+        value = super(LRUFileBasedCache, self).get(
+            key, default=default, version=version)
+        try:
+            os.utime(self._key_to_file(key, version), None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return value
+
+    def _cull(self):
+        filelist = self._list_cache_files()
+        num_entries = len(filelist)
+        if num_entries < self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            return self.clear()
+        by_last_use = []
+        for fname in filelist:
+            try:
+                by_last_use.append((os.path.getmtime(fname), fname))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        by_last_use.sort()
+        for _, fname in by_last_use[:max(1, num_entries // self._cull_frequency)]:
+            self._delete(fname)
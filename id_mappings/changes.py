@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+'''The feed of claims in the order they were made, for replication
+
+Consumers read claims with IDs greater than the last one they've
+seen. Claim IDs are taken from a sequence when each claim is
+inserted, but transactions can commit in a different order, so a
+claim might become visible after one with a higher ID has already
+been read. To stop consumers skipping over it, the feed only goes up
+to a claim ID that every transaction that could still be making
+claims with lower IDs is known to have finished.
+
+That is worked out from "watermarks": the last ID taken from the
+sequence, and then the ID the next transaction to start will get.
+Every transaction that makes claims is given its transaction ID
+before any of its claims get theirs (see reserve_transaction_id), so
+once every transaction with an ID lower than a watermark's has
+finished, no more claims with IDs up to its claim ID can appear.
+
+Requests for changes can wait for new claims. Waiters are woken when
+a transaction that recorded claims commits in the same process, and,
+through PostgreSQL's LISTEN/NOTIFY, by a listener thread when one
+commits in any other process.'''
+
+from __future__ import unicode_literals
+
+import logging
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'id_mappings_claims'
+
+# The last claim ID taken:
+WATERMARK_SQL = '''
+    SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END
+    FROM {sequence}
+'''
+# The ID the next transaction will get, and the lowest one that's still
+# in progress:
+SNAPSHOT_SQL = '''
+    SELECT txid_snapshot_xmax(snapshot), txid_snapshot_xmin(snapshot)
+    FROM txid_current_snapshot() AS snapshot
+'''
+
+CHANGED_CLAIMS_SQL = '''
+    SELECT id FROM {claim_table}
+    WHERE id > %s AND id <= %s
+    ORDER BY id
+    LIMIT %s
+'''
+
+_condition = threading.Condition()
+_generation = [0]
+_listener = [None]
+_listener_lock = threading.Lock()
+
+# Watermarks that aren't known to be safe yet, as (claim ID, next
+# transaction ID) pairs in order, and the highest claim ID that is:
+_watermarks = []
+_safe_claim_id = [0]
+_watermarks_lock = threading.Lock()
+_sequence = []
+
+
+def reserve_transaction_id():
+    '''Make sure the current transaction has an ID
+
+    This must be called before inserting claims, so that the
+    transaction's ID is lower than that of any transaction that
+    gets a later claim ID.'''
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT txid_current()')
+
+
+def claim_id_sequence(cursor):
+    if not _sequence:
+        from .models import EquivalenceClaim
+        cursor.execute(
+            'SELECT pg_get_serial_sequence(%s, %s)',
+            [EquivalenceClaim._meta.db_table, 'id'])
+        _sequence.append(cursor.fetchone()[0])
+    return _sequence[0]
+
+
+def safe_claim_id():
+    '''Return a claim ID that no more claims with lower IDs can appear below
+
+    Each call records a new watermark, which is usually safe by the
+    next call, or straight away if no transactions are in progress.'''
+    with connection.cursor() as cursor:
+        cursor.execute(WATERMARK_SQL.format(sequence=claim_id_sequence(cursor)))
+        last_claim_id = cursor.fetchone()[0]
+        # This has to come from a later statement than the claim ID,
+        # so that any transaction that took a claim ID by then has a
+        # lower transaction ID:
+        cursor.execute(SNAPSHOT_SQL)
+        next_transaction_id, oldest_transaction_id = cursor.fetchone()
+    with _watermarks_lock:
+        if not _watermarks or _watermarks[-1][0] < last_claim_id:
+            _watermarks.append((last_claim_id, next_transaction_id))
+        while _watermarks and _watermarks[0][1] <= oldest_transaction_id:
+            _safe_claim_id[0] = max(_safe_claim_id[0], _watermarks.pop(0)[0])
+        return _safe_claim_id[0]
+
+
+def changed_claim_ids(since, limit):
+    '''Return the IDs of up to limit claims after since that are safe to read'''
+    from .models import EquivalenceClaim
+    up_to = safe_claim_id()
+    if up_to <= since:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            CHANGED_CLAIMS_SQL.format(claim_table=EquivalenceClaim._meta.db_table),
+            [since, up_to, limit])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def claims_recorded():
+    '''Let waiting requests know about claims when this transaction commits'''
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)', [NOTIFY_CHANNEL, ''])
+    transaction.on_commit(wake_waiters)
+
+
+def wake_waiters():
+    with _condition:
+        _generation[0] += 1
+        _condition.notify_all()
+
+
+def current_generation():
+    '''Return a number that changes whenever waiters are woken'''
+    with _condition:
+        return _generation[0]
+
+
+def wait_for_claims(generation, timeout):
+    '''Wait until there might be new claims, or timeout seconds have passed
+
+    generation should be the value current_generation() returned
+    before looking for claims, so that claims recorded since then
+    aren't missed. Returns whether there might be new claims.'''
+    if getattr(settings, 'CHANGES_LISTEN', True):
+        start_listener()
+    deadline = time.time() + timeout
+    with _condition:
+        while _generation[0] == generation:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            _condition.wait(remaining)
+        return True
+
+
+def start_listener():
+    with _listener_lock:
+        if _listener[0] is None or not _listener[0].is_alive():
+            _listener[0] = threading.Thread(
+                target=listen, name='id-mappings-claims-listener')
+            _listener[0].daemon = True
+            _listener[0].start()
+
+
+def listen():
+    '''Wake waiters whenever claims are recorded by any process'''
+    db = connections['default']
+    pg_connection = db.get_new_connection(db.get_connection_params())
+    try:
+        pg_connection.autocommit = True
+        with pg_connection.cursor() as cursor:
+            cursor.execute('LISTEN {0}'.format(NOTIFY_CHANNEL))
+        while True:
+            if select.select([pg_connection], [], [], 60) == ([], [], []):
+                continue
+            pg_connection.poll()
+            if pg_connection.notifies:
+                del pg_connection.notifies[:]
+                wake_waiters()
+    except Exception:
+        # The listener will be started again by the next request that
+        # waits; until then waiters are only woken by this process:
+        logger.exception('Listening for new claims failed')
+    finally:
+        pg_connection.close()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+'''Connected components of the graph of live equivalences
+
+Every identifier with at least one live (i.e. not deprecated) link to
+another identifier has a component_id, which is shared with every
+identifier it's transitively linked to; identifiers with no live
+links have a component_id of None. When a pair of identifiers becomes
+linked their components are merged, by relabelling the smaller one.
+When a link is deprecated, a breadth-first search outwards from both
+identifiers finds out whether they're still connected; it stops as
+soon as it has either found a path or exhausted the smaller of the
+two sides, which is then given a new label, so the cost of this is
+bounded by the size of the smaller resulting component.'''
+
+from __future__ import unicode_literals
+
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .models import Identifier, ResolvedEquivalence
+
+
+COMPONENT_ID_SEQUENCE = 'id_mappings_component_id_seq'
+
+# An arbitrary key for the advisory lock that serialises updates to
+# components:
+COMPONENT_LOCK_KEY = 0x1d3a9
+
+# Links from an identifier to itself don't connect it to anything:
+LIVE_LINK_CONDITION = '''
+    NOT resolved.deprecated
+    AND resolved.identifier_a_id <> resolved.identifier_b_id
+'''
+
+
+def next_component_id():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval(%s)", [COMPONENT_ID_SEQUENCE])
+        return cursor.fetchone()[0]
+
+
+def update_components_for_changes(changed):
+    '''Update components after changes to the resolved equivalences
+
+    changed should be a list of (identifier_a_id, identifier_b_id,
+    deprecated, previously_deprecated) tuples, where
+    previously_deprecated is None for a newly resolved pair.'''
+    linked = [
+        (id_a, id_b) for id_a, id_b, deprecated, previously_deprecated in changed
+        if not deprecated and previously_deprecated is not False]
+    unlinked = [
+        (id_a, id_b) for id_a, id_b, deprecated, previously_deprecated in changed
+        if deprecated and previously_deprecated is False]
+    if not (linked or unlinked):
+        return
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [COMPONENT_LOCK_KEY])
+        for id_a, id_b in linked:
+            union(id_a, id_b)
+        # Process the unlinked pairs one at a time as if they had been
+        # deprecated in turn, by treating those that haven't been
+        # processed yet as still being linked:
+        pending = set(unlinked)
+        for id_a, id_b in unlinked:
+            pending.discard((id_a, id_b))
+            split(id_a, id_b, pending)
+
+
+def union(id_a, id_b):
+    '''Merge the components of two newly linked identifiers'''
+    if id_a == id_b:
+        return
+    component_ids = dict(Identifier.objects.filter(
+        pk__in=(id_a, id_b)).values_list('pk', 'component_id'))
+    component_a, component_b = component_ids[id_a], component_ids[id_b]
+    if component_a is None and component_b is None:
+        Identifier.objects.filter(pk__in=(id_a, id_b)).update(
+            component_id=next_component_id())
+    elif component_a is None:
+        Identifier.objects.filter(pk=id_a).update(component_id=component_b)
+    elif component_b is None:
+        Identifier.objects.filter(pk=id_b).update(component_id=component_a)
+    elif component_a != component_b:
+        size_a = Identifier.objects.filter(component_id=component_a).count()
+        size_b = Identifier.objects.filter(component_id=component_b).count()
+        smaller, larger = sorted(
+            [(size_a, component_a), (size_b, component_b)])
+        Identifier.objects.filter(component_id=smaller[1]).update(
+            component_id=larger[1])
+
+
+def live_neighbours(identifier_ids, pending):
+    neighbours = set()
+    for id_a, id_b in ResolvedEquivalence.objects.filter(
+            Q(identifier_a__in=identifier_ids) | Q(identifier_b__in=identifier_ids),
+            deprecated=False).values_list('identifier_a_id', 'identifier_b_id'):
+        neighbours.update((id_a, id_b))
+    for id_a, id_b in pending:
+        if id_a in identifier_ids or id_b in identifier_ids:
+            neighbours.update((id_a, id_b))
+    return neighbours
+
+
+def split(id_a, id_b, pending=()):
+    '''Split a component if the link between two identifiers was a bridge'''
+    if id_a == id_b:
+        return
+    visited = [set([id_a]), set([id_b])]
+    frontiers = [set([id_a]), set([id_b])]
+    while True:
+        side = 0 if len(visited[0]) <= len(visited[1]) else 1
+        if not frontiers[side]:
+            break
+        neighbours = live_neighbours(frontiers[side], pending)
+        if neighbours & visited[1 - side]:
+            # There's still a path between the two identifiers:
+            return
+        frontiers[side] = neighbours - visited[side]
+        visited[side] |= frontiers[side]
+    # The smaller side has been explored completely without reaching
+    # the other, so it's now a separate component:
+    old_component_id = Identifier.objects.get(pk=id_a).component_id
+    separated = visited[side]
+    Identifier.objects.filter(pk__in=separated).update(
+        component_id=(next_component_id() if len(separated) > 1 else None))
+    remaining = Identifier.objects.filter(component_id=old_component_id)
+    if old_component_id is not None and remaining.count() == 1:
+        remaining.update(component_id=None)
+
+
+def rebuild_components():
+    '''Recompute every identifier's component from the live links
+
+    This labels each identifier that has live links with its own ID,
+    and then repeatedly relabels each one with the lowest label among
+    its neighbours until nothing changes, so the number of passes
+    depends on the longest shortest path in any component.'''
+    identifier_table = Identifier._meta.db_table
+    resolved_table = ResolvedEquivalence._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [COMPONENT_LOCK_KEY])
+        cursor.execute('''
+            UPDATE {identifier_table} SET component_id = NULL
+            WHERE component_id IS NOT NULL
+        '''.format(identifier_table=identifier_table))
+        cursor.execute('''
+            UPDATE {identifier_table} SET component_id = id
+            WHERE id IN (
+                SELECT identifier_a_id FROM {resolved_table} AS resolved
+                WHERE {live}
+                UNION
+                SELECT identifier_b_id FROM {resolved_table} AS resolved
+                WHERE {live})
+        '''.format(
+            identifier_table=identifier_table, resolved_table=resolved_table,
+            live=LIVE_LINK_CONDITION))
+        while True:
+            cursor.execute('''
+                UPDATE {identifier_table} AS identifier
+                SET component_id = lowest.component_id
+                FROM (
+                    SELECT edge.this_id, MIN(neighbour.component_id) AS component_id
+                    FROM (
+                        SELECT identifier_a_id AS this_id, identifier_b_id AS other_id
+                        FROM {resolved_table} AS resolved WHERE {live}
+                        UNION ALL
+                        SELECT identifier_b_id, identifier_a_id
+                        FROM {resolved_table} AS resolved WHERE {live}
+                    ) AS edge
+                    JOIN {identifier_table} AS neighbour ON neighbour.id = edge.other_id
+                    GROUP BY edge.this_id
+                ) AS lowest
+                WHERE identifier.id = lowest.this_id
+                AND lowest.component_id < identifier.component_id
+            '''.format(
+                identifier_table=identifier_table, resolved_table=resolved_table,
+                live=LIVE_LINK_CONDITION))
+            if cursor.rowcount == 0:
+                break
+        # Make sure that new labels can't clash with these ones:
+        cursor.execute('''
+            SELECT setval(%s, GREATEST(
+                (SELECT last_value FROM {sequence}),
+                (SELECT COALESCE(MAX(id), 1) FROM {identifier_table})))
+        '''.format(
+            sequence=COMPONENT_ID_SEQUENCE, identifier_table=identifier_table),
+            [COMPONENT_ID_SEQUENCE])
@@ -0,0 +1,910 @@
+# -*- coding: utf-8 -*-
+'''The current mappings between identifiers, held in memory
+
+If MAPPING_GRAPH is set, each process loads every identifier that has
+ever been in a resolved equivalence, and every resolved pair, into
+compact arrays, and answers lookups, scheme dumps and translations
+from them instead of the database.
+
+Each identifier is a "node", numbered from 0 in order of identifier
+ID, with its identifier ID and scheme ID in parallel arrays. The
+values are held, encoded as UTF-8, in one buffer, rather than as a
+string object each, and each scheme has an array of its nodes in
+order of value, which is searched to find a value. The pairs are
+held as adjacency lists in compressed sparse row form: the neighbours
+of node n are neighbours[offsets[n]:offsets[n + 1]], with a parallel
+array of flags saying whether each link is deprecated.
+As in the resolved equivalence table, deprecated links are kept, so
+that identifiers whose links have all been deprecated still appear
+in scheme dumps.
+
+The graph is kept up to date by reading claims from the change feed
+(see changes.py), at most every MAPPING_GRAPH_REFRESH_INTERVAL seconds
+or as soon as this process hears that claims have been recorded. For
+each pair a new claim is about, the latest claim about that pair is
+read, as when the resolved state is updated. Links to new pairs are
+kept in a small overflow list per node, changes to existing links in
+a dictionary per node, and new identifiers in a dictionary per
+scheme, until there are enough of them to be worth rebuilding the
+arrays. The names of the schemes are read again on a refresh if
+Scheme.objects.names_version() has changed, which is read from the
+database so that renames made through any process are seen.
+
+Requests read the graph without taking any lock, so the contents of a
+graph are never changed once it's in use: refreshing it returns a new graph, which
+shares its arrays with the old one (only ever appending to them) and
+copies any dictionary or list it changes. The new graph then replaces
+the old one in a single assignment, and a request keeps using the
+graph it started with (see pinned_mapping_graph).
+
+Rather than each process holding its own copy, they can share one:
+if MAPPING_GRAPH_SNAPSHOT is set, the build_graph_snapshot command
+writes the arrays to that file, and each process maps it into memory,
+so the operating system keeps a single copy of it in its page cache.
+A new file is written and renamed over the old one when there are new
+claims; processes notice that, at most every
+MAPPING_GRAPH_REFRESH_INTERVAL seconds, and switch to it. Until then,
+lookups of identifiers and schemes with claims newer than the graph's
+(as shown by their last_claim_id) are answered from the database.
+
+Identifiers that aren't in the graph (e.g. ones that have never been
+linked to anything) are looked up in the database as before. Scheme
+dumps and translations list values in order, so they're only answered
+from the graph if the database sorts values the way the graph does
+(by their UTF-8 encoding), i.e. with the "C" collation.'''
+
+from __future__ import unicode_literals
+
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+import copy
+import errno
+from heapq import merge
+import io
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from . import changes
+from .models import (
+    PAIR_HIGH_SQL, PAIR_LOW_SQL, EquivalenceClaim, Identifier, ResolvedEquivalence, Scheme,
+    latest_claims_sql)
+
+
+NODES_SQL = '''
+    SELECT identifier.id, identifier.scheme_id, identifier.value
+    FROM {identifier_table} AS identifier
+    WHERE EXISTS (
+        SELECT 1 FROM {resolved_table} AS resolved
+        WHERE resolved.identifier_a_id = identifier.id)
+    OR EXISTS (
+        SELECT 1 FROM {resolved_table} AS resolved
+        WHERE resolved.identifier_b_id = identifier.id)
+    ORDER BY identifier.id
+'''
+
+LINKS_SQL = '''
+    SELECT identifier_a_id, identifier_b_id, deprecated
+    FROM {resolved_table}
+    ORDER BY id
+'''
+
+# The latest claim about each pair that a claim in a range of IDs is
+# about, which is found through the index on the claims' pair key:
+CHANGED_LINKS_SQL = '''
+    SELECT identifier_a_id, identifier_b_id, deprecated
+    FROM ({latest_claims}) AS latest
+'''.format(latest_claims=latest_claims_sql('''
+    ({low}, {high}) IN (
+        SELECT {low}, {high} FROM {claim_table}
+        WHERE id > %s AND id <= %s)
+'''.format(
+    low=PAIR_LOW_SQL, high=PAIR_HIGH_SQL, claim_table=EquivalenceClaim._meta.db_table)))
+
+# The number of claims to read from the change feed at once:
+REFRESH_BATCH_SIZE = 10000
+
+# Offsets into the arrays of values and links are 64-bit:
+try:
+    array('q')
+    OFFSET_TYPECODE = 'q'
+except ValueError:
+    # Python 2 doesn't have 'q', but 'l' is 64-bit on 64-bit Linux:
+    OFFSET_TYPECODE = 'l'
+
+
+def copy_dict(items):
+    return dict(items or {})
+
+
+def copy_links(links):
+    return [list(link) for link in links or ()]
+
+
+class MappingGraph(object):
+
+    def __init__(self):
+        self.scheme_names = {}
+        self.node_count = 0
+        # Indexed by node:
+        self.identifier_ids = array('i')
+        self.schemes = array('i')
+        self.value_offsets = array(OFFSET_TYPECODE, [0])
+        self.value_data = bytearray()
+        # Nodes up to this one are in order of identifier ID, so can be
+        # found by bisection; the rest are in extra_nodes:
+        self.sorted_node_count = 0
+        self.extra_nodes = {}
+        # Each scheme's nodes in order of value, and a dictionary from
+        # value to node for any added since that was built:
+        self.scheme_order = {}
+        self.scheme_extra = {}
+        self.offsets = array(OFFSET_TYPECODE, [0])
+        self.neighbours = array('i')
+        self.deprecated = array('b')
+        # Links added since the arrays were built, as lists of
+        # [neighbour, deprecated] for each node that has any:
+        self.added = {}
+        self.added_count = 0
+        # Whether links in the arrays are deprecated, for those that
+        # have changed since they were built, by node and neighbour:
+        self.overrides = {}
+        self.override_count = 0
+        # The items of scheme_extra, added and overrides that this
+        # graph has its own copy of (see writable):
+        self.owned = set()
+        self.last_claim_id = 0
+        self.generation = None
+        # Scheme.objects.names_version() when scheme_names was read:
+        self.names_version = None
+        self.refreshed_at = 0
+        self.ordered = False
+
+    def load(self):
+        '''Read the whole graph from the database'''
+        # Claims made while this is loading might be missed by it, but
+        # will then be read from the change feed afterwards:
+        self.last_claim_id = changes.safe_claim_id()
+        self.generation = changes.current_generation()
+        self.load_scheme_names()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT datcollate FROM pg_database WHERE datname = current_database()')
+            self.ordered = cursor.fetchone()[0] in ('C', 'POSIX')
+        cursor = connection.chunked_cursor()
+        try:
+            cursor.execute(NODES_SQL.format(
+                identifier_table=Identifier._meta.db_table,
+                resolved_table=ResolvedEquivalence._meta.db_table))
+            for identifier_id, scheme_id, value in cursor:
+                self.add_node(identifier_id, scheme_id, value, index=False)
+        finally:
+            cursor.close()
+        scheme_nodes = {}
+        for node in range(self.node_count):
+            scheme_nodes.setdefault(self.schemes[node], []).append(node)
+        for scheme_id, nodes in scheme_nodes.items():
+            nodes.sort(key=self.encoded_value)
+            self.scheme_order[scheme_id] = array('i', nodes)
+        # Pairs are added to a and b in order, then moved into the
+        # arrays once it's known how many neighbours each node has:
+        a = array('i')
+        b = array('i')
+        deprecated = array('b')
+        cursor = connection.chunked_cursor()
+        try:
+            cursor.execute(LINKS_SQL.format(
+                resolved_table=ResolvedEquivalence._meta.db_table))
+            for identifier_a_id, identifier_b_id, pair_deprecated in cursor:
+                a.append(identifier_a_id)
+                b.append(identifier_b_id)
+                deprecated.append(pair_deprecated)
+        finally:
+            cursor.close()
+        # Pairs resolved since the identifiers were read:
+        self.add_missing_nodes(set(a) | set(b))
+        for i in range(len(a)):
+            a[i] = self.node(a[i])
+            b[i] = self.node(b[i])
+        self.build(a, b, deprecated)
+        self.build_scheme_order()
+        self.refreshed_at = time.time()
+
+    def load_scheme_names(self):
+        self.names_version = Scheme.objects.names_version()
+        self.scheme_names = dict(Scheme.objects.values_list('id', 'name'))
+
+    def copy(self):
+        '''Return a graph with the same contents that can be changed
+
+        Nothing that this graph reads is changed by changing the copy.
+        The arrays are shared, since the copy only appends to them,
+        unless another copy has already appended to them (e.g. one
+        whose refresh failed, or that replaced this graph).'''
+        graph = copy.copy(self)
+        if len(self.identifier_ids) != self.node_count or \
+                len(self.offsets) != self.node_count + 1:
+            graph.identifier_ids = self.identifier_ids[:self.node_count]
+            graph.schemes = self.schemes[:self.node_count]
+            graph.value_offsets = self.value_offsets[:self.node_count + 1]
+            graph.value_data = self.value_data[:self.value_offsets[self.node_count]]
+            graph.offsets = self.offsets[:self.node_count + 1]
+        graph.extra_nodes = dict(self.extra_nodes)
+        graph.scheme_order = dict(self.scheme_order)
+        graph.scheme_extra = dict(self.scheme_extra)
+        graph.added = dict(self.added)
+        graph.overrides = dict(self.overrides)
+        graph.owned = set()
+        return graph
+
+    def writable(self, attribute, key, copy_item):
+        '''Return an item of scheme_extra, added or overrides to change
+
+        The first time this graph changes one, it replaces it with a
+        copy made by copy_item (from the item, or None if there isn't
+        one), since the graph it was copied from might share it.'''
+        items = getattr(self, attribute)
+        if (attribute, key) not in self.owned or key not in items:
+            items[key] = copy_item(items.get(key))
+            self.owned.add((attribute, key))
+        return items[key]
+
+    def add_node(self, identifier_id, scheme_id, value, index=True):
+        '''Add a node, and unless index is False, make it findable by value'''
+        node = self.node_count
+        if self.sorted_node_count == node and (
+                node == 0 or self.identifier_ids[node - 1] < identifier_id):
+            self.sorted_node_count += 1
+        else:
+            self.extra_nodes[identifier_id] = node
+        self.identifier_ids.append(identifier_id)
+        self.schemes.append(scheme_id)
+        self.value_data.extend(value.encode('utf-8'))
+        self.value_offsets.append(len(self.value_data))
+        if len(self.offsets) < node + 2:
+            self.offsets.append(self.offsets[-1])
+        self.node_count += 1
+        if index:
+            self.writable('scheme_extra', scheme_id, copy_dict)[value] = node
+        return node
+
+    def encoded_value(self, node):
+        return bytes(self.value_data[self.value_offsets[node]:self.value_offsets[node + 1]])
+
+    def value(self, node):
+        return self.encoded_value(node).decode('utf-8')
+
+    def build_scheme_order(self):
+        '''Move the nodes added to each scheme into its array in order'''
+        for scheme_id, extra in self.scheme_extra.items():
+            nodes = list(self.scheme_order.get(scheme_id, ())) + list(extra.values())
+            nodes.sort(key=self.encoded_value)
+            self.scheme_order[scheme_id] = array('i', nodes)
+        self.scheme_extra = {}
+
+    def search(self, order, encoded_value, after=False):
+        '''Return the position of the first node in order not before encoded_value
+
+        With after, return the position of the first node after it.'''
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            middle_value = self.encoded_value(order[middle])
+            if middle_value < encoded_value or (after and middle_value == encoded_value):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, scheme_id, value):
+        '''Return the node for a value in a scheme, or None'''
+        node = self.scheme_extra.get(scheme_id, {}).get(value)
+        if node is not None:
+            return node
+        order = self.scheme_order.get(scheme_id, ())
+        encoded_value = value.encode('utf-8')
+        i = self.search(order, encoded_value)
+        if i < len(order) and self.encoded_value(order[i]) == encoded_value:
+            return order[i]
+        return None
+
+    def add_missing_nodes(self, identifier_ids):
+        missing = [i for i in identifier_ids if self.node(i) is None]
+        if not missing:
+            return
+        rows = Identifier.objects.filter(
+            pk__in=missing).order_by('id').values_list('id', 'scheme_id', 'value')
+        for identifier_id, scheme_id, value in rows:
+            if scheme_id not in self.scheme_names:
+                self.load_scheme_names()
+            self.add_node(identifier_id, scheme_id, value)
+
+    def node(self, identifier_id):
+        '''Return the node for an identifier ID, or None'''
+        i = bisect_left(self.identifier_ids, identifier_id, 0, self.sorted_node_count)
+        if i < self.sorted_node_count and self.identifier_ids[i] == identifier_id:
+            return i
+        return self.extra_nodes.get(identifier_id)
+
+    def build(self, a, b, deprecated):
+        '''Replace the arrays of links with the pairs (a[i], b[i])'''
+        node_count = self.node_count
+        offsets = array(OFFSET_TYPECODE, [0]) * (node_count + 1)
+        for nodes in (a, b):
+            for node in nodes:
+                offsets[node + 1] += 1
+        for node in range(node_count):
+            offsets[node + 1] += offsets[node]
+        positions = offsets[:-1]
+        neighbours = array('i', [0]) * len(a) * 2
+        flags = array('b', [0]) * len(a) * 2
+        # Each node's links are kept in the order of the pairs, and a
+        # pair of an identifier with itself is added from each side, as
+        # when mappings are read from the database:
+        for i in range(len(a)):
+            for this, other in ((a[i], b[i]), (b[i], a[i])):
+                neighbours[positions[this]] = other
+                flags[positions[this]] = deprecated[i]
+                positions[this] += 1
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.deprecated = flags
+        self.added = {}
+        self.added_count = 0
+        self.overrides = {}
+        self.override_count = 0
+
+    def links(self, node):
+        '''Generate (neighbour, deprecated) for each link from a node'''
+        overrides = self.overrides.get(node)
+        for i in range(self.offsets[node], self.offsets[node + 1]):
+            neighbour = self.neighbours[i]
+            if overrides and neighbour in overrides:
+                yield neighbour, overrides[neighbour]
+            else:
+                yield neighbour, self.deprecated[i]
+        for neighbour, deprecated in self.added.get(node, ()):
+            yield neighbour, deprecated
+
+    def update_link(self, node, neighbour, deprecated):
+        found = False
+        for i in range(self.offsets[node], self.offsets[node + 1]):
+            if self.neighbours[i] == neighbour:
+                overrides = self.writable('overrides', node, copy_dict)
+                if neighbour not in overrides:
+                    self.override_count += 1
+                overrides[neighbour] = deprecated
+                found = True
+                break
+        if any(link[0] == neighbour for link in self.added.get(node, ())):
+            for link in self.writable('added', node, copy_links):
+                if link[0] == neighbour:
+                    link[1] = deprecated
+            found = True
+        return found
+
+    def set_pair(self, node_a, node_b, deprecated):
+        if self.update_link(node_a, node_b, deprecated):
+            self.update_link(node_b, node_a, deprecated)
+            return
+        self.writable('added', node_a, copy_links).append([node_b, deprecated])
+        self.writable('added', node_b, copy_links).append([node_a, deprecated])
+        self.added_count += 2
+
+    def compact(self):
+        '''Move links added since the arrays were built into them'''
+        a = array('i')
+        b = array('i')
+        deprecated = array('b')
+        for node in range(self.node_count):
+            # Each pair is linked from both of its nodes, so only take
+            # it from one side; a pair of a node with itself is linked
+            # from it twice:
+            self_links = 0
+            for neighbour, link_deprecated in self.links(node):
+                if node == neighbour:
+                    self_links += 1
+                    if self_links % 2 == 0:
+                        continue
+                elif node > neighbour:
+                    continue
+                a.append(node)
+                b.append(neighbour)
+                deprecated.append(link_deprecated)
+        self.build(a, b, deprecated)
+
+    def refresh(self):
+        '''Return the graph with every claim from the change feed since this one
+
+        That's a new graph, unless there's nothing new.'''
+        generation = changes.current_generation()
+        claim_ids = changes.changed_claim_ids(self.last_claim_id, REFRESH_BATCH_SIZE)
+        # e.g. a scheme has been renamed, by this process or any other:
+        names_changed = Scheme.objects.names_version() != self.names_version
+        if not (claim_ids or names_changed):
+            self.generation = generation
+            self.refreshed_at = time.time()
+            return self
+        graph = self.copy()
+        graph.generation = generation
+        if names_changed:
+            graph.load_scheme_names()
+        while claim_ids:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    CHANGED_LINKS_SQL,
+                    [graph.last_claim_id, claim_ids[-1]])
+                changed = cursor.fetchall()
+            graph.add_missing_nodes(set(
+                identifier_id for low, high, _ in changed for identifier_id in (low, high)))
+            for low, high, deprecated in changed:
+                graph.set_pair(graph.node(low), graph.node(high), deprecated)
+            graph.last_claim_id = claim_ids[-1]
+            claim_ids = changes.changed_claim_ids(graph.last_claim_id, REFRESH_BATCH_SIZE)
+        if graph.added_count + graph.override_count > max(10000, len(graph.neighbours) // 20):
+            graph.compact()
+        if sum(len(extra) for extra in graph.scheme_extra.values()) > max(
+                10000, graph.node_count // 20):
+            graph.build_scheme_order()
+        graph.refreshed_at = time.time()
+        return graph
+
+    def refresh_if_due(self):
+        '''Return the graph refreshed if it might be out of date, or this one'''
+        interval = getattr(settings, 'MAPPING_GRAPH_REFRESH_INTERVAL', 1)
+        if (self.generation != changes.current_generation() or
+                time.time() - self.refreshed_at >= interval):
+            return self.refresh()
+        return self
+
+    def covers(self, last_claim_id):
+        '''Return whether every claim up to last_claim_id is in the graph
+
+        Use this with the last_claim_id of an identifier, or the
+        version of a scheme, to check that the graph is up to date
+        with it.'''
+        return (last_claim_id or 0) <= self.last_claim_id
+
+    def identifier_json(self, node):
+        return {
+            'value': self.value(node),
+            'scheme_id': self.schemes[node],
+            'scheme_name': self.scheme_names[self.schemes[node]],
+        }
+
+    def mapped_identifiers(self, identifier_id):
+        '''Return the identifiers currently mapped to one, or None if it isn't known
+
+        These are in the same form as the results of a lookup.'''
+        node = self.node(identifier_id)
+        if node is None:
+            return None
+        return [
+            self.identifier_json(neighbour)
+            for neighbour, deprecated in self.links(node) if not deprecated
+        ]
+
+    def scheme_nodes(self, scheme_id, after=None, up_to=None, target_scheme_id=None,
+                     values=None):
+        '''Generate (value, node) for the identifiers in a scheme with links
+
+        These are in order of value, and can be restricted as in
+        queries.scheme_mappings.'''
+        encoded_after = None if after is None else after.encode('utf-8')
+        encoded_up_to = None if up_to is None else up_to.encode('utf-8')
+
+        def in_range(encoded_value):
+            return ((encoded_after is None or encoded_value > encoded_after) and
+                    (encoded_up_to is None or encoded_value <= encoded_up_to))
+
+        if values is not None:
+            candidates = (
+                (encoded_value, self.find(scheme_id, encoded_value.decode('utf-8')))
+                for encoded_value in sorted(set(v.encode('utf-8') for v in values))
+                if in_range(encoded_value)
+            )
+        else:
+            order = self.scheme_order.get(scheme_id, ())
+            start = 0 if after is None else self.search(order, encoded_after, after=True)
+            end = len(order) if up_to is None else self.search(
+                order, encoded_up_to, after=True)
+            extra = sorted(
+                (encoded_value, node) for encoded_value, node in (
+                    (value.encode('utf-8'), node)
+                    for value, node in self.scheme_extra.get(scheme_id, {}).items())
+                if in_range(encoded_value))
+            candidates = merge(
+                ((self.encoded_value(order[i]), order[i]) for i in range(start, end)),
+                extra)
+        for encoded_value, node in candidates:
+            if node is None:
+                continue
+            if target_scheme_id is not None and not any(
+                    self.schemes[neighbour] == target_scheme_id
+                    for neighbour, _ in self.links(node)):
+                continue
+            yield encoded_value.decode('utf-8'), node
+
+    def scheme_mappings(self, scheme_id, after=None, up_to=None, target_scheme_id=None,
+                        values=None):
+        '''Generate the same as queries.scheme_mappings'''
+        for value, node in self.scheme_nodes(
+                scheme_id, after=after, up_to=up_to,
+                target_scheme_id=target_scheme_id, values=values):
+            yield value, [
+                self.identifier_json(neighbour)
+                for neighbour, deprecated in self.links(node)
+                if not deprecated and (
+                    target_scheme_id is None or self.schemes[neighbour] == target_scheme_id)
+            ]
+
+    def scheme_page_values(self, scheme_id, limit, after=None, target_scheme_id=None):
+        '''Return the same as queries.scheme_page_values'''
+        page = []
+        for value, node in self.scheme_nodes(
+                scheme_id, after=after, target_scheme_id=target_scheme_id):
+            page.append(value)
+            if len(page) > limit:
+                break
+        return page
+
+    def stats(self):
+        '''Return the size of the graph, and roughly how much memory it uses'''
+        link_count = len(self.neighbours) + self.added_count
+        array_bytes = sum(
+            a.itemsize * len(a) for a in (
+                self.identifier_ids, self.schemes, self.offsets, self.neighbours,
+                self.deprecated))
+        value_bytes = len(self.value_data) + self.value_offsets.itemsize * len(
+            self.value_offsets)
+        array_bytes += sum(
+            order.itemsize * len(order) for order in self.scheme_order.values())
+        index_bytes = sys.getsizeof(self.extra_nodes) + sum(
+            sys.getsizeof(extra) + sum(sys.getsizeof(value) for value in extra)
+            for extra in self.scheme_extra.values())
+        added_bytes = sys.getsizeof(self.added) + sum(
+            sys.getsizeof(links) + len(links) * sys.getsizeof([0, False])
+            for links in self.added.values()) + sys.getsizeof(self.overrides) + sum(
+            sys.getsizeof(overrides) for overrides in self.overrides.values())
+        total = array_bytes + value_bytes + index_bytes + added_bytes
+        pair_count = link_count // 2
+        return {
+            'identifiers': self.node_count,
+            'pairs': pair_count,
+            'array_bytes': array_bytes,
+            'value_bytes': value_bytes,
+            'index_bytes': index_bytes + added_bytes,
+            'bytes': total,
+            'bytes_per_million_pairs': (
+                int(total * 1000000 / pair_count) if pair_count else None),
+            'last_claim_id': self.last_claim_id,
+        }
+
+
+class PackedArray(object):
+    '''A read-only array of numbers in part of a buffer
+
+    This is for Pythons whose memoryviews can't be cast to arrays of
+    numbers (i.e. Python 2); each item is unpacked when it's read.'''
+
+    def __init__(self, buf, start, count, typecode):
+        self.buf = buf
+        self.start = start
+        self.count = count
+        self.struct = struct.Struct(str('<' + SNAPSHOT_TYPECODES[typecode]))
+        self.itemsize = self.struct.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.struct.unpack_from(self.buf, self.start + i * self.itemsize)[0]
+
+
+class BufferSlice(object):
+    '''Bytes in part of a buffer, for the same Pythons as PackedArray'''
+
+    def __init__(self, buf, start, end):
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, s):
+        return self.buf[self.start + s.start:self.start + s.stop]
+
+
+# A snapshot file starts with SNAPSHOT_HEADER, and then has each array
+# of the graph in turn, each padded to a multiple of 8 bytes, with
+# numbers stored little-endian in the sizes given here:
+SNAPSHOT_MAGIC = b'IDMAPGR1'
+SNAPSHOT_HEADER = struct.Struct(str('<8sqqqqqq'))
+SNAPSHOT_TYPECODES = {'i': 'i', 'b': 'b', OFFSET_TYPECODE: 'q'}
+SNAPSHOT_ITEM_SIZES = {'i': 4, 'b': 1, OFFSET_TYPECODE: 8}
+
+
+def snapshot_sections(node_count, link_count, value_byte_count, scheme_count):
+    '''Return the (attribute, typecode, count) of each array in a snapshot'''
+    return [
+        ('identifier_ids', 'i', node_count),
+        ('schemes', 'i', node_count),
+        ('value_offsets', OFFSET_TYPECODE, node_count + 1),
+        ('value_data', None, value_byte_count),
+        ('offsets', OFFSET_TYPECODE, node_count + 1),
+        ('neighbours', 'i', link_count),
+        ('deprecated', 'b', link_count),
+        # The ID, start in scheme_order and number of nodes of each scheme:
+        ('scheme_table', OFFSET_TYPECODE, scheme_count * 3),
+        ('scheme_order_nodes', 'i', node_count),
+    ]
+
+
+def padding(size):
+    return b'\0' * (-size % 8)
+
+
+def arrays_in_id_order(graph):
+    '''Return the arrays of a compacted graph, with its nodes renumbered in order of ID
+
+    Nodes can be added out of order of identifier ID (see add_node),
+    but a snapshot finds every node by bisecting identifier_ids, so
+    they're put in order first. The links from each node, and the
+    nodes of each scheme, stay in the same order.'''
+    nodes = sorted(range(graph.node_count), key=graph.identifier_ids.__getitem__)
+    renumbered = array('i', [0]) * graph.node_count
+    for new_node, node in enumerate(nodes):
+        renumbered[node] = new_node
+    arrays = {
+        'identifier_ids': array('i'),
+        'schemes': array('i'),
+        'value_offsets': array(OFFSET_TYPECODE, [0]),
+        'value_data': bytearray(),
+        'offsets': array(OFFSET_TYPECODE, [0]),
+        'neighbours': array('i'),
+        'deprecated': array('b'),
+    }
+    for node in nodes:
+        arrays['identifier_ids'].append(graph.identifier_ids[node])
+        arrays['schemes'].append(graph.schemes[node])
+        arrays['value_data'].extend(graph.encoded_value(node))
+        arrays['value_offsets'].append(len(arrays['value_data']))
+        for i in range(graph.offsets[node], graph.offsets[node + 1]):
+            arrays['neighbours'].append(renumbered[graph.neighbours[i]])
+            arrays['deprecated'].append(graph.deprecated[i])
+        arrays['offsets'].append(len(arrays['neighbours']))
+    scheme_order = {
+        scheme_id: [renumbered[node] for node in order]
+        for scheme_id, order in graph.scheme_order.items()
+    }
+    return arrays, scheme_order
+
+
+def write_snapshot(graph, path):
+    '''Write a snapshot file of a graph, replacing any at path atomically
+
+    The graph's added links and nodes are moved into its arrays first.'''
+    graph.compact()
+    graph.build_scheme_order()
+    if graph.sorted_node_count == graph.node_count:
+        arrays = {
+            'identifier_ids': graph.identifier_ids,
+            'schemes': graph.schemes,
+            'value_offsets': graph.value_offsets,
+            'value_data': graph.value_data,
+            'offsets': graph.offsets,
+            'neighbours': graph.neighbours,
+            'deprecated': graph.deprecated,
+        }
+        scheme_orders = graph.scheme_order
+    else:
+        arrays, scheme_orders = arrays_in_id_order(graph)
+    scheme_table = array(OFFSET_TYPECODE)
+    scheme_order = array('i')
+    for scheme_id in sorted(scheme_orders):
+        order = scheme_orders[scheme_id]
+        scheme_table.extend([scheme_id, len(scheme_order), len(order)])
+        scheme_order.extend(order)
+    arrays['scheme_table'] = scheme_table
+    arrays['scheme_order_nodes'] = scheme_order
+    temporary_path = path + '.tmp'
+    try:
+        with io.open(temporary_path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC, graph.last_claim_id, int(graph.ordered),
+                graph.node_count, len(graph.neighbours), len(graph.value_data),
+                len(graph.scheme_order)))
+            for attribute, typecode, count in snapshot_sections(
+                    graph.node_count, len(graph.neighbours), len(graph.value_data),
+                    len(graph.scheme_order)):
+                data = arrays[attribute]
+                if typecode is not None:
+                    data = array(typecode, data)
+                    if sys.byteorder == 'big':
+                        data.byteswap()
+                    data = data.tobytes() if hasattr(data, 'tobytes') else data.tostring()
+                else:
+                    data = bytes(data)
+                f.write(data)
+                f.write(padding(len(data)))
+        os.rename(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+class GraphSnapshot(MappingGraph):
+    '''A graph read from a snapshot file, shared with other processes
+
+    The file is mapped into memory read-only, and its arrays are read
+    where they are, so however many processes use a snapshot, there's
+    only one copy of it, in the operating system's page cache. Rather
+    than being refreshed, a snapshot is replaced when a new file is
+    written; until then, it only answers questions about identifiers
+    and schemes that haven't changed since it was built (see covers).'''
+
+    def __init__(self, path, cast=True):
+        super(GraphSnapshot, self).__init__()
+        self.path = path
+        with io.open(path, 'rb') as f:
+            self.file_id = self.stat_file_id(os.fstat(f.fileno()))
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.last_claim_id, ordered, node_count, link_count,
+         value_byte_count, scheme_count) = SNAPSHOT_HEADER.unpack_from(self.mmap, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('{0} is not a mapping graph snapshot'.format(path))
+        self.ordered = bool(ordered)
+        try:
+            view = memoryview(self.mmap)
+        except TypeError:
+            # Python 2's mmaps only have the old buffer interface:
+            view = None
+        cast = cast and hasattr(view, 'cast') and sys.byteorder == 'little'
+        position = SNAPSHOT_HEADER.size
+        for attribute, typecode, count in snapshot_sections(
+                node_count, link_count, value_byte_count, scheme_count):
+            size = count * SNAPSHOT_ITEM_SIZES.get(typecode, 1)
+            if typecode is None:
+                data = view[position:position + size] if cast else BufferSlice(
+                    self.mmap, position, position + size)
+            elif cast:
+                data = view[position:position + size].cast(
+                    str(SNAPSHOT_TYPECODES[typecode]))
+            else:
+                data = PackedArray(self.mmap, position, count, typecode)
+            setattr(self, attribute, data)
+            position += size + len(padding(size))
+        # write_snapshot puts every node in order of identifier ID:
+        self.node_count = self.sorted_node_count = node_count
+        for i in range(scheme_count):
+            scheme_id, start, count = [self.scheme_table[i * 3 + j] for j in range(3)]
+            if cast:
+                order = self.scheme_order_nodes[start:start + count]
+            else:
+                order = PackedArray(
+                    self.mmap, self.scheme_order_nodes.start + start * 4, count, 'i')
+            self.scheme_order[scheme_id] = order
+        self.load_scheme_names()
+        self.refreshed_at = time.time()
+
+    @staticmethod
+    def stat_file_id(stat):
+        return (stat.st_dev, stat.st_ino, stat.st_mtime)
+
+    @classmethod
+    def open(cls, path):
+        '''Return the snapshot at path, or None if there isn't one'''
+        try:
+            return cls(path)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def refresh_if_due(self):
+        '''Return a new snapshot if the file has been replaced, or this one'''
+        interval = getattr(settings, 'MAPPING_GRAPH_REFRESH_INTERVAL', 1)
+        if time.time() - self.refreshed_at < interval:
+            return self
+        self.refreshed_at = time.time()
+        try:
+            replaced = self.stat_file_id(os.stat(self.path)) != self.file_id
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            replaced = False
+        if replaced:
+            return GraphSnapshot.open(self.path) or self
+        if Scheme.objects.names_version() != self.names_version:
+            # The arrays are never changed, so they can be shared:
+            graph = copy.copy(self)
+            graph.load_scheme_names()
+            return graph
+        return self
+
+    def stats(self):
+        stats = super(GraphSnapshot, self).stats()
+        stats['file_bytes'] = len(self.mmap)
+        return stats
+
+
+_graph = [None]
+# The process that loaded _graph, so that a process forked from it
+# loads its own rather than using one it can't keep up to date:
+_graph_pid = [None]
+_graph_lock = threading.Lock()
+
+_state = threading.local()
+
+
+@contextmanager
+def pinned_mapping_graph():
+    '''Make mapping_graph return the same graph throughout the block
+
+    Views read from the graph inside this, so that everything in a
+    response comes from one version of it, even if a newer one
+    replaces it meanwhile.'''
+    previous = getattr(_state, 'pinned', None)
+    # The graph is only found (and so loaded) if it's used:
+    _state.pinned = []
+    try:
+        yield
+    finally:
+        _state.pinned = previous
+
+
+def mapping_graph(ordered=False):
+    '''Return this process's up-to-date graph, or None if it isn't used
+
+    If MAPPING_GRAPH_SNAPSHOT is set, this is the snapshot at that path,
+    or None if there isn't one yet; otherwise, if MAPPING_GRAPH is set,
+    it's loaded from the database the first time this is called in
+    each process. It isn't loaded when the application starts, and a
+    graph loaded by another process is never used: servers that load
+    the application before forking their workers (e.g. gunicorn with
+    --preload) would otherwise leave every worker with the parent's
+    graph, database connection and no thread listening for new
+    claims. With ordered, None is also returned if the graph's order
+    of values doesn't match the database's.'''
+    snapshot_path = getattr(settings, 'MAPPING_GRAPH_SNAPSHOT', None)
+    if not (snapshot_path or getattr(settings, 'MAPPING_GRAPH', False)):
+        return None
+    pinned = getattr(_state, 'pinned', None)
+    if pinned:
+        graph = pinned[0]
+    else:
+        with _graph_lock:
+            graph = _graph[0]
+            if _graph_pid[0] != os.getpid():
+                graph = None
+                _graph_pid[0] = os.getpid()
+            if graph is not None:
+                graph = graph.refresh_if_due()
+            elif snapshot_path:
+                graph = GraphSnapshot.open(snapshot_path)
+            else:
+                graph = MappingGraph()
+                graph.load()
+                if getattr(settings, 'CHANGES_LISTEN', True):
+                    changes.start_listener()
+            _graph[0] = graph
+        if pinned is not None:
+            pinned.append(graph)
+    if graph is None or (ordered and not graph.ordered):
+        return None
+    return graph
+
+
+def unload_mapping_graph():
+    with _graph_lock:
+        _graph[0] = None
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+'''A cache of rendered lookup responses
+
+Responses are cached under keys that include a "generation" for the
+identifier or scheme they're about, which is itself stored in the
+cache. When a claim is recorded, the generations of both of its
+identifiers and both of their schemes are replaced with new random
+values, so every response that might have changed is never looked
+up again and eventually gets evicted. This is done both straight
+away and once the transaction commits: the second time catches any
+response that was cached from a read that started before the commit
+and so might have missed the claim.'''
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+from uuid import uuid4
+
+from django.core.cache import caches
+from django.db import transaction
+
+
+LOOKUP_CACHE_ALIAS = 'lookups'
+
+HITS_KEY = 'stats:hits'
+MISSES_KEY = 'stats:misses'
+
+
+def lookup_cache():
+    return caches[LOOKUP_CACHE_ALIAS]
+
+
+def make_key(*parts):
+    # Values can contain anything, so hash them to keep keys short
+    # and safe for every backend:
+    return hashlib.md5(
+        json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+def identifier_generation_key(scheme, value):
+    '''The generation key for an identifier, with its scheme as in the URL'''
+    return make_key('identifier', scheme, value)
+
+
+def scheme_generation_key(scheme_id):
+    return make_key('scheme', '{0}'.format(scheme_id))
+
+
+# Shared by every response, so they can all be invalidated at once:
+ALL_GENERATION_KEY = make_key('all')
+
+
+def current_generations(generation_keys):
+    cache = lookup_cache()
+    generations = cache.get_many(generation_keys)
+    for generation_key in generation_keys:
+        if generation_key not in generations:
+            cache.add(generation_key, uuid4().hex, None)
+            generations[generation_key] = cache.get(generation_key)
+    return [generations[generation_key] for generation_key in generation_keys]
+
+
+def response_key(generation_key, *parts):
+    '''Return the key to cache a response under in the current generation'''
+    generations = current_generations([ALL_GENERATION_KEY, generation_key])
+    return make_key('response', generations, *parts)
+
+
+def bump_generations(generation_keys):
+    lookup_cache().set_many(
+        {generation_key: uuid4().hex for generation_key in generation_keys},
+        None)
+
+
+def invalidate_identifiers(identifier_ids):
+    '''Stop cached responses about these identifiers being used
+
+    This covers lookups of each identifier by its scheme's ID or name,
+    and the mappings of each identifier's scheme.'''
+    from .models import Identifier
+    generation_keys = set()
+    for scheme_id, scheme_name, value in Identifier.objects.filter(
+            pk__in=set(identifier_ids)
+    ).values_list('scheme_id', 'scheme__name', 'value'):
+        generation_keys.update([
+            identifier_generation_key('{0}'.format(scheme_id), value),
+            identifier_generation_key(scheme_name, value),
+            scheme_generation_key(scheme_id),
+        ])
+    bump_generations(generation_keys)
+    transaction.on_commit(lambda: bump_generations(generation_keys))
+
+
+def invalidate_all():
+    '''Stop every cached response being used, e.g. after a bulk import'''
+    bump_generations([ALL_GENERATION_KEY])
+    transaction.on_commit(lambda: bump_generations([ALL_GENERATION_KEY]))
+
+
+def record_hit(hit):
+    cache = lookup_cache()
+    key = HITS_KEY if hit else MISSES_KEY
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The counter hasn't been created yet, or has been evicted:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def stats():
+    counts = lookup_cache().get_many([HITS_KEY, MISSES_KEY])
+    hits = counts.get(HITS_KEY, 0)
+    misses = counts.get(MISSES_KEY, 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': (float(hits) / (hits + misses)) if (hits + misses) else None,
+    }
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from id_mappings.benchmarks import (
+    BENCHMARKS, compare, current_commit, entity_count, generate_data, over_budget,
+    run_benchmarks)
+
+
+def sizes(value):
+    return sorted(int(size) for size in value.split(','))
+
+
+class Command(BaseCommand):
+
+    help = '''Time the API's endpoints against generated data, and check their query counts
+
+Generated data is added to the database and left there for later
+runs, so only run this against a database set aside for it.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=sizes,
+            default=[1000, 10000, 100000],
+            help='Comma-separated numbers of entities to run the benchmarks with, in turn')
+        parser.add_argument(
+            '--schemes',
+            type=int,
+            default=4,
+            help='The number of schemes each entity has an identifier in')
+        parser.add_argument(
+            '--history-depth',
+            type=int,
+            default=4,
+            help='The most claims to generate about each pair of identifiers')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='The number of processes to import generated claims with')
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=20,
+            help='The number of times to time each benchmark at each size')
+        parser.add_argument(
+            '--benchmark',
+            action='append',
+            choices=[benchmark.name for benchmark in BENCHMARKS],
+            help='Only run this benchmark (can be given more than once)')
+        parser.add_argument(
+            '--output',
+            help='Write the results to this JSON file')
+        parser.add_argument(
+            '--compare',
+            help='Compare the timings with those in an earlier JSON file of results')
+        parser.add_argument(
+            '--max-regression',
+            type=float,
+            default=20,
+            help='With --compare, the percentage slowdown to fail on')
+
+    def handle(self, *args, **options):
+        if options['schemes'] < 2:
+            raise CommandError('There must be at least 2 schemes')
+        results = {
+            'commit': current_commit(),
+            'started': timezone.now().isoformat(),
+            'runs': [],
+        }
+        for size in options['sizes']:
+            self.stdout.write('Generating data for {0} entities'.format(size))
+            schemes = generate_data(
+                options['schemes'], size, workers=options['workers'],
+                history_depth=options['history_depth'])
+            if entity_count(schemes) > size:
+                # Data is never removed, so this size has been passed:
+                self.stdout.write('Skipping {0} entities, as there are already {1}'.format(
+                    size, entity_count(schemes)))
+                continue
+            try:
+                run = run_benchmarks(
+                    schemes, repeat=options['repeat'], names=options['benchmark'])
+            except ValueError as e:
+                raise CommandError(e)
+            results['runs'].append(run)
+            self.stdout.write('{0} identifiers, {1} claims:'.format(
+                run['identifiers'], run['claims']))
+            for name, result in sorted(run['benchmarks'].items()):
+                self.stdout.write(
+                    '  {0}: median {1:.1f}ms, p95 {2:.1f}ms, {3} queries'.format(
+                        name, result['median_ms'], result['p95_ms'], result['queries']))
+        if options['output']:
+            with io.open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(json.dumps(results, indent=4, sort_keys=True))
+        failures = over_budget(results)
+        if options['compare']:
+            with io.open(options['compare'], encoding='utf-8') as f:
+                old_results = json.load(f)
+            self.stdout.write('Compared with {0}:'.format(
+                old_results.get('commit') or options['compare']))
+            for name, entities, old_median, new_median, regressed in compare(
+                    old_results, results, options['max_regression'] / 100.0):
+                self.stdout.write('  {0} with {1} entities: {2:.1f}ms -> {3:.1f}ms{4}'.format(
+                    name, entities, old_median, new_median,
+                    ' (regression)' if regressed else ''))
+                if regressed:
+                    failures.append('{0} with {1} entities is slower'.format(
+                        name, entities))
+        if failures:
+            raise CommandError('\n'.join(failures))
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from id_mappings.graph import MappingGraph, write_snapshot
+
+
+class Command(BaseCommand):
+
+    help = 'Write a snapshot file of the mappings for web processes to share'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            help='The file to write (MAPPING_GRAPH_SNAPSHOT by default)')
+        parser.add_argument(
+            '--watch',
+            action='store_true',
+            help='Keep running, writing a new snapshot whenever claims are made')
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=10,
+            help='With --watch, the number of seconds between checks for claims')
+
+    def handle(self, *args, **options):
+        path = options['output'] or settings.MAPPING_GRAPH_SNAPSHOT
+        if not path:
+            raise CommandError('MAPPING_GRAPH_SNAPSHOT is not set')
+        graph = MappingGraph()
+        graph.load()
+        written_claim_id = None
+        while True:
+            if graph.last_claim_id != written_claim_id:
+                write_snapshot(graph, path)
+                written_claim_id = graph.last_claim_id
+                stats = graph.stats()
+                self.stdout.write(
+                    'Wrote a snapshot of {0} identifiers and {1} pairs, up to claim {2}'.format(
+                        stats['identifiers'], stats['pairs'], graph.last_claim_id))
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
+            # The graph is kept in memory and brought up to date from
+            # the change feed, rather than being loaded again each time:
+            graph = graph.refresh()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from id_mappings.snapshots import build_snapshots, snapshot_dir
+
+
+class Command(BaseCommand):
+
+    help = "Write snapshot files of the schemes whose mappings have changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scheme',
+            type=int,
+            action='append',
+            dest='scheme_ids',
+            metavar='SCHEME_ID',
+            help='Only consider this scheme (can be given more than once)')
+        parser.add_argument(
+            '--watch',
+            action='store_true',
+            help='Keep running, rebuilding snapshots as schemes change')
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=60,
+            help='With --watch, the number of seconds between checks for changes')
+
+    def handle(self, *args, **options):
+        if not snapshot_dir():
+            raise CommandError('SCHEME_SNAPSHOT_DIR is not set')
+        while True:
+            for scheme in build_snapshots(options['scheme_ids']):
+                self.stdout.write('Built a snapshot of scheme {0} ({1})'.format(
+                    scheme.id, scheme.name))
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from id_mappings.models import IdempotentRequest
+
+
+class Command(BaseCommand):
+
+    help = 'Delete the saved responses of claims made with Idempotency-Keys that have expired'
+
+    def handle(self, *args, **options):
+        count, _ = IdempotentRequest.objects.expired().delete()
+        self.stdout.write('Deleted {0} expired idempotency keys'.format(count))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from id_mappings.models import ArchivedEquivalenceClaim
+
+
+class Command(BaseCommand):
+
+    help = '''Move superseded claims older than a cutoff into the archive
+
+A claim is superseded once there's a later claim about the same pair
+of identifiers, so it no longer affects the pair's state. Archived
+claims are only included in the history of lookups made with
+include_archived=1, and aren't in the change feed, so don't archive
+claims that followers of /changes might not have seen yet.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=int,
+            default=90,
+            help='Only archive claims made at least this many days ago')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10000,
+            help='The number of claims to move in each transaction')
+
+    def handle(self, *args, **options):
+        if options['older_than'] < 0:
+            raise CommandError('--older-than must not be negative')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        count = ArchivedEquivalenceClaim.objects.archive_superseded(
+            timezone.now() - timedelta(days=options['older_than']),
+            batch_size=options['batch_size'])
+        self.stdout.write('Archived {0} superseded claims'.format(count))
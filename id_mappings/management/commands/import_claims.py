@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import csv
+import io
+import json
+from multiprocessing import Pool
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+
+from id_mappings.changes import reserve_transaction_id
+from id_mappings.components import rebuild_components
+from id_mappings.models import EquivalenceClaim, Identifier, ResolvedEquivalence, Scheme
+
+
+TRUE_STRINGS = ('1', 't', 'true', 'y', 'yes')
+
+
+def staging_table_name():
+    return 'id_mappings_claim_import_{0}'.format(os.getpid())
+
+
+def create_identifiers_for_scheme(staging_table, scheme_id):
+    '''Create any identifiers from one scheme that don't exist yet
+
+    Each scheme is only ever handled by one worker, so workers never
+    wait on each other to create the same identifier.'''
+    with connection.cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO {identifier_table}
+                (scheme_id, value, last_claim_id, archived_claim_count)
+            SELECT %(scheme_id)s, staged.value, 0, 0 FROM (
+                SELECT value_a AS value FROM {staging_table}
+                WHERE scheme_a_id = %(scheme_id)s
+                UNION
+                SELECT value_b AS value FROM {staging_table}
+                WHERE scheme_b_id = %(scheme_id)s
+            ) AS staged
+            ON CONFLICT (scheme_id, value) DO NOTHING
+        '''.format(
+            identifier_table=Identifier._meta.db_table,
+            staging_table=staging_table,
+        ), {'scheme_id': scheme_id})
+        return cursor.rowcount
+
+
+def create_claims_for_scheme(staging_table, scheme_id):
+    '''Insert the claims whose first identifier is from one scheme'''
+    with transaction.atomic(), connection.cursor() as cursor:
+        reserve_transaction_id()
+        cursor.execute('''
+            INSERT INTO {claim_table}
+                (identifier_a_id, identifier_b_id, deprecated, comment, created)
+            SELECT identifier_a.id, identifier_b.id,
+                staged.deprecated, staged.comment, staged.created
+            FROM {staging_table} AS staged
+            JOIN {identifier_table} AS identifier_a
+                ON identifier_a.scheme_id = staged.scheme_a_id
+                AND identifier_a.value = staged.value_a
+            JOIN {identifier_table} AS identifier_b
+                ON identifier_b.scheme_id = staged.scheme_b_id
+                AND identifier_b.value = staged.value_b
+            WHERE staged.scheme_a_id = %s
+            ORDER BY staged.line
+        '''.format(
+            claim_table=EquivalenceClaim._meta.db_table,
+            identifier_table=Identifier._meta.db_table,
+            staging_table=staging_table,
+        ), [scheme_id])
+        return cursor.rowcount
+
+
+def run_partition(args):
+    function, staging_table, scheme_id = args
+    return function(staging_table, scheme_id)
+
+
+class Command(BaseCommand):
+
+    help = 'Import equivalence claims from CSV or JSON Lines files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('filenames', nargs='+', metavar='FILENAME')
+        parser.add_argument(
+            '--format',
+            choices=('csv', 'jsonl'),
+            help='The format of the input files (by default, guessed from the extension)')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='The number of processes to split the import across, by scheme')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100000,
+            help='The number of rows to send to the database in each COPY')
+
+    def handle(self, *args, **options):
+        self.schemes = {}
+        for scheme_id, name in Scheme.objects.values_list('id', 'name'):
+            self.schemes[six.text_type(scheme_id)] = scheme_id
+            self.schemes[name] = scheme_id
+        self.workers = options['workers']
+        staging_table = staging_table_name()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM {0}'.format(
+                EquivalenceClaim._meta.db_table))
+            max_claim_id_before = cursor.fetchone()[0]
+            cursor.execute('''
+                CREATE UNLOGGED TABLE {0} (
+                    line serial PRIMARY KEY,
+                    scheme_a_id integer NOT NULL,
+                    value_a varchar(512) NOT NULL,
+                    scheme_b_id integer NOT NULL,
+                    value_b varchar(512) NOT NULL,
+                    deprecated boolean NOT NULL,
+                    comment text NOT NULL,
+                    created timestamp with time zone NOT NULL
+                )
+            '''.format(staging_table))
+        imported = False
+        try:
+            staged = self.load_staging_table(
+                staging_table, options['filenames'], options['format'],
+                options['batch_size'])
+            self.stdout.write('Staged {0} claims'.format(staged))
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE {0}'.format(staging_table))
+                cursor.execute('''
+                    SELECT scheme_a_id FROM {0}
+                    UNION
+                    SELECT scheme_b_id FROM {0}
+                '''.format(staging_table))
+                all_scheme_ids = [row[0] for row in cursor.fetchall()]
+                cursor.execute(
+                    'SELECT DISTINCT scheme_a_id FROM {0}'.format(staging_table))
+                scheme_a_ids = [row[0] for row in cursor.fetchall()]
+            identifiers_created = self.run_partitioned(
+                create_identifiers_for_scheme, staging_table, all_scheme_ids)
+            self.stdout.write('Created {0} identifiers'.format(identifiers_created))
+            claims_created = self.run_partitioned(
+                create_claims_for_scheme, staging_table, scheme_a_ids)
+            self.stdout.write('Created {0} claims'.format(claims_created))
+            imported = True
+        finally:
+            # Each partition commits on its own, so even if a later one
+            # failed, the claims that did get in must be resolved:
+            try:
+                self.resolve_claims_after(max_claim_id_before, imported)
+            finally:
+                with connection.cursor() as cursor:
+                    cursor.execute('DROP TABLE IF EXISTS {0}'.format(staging_table))
+
+    def resolve_claims_after(self, claim_id, imported):
+        '''Resolve the claims with IDs above claim_id, if there are any
+
+        If this fails, that's a CommandError if the import succeeded;
+        otherwise the failure is only reported, so that the error that
+        stopped the import is the one raised.'''
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT EXISTS (SELECT 1 FROM {0} WHERE id > %s)'.format(
+                    EquivalenceClaim._meta.db_table), [claim_id])
+                if not cursor.fetchone()[0]:
+                    return
+            # For a bulk load it's quicker to recompute the components
+            # from scratch than to update them link by link:
+            ResolvedEquivalence.objects.record_claims_after(
+                claim_id, update_components=False)
+            rebuild_components()
+        except Exception as e:
+            message = (
+                'Resolving the imported claims failed ({0}); the resolved '
+                'equivalences are now out of date, so run '
+                '"manage.py rebuild_resolved_equivalences"'.format(e))
+            if imported:
+                raise CommandError(message)
+            self.stderr.write(message)
+
+    def run_partitioned(self, function, staging_table, scheme_ids):
+        tasks = [(function, staging_table, scheme_id) for scheme_id in scheme_ids]
+        if self.workers <= 1:
+            return sum(run_partition(task) for task in tasks)
+        # Forked workers must open their own database connections
+        # rather than share the parent's:
+        connections.close_all()
+        pool = Pool(self.workers)
+        try:
+            return sum(pool.imap_unordered(run_partition, tasks))
+        finally:
+            pool.close()
+            pool.join()
+
+    def load_staging_table(self, staging_table, filenames, file_format, batch_size):
+        copy_sql = '''
+            COPY {0} (scheme_a_id, value_a, scheme_b_id, value_b,
+                      deprecated, comment, created)
+            FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (value_a, value_b, comment))
+        '''.format(staging_table)
+        total = 0
+        batch = []
+        with connection.cursor() as cursor:
+            for row in self.all_rows(filenames, file_format):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    self.copy_batch(cursor, copy_sql, batch)
+                    total += len(batch)
+                    batch = []
+            if batch:
+                self.copy_batch(cursor, copy_sql, batch)
+                total += len(batch)
+        return total
+
+    def copy_batch(self, cursor, copy_sql, batch):
+        buf = io.StringIO() if six.PY3 else io.BytesIO()
+        writer = csv.writer(buf)
+        for row in batch:
+            if six.PY2:
+                row = [six.text_type(v).encode('utf-8') for v in row]
+            writer.writerow(row)
+        buf.seek(0)
+        cursor.copy_expert(copy_sql, buf)
+
+    def all_rows(self, filenames, file_format):
+        for filename in filenames:
+            this_format = file_format
+            if this_format is None:
+                this_format = 'csv' if filename.endswith('.csv') else 'jsonl'
+            with io.open(filename, encoding='utf-8', newline='') as f:
+                if this_format == 'csv':
+                    records = csv.DictReader(f)
+                else:
+                    records = (json.loads(line) for line in f if line.strip())
+                for line_number, record in enumerate(records, start=1):
+                    try:
+                        yield self.staging_row(record)
+                    except (KeyError, TypeError, ValueError) as e:
+                        raise CommandError('{0}, record {1}: {2}'.format(
+                            filename, line_number, e))
+
+    def staging_row(self, record):
+        row = []
+        for scheme_key, value_key in (('scheme_a', 'value_a'), ('scheme_b', 'value_b')):
+            scheme = six.text_type(record[scheme_key])
+            if scheme not in self.schemes:
+                raise ValueError('Unknown scheme: {0}'.format(scheme))
+            row += [self.schemes[scheme], record[value_key]]
+        deprecated = record.get('deprecated') or False
+        if isinstance(deprecated, six.string_types):
+            deprecated = deprecated.strip().lower() in TRUE_STRINGS
+        created = record.get('created')
+        if created:
+            created = parse_datetime(created)
+            if created is None:
+                raise ValueError('Invalid created timestamp')
+            if timezone.is_naive(created):
+                created = timezone.make_aware(created, timezone.utc)
+        else:
+            created = timezone.now()
+        row += [
+            't' if deprecated else 'f',
+            record.get('comment') or '',
+            created.isoformat(),
+        ]
+        return row
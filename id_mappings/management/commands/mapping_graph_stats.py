@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from id_mappings.graph import MappingGraph
+
+
+class Command(BaseCommand):
+
+    help = 'Load the mappings into memory as the web processes would, and report the memory used'
+
+    def handle(self, *args, **options):
+        start = time.time()
+        graph = MappingGraph()
+        graph.load()
+        stats = graph.stats()
+        self.stdout.write('Loaded {0} identifiers and {1} pairs in {2:.1f}s'.format(
+            stats['identifiers'], stats['pairs'], time.time() - start))
+        self.stdout.write(
+            'Memory used: {0} bytes ({1} in arrays, {2} in values, {3} in indexes)'.format(
+                stats['bytes'], stats['array_bytes'], stats['value_bytes'],
+                stats['index_bytes']))
+        if stats['bytes_per_million_pairs'] is not None:
+            self.stdout.write('Bytes per million pairs: {0}'.format(
+                stats['bytes_per_million_pairs']))
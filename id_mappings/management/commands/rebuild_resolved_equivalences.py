@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from id_mappings.models import ResolvedEquivalence
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuild the resolved equivalence table from the claim log'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help="Only report pairs whose resolved state doesn't match the claim log")
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            count = ResolvedEquivalence.objects.rebuild()
+            self.stdout.write(
+                'Rebuilt {0} resolved equivalences and their components'.format(count))
+        discrepancies = ResolvedEquivalence.objects.discrepancies()
+        for id_a, id_b, expected_claim_id, stored_claim_id in discrepancies:
+            self.stdout.write(
+                'Identifiers {0} and {1}: latest claim is {2}, resolved from {3}'.format(
+                    id_a, id_b, expected_claim_id, stored_claim_id))
+        if discrepancies:
+            raise CommandError(
+                '{0} resolved equivalences disagree with the claim log'.format(
+                    len(discrepancies)))
+        self.stdout.write('Resolved equivalences match the claim log')
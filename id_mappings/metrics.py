@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+'''Timing each request, and latency histograms of each route
+
+If METRICS is set, MetricsMiddleware records, for each request, the
+number of SQL queries it made and the time spent running them, the
+time spent serializing the response (in renderers.py), and the rest
+of the time in the view, which is mostly spent turning rows into
+objects. These are sent back in a Server-Timing header, e.g.:
+
+    Server-Timing: db;dur=3.1;desc="4 queries", serialize;dur=0.4, view;dur=1.2, total;dur=4.9
+
+... and added to per-route histograms and totals, which /metrics
+returns in the Prometheus text format. The metrics are kept by each
+process, so with several processes each one has to be scraped.
+
+Queries are timed by wrapping the cursors each database connection
+makes while a request is being handled (as execute_wrapper does in
+later versions of Django). Work done while a streaming response is
+being sent isn't included.'''
+
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+
+# Upper bounds of the request duration histograms' buckets, in seconds:
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_state = threading.local()
+
+
+class RequestTimings(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+
+    def phases(self, total):
+        return [
+            ('db', self.db_time, '{0} queries'.format(self.queries)),
+            ('serialize', self.serialize_time, None),
+            ('view', max(0.0, total - self.db_time - self.serialize_time), None),
+            ('total', total, None),
+        ]
+
+
+def current_timings():
+    return getattr(_state, 'timings', None)
+
+
+@contextmanager
+def serializing():
+    '''Count the time in the block as serialization of the current request'''
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.serialize_time += time.time() - start
+
+
+class TimedCursorWrapper(object):
+    '''Add the time each query takes to the request's timings'''
+
+    def __init__(self, cursor, timings):
+        self.cursor = cursor
+        self.timings = timings
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def timed(self, method, *args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            self.timings.queries += 1
+            self.timings.db_time += time.time() - start
+
+    def execute(self, *args):
+        return self.timed(self.cursor.execute, *args)
+
+    def executemany(self, *args):
+        return self.timed(self.cursor.executemany, *args)
+
+    def callproc(self, *args):
+        return self.timed(self.cursor.callproc, *args)
+
+
+@contextmanager
+def timing_queries(timings):
+    '''Time the queries made on every database connection in this thread'''
+    patched = []
+    for alias in connections:
+        connection = connections[alias]
+        for name in ('make_cursor', 'make_debug_cursor'):
+            patched.append((connection, name, connection.__dict__.get(name)))
+            setattr(connection, name, timed_cursor_maker(getattr(connection, name), timings))
+    try:
+        yield
+    finally:
+        for connection, name, previous in reversed(patched):
+            if previous is None:
+                # Without the instance attribute, the method is used again:
+                delattr(connection, name)
+            else:
+                setattr(connection, name, previous)
+
+
+def timed_cursor_maker(make_cursor, timings):
+    def make_timed_cursor(cursor):
+        return TimedCursorWrapper(make_cursor(cursor), timings)
+    return make_timed_cursor
+
+
+class Route(object):
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(DURATION_BUCKETS) + 1)
+        self.count = 0
+        self.duration = 0.0
+        self.db_time = 0.0
+        self.queries = 0
+        self.serialize_time = 0.0
+        self.statuses = defaultdict(int)
+
+
+class Registry(object):
+    '''Per-route histograms of request durations, and totals of their timings'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = defaultdict(Route)
+
+    def record(self, route, method, status, total, timings):
+        with self.lock:
+            route = self.routes[(route, method)]
+            route.bucket_counts[bisect_left(DURATION_BUCKETS, total)] += 1
+            route.count += 1
+            route.duration += total
+            route.db_time += timings.db_time
+            route.queries += timings.queries
+            route.serialize_time += timings.serialize_time
+            route.statuses[status] += 1
+
+    def clear(self):
+        with self.lock:
+            self.routes.clear()
+
+    def prometheus_text(self):
+        '''Return the metrics in the Prometheus text exposition format'''
+        lines = []
+
+        def metric(name, kind, description):
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+
+        def sample(name, labels, value):
+            lines.append('{0}{{{1}}} {2}'.format(name, ','.join(
+                '{0}="{1}"'.format(key, escape_label(label_value))
+                for key, label_value in labels), format_value(value)))
+
+        with self.lock:
+            routes = sorted(self.routes.items())
+            name = 'id_mappings_request_duration_seconds'
+            metric(name, 'histogram', 'Time taken to handle requests')
+            for (route_name, method), route in routes:
+                labels = [('route', route_name), ('method', method)]
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS + ('+Inf',), route.bucket_counts):
+                    cumulative += count
+                    sample(name + '_bucket', labels + [('le', bound)], cumulative)
+                sample(name + '_sum', labels, route.duration)
+                sample(name + '_count', labels, route.count)
+            for attribute, name, description in (
+                    ('db_time', 'id_mappings_request_db_seconds_total',
+                     'Time spent running SQL queries'),
+                    ('queries', 'id_mappings_request_db_queries_total',
+                     'SQL queries made'),
+                    ('serialize_time', 'id_mappings_request_serialize_seconds_total',
+                     'Time spent serializing responses')):
+                metric(name, 'counter', description)
+                for (route_name, method), route in routes:
+                    sample(name, [('route', route_name), ('method', method)],
+                           getattr(route, attribute))
+            name = 'id_mappings_requests_total'
+            metric(name, 'counter', 'Requests handled, by response status')
+            for (route_name, method), route in routes:
+                for status, count in sorted(route.statuses.items()):
+                    sample(name, [
+                        ('route', route_name), ('method', method), ('status', status),
+                    ], count)
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return '{0}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return '{0}'.format(value)
+
+
+registry = Registry()
+
+
+def route_name(request):
+    '''Return the name of the URL pattern a request matched'''
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    if match.url_name:
+        return match.url_name
+    view_class = getattr(match.func, 'view_class', None)
+    return (view_class or match.func).__name__
+
+
+def server_timing(phases):
+    entries = []
+    for name, duration, description in phases:
+        entry = '{0};dur={1:.1f}'.format(name, duration * 1000)
+        if description:
+            entry += ';desc="{0}"'.format(description)
+        entries.append(entry)
+    return ', '.join(entries)
+
+
+class MetricsMiddleware(object):
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        _state.timings = timings
+        try:
+            with timing_queries(timings):
+                response = self.get_response(request)
+        finally:
+            _state.timings = None
+        total = time.time() - timings.start
+        response['Server-Timing'] = server_timing(timings.phases(total))
+        registry.record(
+            route_name(request), request.method, response.status_code, total, timings)
+        return response
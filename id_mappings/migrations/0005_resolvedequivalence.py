@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 14:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+POPULATE_SQL = '''
+    INSERT INTO id_mappings_resolvedequivalence
+        (identifier_a_id, identifier_b_id, deprecated, created, latest_claim_id)
+    SELECT DISTINCT ON (
+            LEAST(identifier_a_id, identifier_b_id),
+            GREATEST(identifier_a_id, identifier_b_id))
+        LEAST(identifier_a_id, identifier_b_id),
+        GREATEST(identifier_a_id, identifier_b_id),
+        deprecated, created, id
+    FROM id_mappings_equivalenceclaim
+    ORDER BY LEAST(identifier_a_id, identifier_b_id),
+        GREATEST(identifier_a_id, identifier_b_id),
+        created DESC, id DESC
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_mappings', '0004_equivalenceclaim_comment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResolvedEquivalence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('deprecated', models.BooleanField(default=False)),
+                ('created', models.DateTimeField()),
+                ('identifier_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='resolved_via_a', to='id_mappings.Identifier')),
+                ('identifier_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='resolved_via_b', to='id_mappings.Identifier')),
+                ('latest_claim', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='id_mappings.EquivalenceClaim')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='resolvedequivalence',
+            unique_together=set([('identifier_a', 'identifier_b')]),
+        ),
+        migrations.RunSQL(POPULATE_SQL, migrations.RunSQL.noop),
+    ]
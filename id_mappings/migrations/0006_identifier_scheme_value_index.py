@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 14:26
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_mappings', '0005_resolvedequivalence'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='identifier',
+            index_together=set([('scheme', 'value')]),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Each identifier that has the same scheme and value as an older one
+# is merged into the oldest: claims are moved onto it, the resolved
+# state of every pair involving it is recomputed from those claims,
+# and then the duplicate identifiers are deleted.
+MERGE_DUPLICATES_SQL = [
+    '''
+    CREATE TEMPORARY TABLE id_mappings_identifier_duplicate AS
+    SELECT id AS duplicate_id, survivor_id FROM (
+        SELECT id, MIN(id) OVER (PARTITION BY scheme_id, value) AS survivor_id
+        FROM id_mappings_identifier
+    ) AS identifiers
+    WHERE id <> survivor_id
+    ''',
+    '''
+    UPDATE id_mappings_equivalenceclaim AS claim
+    SET identifier_a_id = duplicate.survivor_id
+    FROM id_mappings_identifier_duplicate AS duplicate
+    WHERE claim.identifier_a_id = duplicate.duplicate_id
+    ''',
+    '''
+    UPDATE id_mappings_equivalenceclaim AS claim
+    SET identifier_b_id = duplicate.survivor_id
+    FROM id_mappings_identifier_duplicate AS duplicate
+    WHERE claim.identifier_b_id = duplicate.duplicate_id
+    ''',
+    '''
+    DELETE FROM id_mappings_resolvedequivalence AS resolved
+    USING id_mappings_identifier_duplicate AS duplicate
+    WHERE resolved.identifier_a_id IN (duplicate.duplicate_id, duplicate.survivor_id)
+    OR resolved.identifier_b_id IN (duplicate.duplicate_id, duplicate.survivor_id)
+    ''',
+    '''
+    INSERT INTO id_mappings_resolvedequivalence
+        (identifier_a_id, identifier_b_id, deprecated, created, latest_claim_id)
+    SELECT DISTINCT ON (
+            LEAST(identifier_a_id, identifier_b_id),
+            GREATEST(identifier_a_id, identifier_b_id))
+        LEAST(identifier_a_id, identifier_b_id),
+        GREATEST(identifier_a_id, identifier_b_id),
+        deprecated, created, id
+    FROM id_mappings_equivalenceclaim
+    WHERE identifier_a_id IN (
+        SELECT survivor_id FROM id_mappings_identifier_duplicate)
+    OR identifier_b_id IN (
+        SELECT survivor_id FROM id_mappings_identifier_duplicate)
+    ORDER BY LEAST(identifier_a_id, identifier_b_id),
+        GREATEST(identifier_a_id, identifier_b_id),
+        created DESC, id DESC
+    ''',
+    '''
+    DELETE FROM id_mappings_identifier AS identifier
+    USING id_mappings_identifier_duplicate AS duplicate
+    WHERE identifier.id = duplicate.duplicate_id
+    ''',
+    'DROP TABLE id_mappings_identifier_duplicate',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_mappings', '0006_identifier_scheme_value_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(MERGE_DUPLICATES_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 14:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_mappings', '0008_identifier_unique_scheme_value'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identifier',
+            name='component_id',
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+LIVE_EDGES_SQL = '''
+    SELECT identifier_a_id AS this_id, identifier_b_id AS other_id
+    FROM id_mappings_resolvedequivalence
+    WHERE NOT deprecated AND identifier_a_id <> identifier_b_id
+    UNION ALL
+    SELECT identifier_b_id, identifier_a_id
+    FROM id_mappings_resolvedequivalence
+    WHERE NOT deprecated AND identifier_a_id <> identifier_b_id
+'''
+
+
+def populate_components(apps, schema_editor):
+    # Label each linked identifier with its own ID, then propagate the
+    # lowest label across live links until nothing changes:
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('''
+            UPDATE id_mappings_identifier SET component_id = id
+            WHERE id IN (SELECT this_id FROM ({live_edges}) AS edge)
+        '''.format(live_edges=LIVE_EDGES_SQL))
+        while True:
+            cursor.execute('''
+                UPDATE id_mappings_identifier AS identifier
+                SET component_id = lowest.component_id
+                FROM (
+                    SELECT edge.this_id, MIN(neighbour.component_id) AS component_id
+                    FROM ({live_edges}) AS edge
+                    JOIN id_mappings_identifier AS neighbour
+                        ON neighbour.id = edge.other_id
+                    GROUP BY edge.this_id
+                ) AS lowest
+                WHERE identifier.id = lowest.this_id
+                AND lowest.component_id < identifier.component_id
+            '''.format(live_edges=LIVE_EDGES_SQL))
+            if cursor.rowcount == 0:
+                break
+        cursor.execute('''
+            SELECT setval('id_mappings_component_id_seq',
+                (SELECT COALESCE(MAX(id), 1) FROM id_mappings_identifier))
+        ''')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_mappings', '0009_identifier_component_id'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE SEQUENCE id_mappings_component_id_seq',
+            'DROP SEQUENCE id_mappings_component_id_seq',
+        ),
+        migrations.RunPython(populate_components, migrations.RunPython.noop),
+    ]
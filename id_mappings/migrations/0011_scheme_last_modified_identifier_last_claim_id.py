@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 14:34
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_mappings', '0010_populate_components'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identifier',
+            name='last_claim_id',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='scheme',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='identifier',
+            index_together=set([('scheme', 'last_claim_id')]),
+        ),
+    ]
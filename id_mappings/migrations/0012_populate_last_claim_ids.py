@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_mappings', '0011_scheme_last_modified_identifier_last_claim_id'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            '''
+            UPDATE id_mappings_identifier AS identifier
+            SET last_claim_id = latest.claim_id
+            FROM (
+                SELECT identifier_id, MAX(id) AS claim_id FROM (
+                    SELECT identifier_a_id AS identifier_id, id
+                    FROM id_mappings_equivalenceclaim
+                    UNION ALL
+                    SELECT identifier_b_id, id
+                    FROM id_mappings_equivalenceclaim
+                ) AS sides
+                GROUP BY identifier_id
+            ) AS latest
+            WHERE identifier.id = latest.identifier_id
+            ''',
+            migrations.RunSQL.noop,
+        ),
+    ]
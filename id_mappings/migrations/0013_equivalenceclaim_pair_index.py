@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_mappings', '0012_populate_last_claim_ids'),
+    ]
+
+    operations = [
+        # The key of latest_claims_sql's DISTINCT ON, and its order, so
+        # the latest claim about each pair is the first index entry for
+        # the pair:
+        migrations.RunSQL(
+            '''
+            CREATE INDEX id_mappings_equivalenceclaim_pair_latest
+            ON id_mappings_equivalenceclaim (
+                LEAST(identifier_a_id, identifier_b_id),
+                GREATEST(identifier_a_id, identifier_b_id),
+                created DESC, id DESC)
+            ''',
+            'DROP INDEX id_mappings_equivalenceclaim_pair_latest',
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 15:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_keys', '0001_initial'),
+        ('id_mappings', '0013_equivalenceclaim_pair_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotentRequest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('request_hash', models.CharField(max_length=64)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('status', models.IntegerField(blank=True, null=True)),
+                ('response', models.TextField(default='')),
+                ('api_key', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api_keys.APIKey')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='idempotentrequest',
+            unique_together=set([('api_key', 'key')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 15:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api_keys', '0001_initial'),
+        ('id_mappings', '0014_idempotentrequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedEquivalenceClaim',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created', models.DateTimeField()),
+                ('deprecated', models.BooleanField(default=False)),
+                ('comment', models.TextField(default='')),
+                ('archived', models.DateTimeField(default=django.utils.timezone.now)),
+                ('api_key', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='api_keys.APIKey')),
+                ('identifier_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_claims_via_a', to='id_mappings.Identifier')),
+                ('identifier_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_claims_via_b', to='id_mappings.Identifier')),
+            ],
+        ),
+    ]
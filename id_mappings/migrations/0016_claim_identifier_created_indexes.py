@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 15:19
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_mappings', '0015_archivedequivalenceclaim'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='archivedequivalenceclaim',
+            index_together=set([('identifier_b', 'created'), ('identifier_a', 'created')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='equivalenceclaim',
+            index_together=set([('identifier_b', 'created'), ('identifier_a', 'created')]),
+        ),
+    ]
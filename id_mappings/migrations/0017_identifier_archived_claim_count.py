@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('id_mappings', '0016_claim_identifier_created_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identifier',
+            name='archived_claim_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
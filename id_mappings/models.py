@@ -1,14 +1,65 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.db import models
+from datetime import timedelta
+from functools import reduce
+import operator
+
+from django.conf import settings
+from django.db import connection, connections, models, transaction
 from django.utils import timezone
 
 from api_keys.models import APIKey
 
 
+class SchemeManager(models.Manager):
+
+    def with_last_claim_ids(self):
+        '''Annotate each scheme with the highest last_claim_id in it
+
+        This changes whenever a claim about an identifier in the
+        scheme is recorded, and comes from the end of the identifier's
+        (scheme, last_claim_id) index. It's None for a scheme without
+        identifiers.'''
+        return self.annotate(last_claim_id=models.Subquery(
+            Identifier.objects.filter(
+                scheme=models.OuterRef('pk')
+            ).order_by('-last_claim_id').values('last_claim_id')[:1]))
+
+    def names_version(self):
+        '''Return a string that changes whenever a scheme is added, renamed or deleted
+
+        Scheme names appear in every response that mentions an
+        identifier, so this belongs in the ETag of any such response.
+        It's read from the database, so it sees changes saved by any
+        process. names_version_sql() reads the same string as part of
+        another query.'''
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(names_version_sql().sql)
+            return cursor.fetchone()[0]
+
+
+def names_version_sql():
+    '''An expression for Scheme.objects.names_version(), to annotate a query with'''
+    return models.expressions.RawSQL(
+        '''
+        SELECT COUNT(*) || '-' || COALESCE(MAX(last_modified)::text, '')
+        FROM {table}
+        '''.format(table=Scheme._meta.db_table), [])
+
+
 class Scheme(models.Model):
     name = models.CharField(max_length=512)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    objects = SchemeManager()
+
+    def save(self, *args, **kwargs):
+        super(Scheme, self).save(*args, **kwargs)
+        # Scheme names appear in every cached response that mentions
+        # an identifier from the scheme:
+        from .lookup_cache import invalidate_all
+        invalidate_all()
 
     def __repr__(self):
         return '{class_}(pk={pk}, name={name})'.format(
@@ -21,9 +72,100 @@ class Scheme(models.Model):
         return self.name
 
 
+class IdentifierManager(models.Manager):
+
+    def upsert_many(self, scheme_id_value_pairs):
+        '''Make sure identifiers exist for each (scheme ID, value) pair
+
+        This is done with a single multi-row INSERT ... ON CONFLICT
+        statement, returning a tuple of a dictionary mapping each
+        (scheme ID, value) pair to the ID of its identifier, and the
+        number of identifiers that had to be created.'''
+        pairs = set(scheme_id_value_pairs)
+        if not pairs:
+            return {}, 0
+        params = []
+        for scheme_id, value in pairs:
+            params += [scheme_id, value]
+        # The rows are inserted in a consistent order so that
+        # concurrent upserts can't deadlock:
+        sql = '''
+            WITH incoming (scheme_id, value) AS (VALUES {rows}),
+            inserted AS (
+                INSERT INTO {table}
+                    (scheme_id, value, last_claim_id, archived_claim_count)
+                SELECT scheme_id, value, 0, 0 FROM incoming
+                ORDER BY scheme_id, value
+                ON CONFLICT (scheme_id, value) DO NOTHING
+                RETURNING id, scheme_id, value
+            )
+            SELECT id, scheme_id, value, TRUE FROM inserted
+            UNION ALL
+            SELECT existing.id, existing.scheme_id, existing.value, FALSE
+            FROM {table} AS existing
+            JOIN incoming ON existing.scheme_id = incoming.scheme_id
+                AND existing.value = incoming.value
+        '''.format(
+            table=self.model._meta.db_table,
+            rows=', '.join(['(%s, %s)'] * len(pairs)))
+        pair_to_id = {}
+        created_count = 0
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for identifier_id, scheme_id, value, created in cursor.fetchall():
+                pair_to_id[(scheme_id, value)] = identifier_id
+                created_count += created
+            # An identifier that was created by a concurrent transaction
+            # after this statement started is neither inserted nor
+            # visible to it, but will be visible to a new statement:
+            missing = pairs - set(pair_to_id)
+            if missing:
+                pair_to_id.update(
+                    ((scheme_id, value), identifier_id)
+                    for identifier_id, scheme_id, value in self.filter(
+                        reduce(operator.or_, (
+                            models.Q(scheme_id=scheme_id, value=value)
+                            for scheme_id, value in missing))
+                    ).values_list('id', 'scheme_id', 'value'))
+        return pair_to_id, created_count
+
+    def upsert(self, scheme, value):
+        '''Like get_or_create, but safe against concurrent creation'''
+        pair_to_id, created_count = self.upsert_many([(scheme.id, value)])
+        identifier = self.model(
+            pk=pair_to_id[(scheme.id, value)], scheme=scheme, value=value)
+        return identifier, bool(created_count)
+
+
 class Identifier(models.Model):
     value = models.CharField(max_length=512)
     scheme = models.ForeignKey(Scheme)
+    # Shared by all identifiers that are transitively linked by live
+    # equivalences; see components.py
+    component_id = models.IntegerField(blank=True, null=True, db_index=True)
+    # Increases whenever a claim about this identifier is recorded, so
+    # it can be used to tell whether lookups of this identifier (or
+    # any identifier in its scheme) might have changed; see
+    # ResolvedEquivalenceManager.upsert
+    last_claim_id = models.IntegerField(default=0)
+    # Increases whenever claims about this identifier are moved to the
+    # archive, which changes the history in its lookups without
+    # changing last_claim_id; see archive_superseded
+    archived_claim_count = models.IntegerField(default=0)
+
+    objects = IdentifierManager()
+
+    class Meta:
+        unique_together = ('scheme', 'value')
+        index_together = [('scheme', 'last_claim_id')]
+
+    def component_identifiers(self):
+        '''Return this and every identifier transitively linked to it'''
+        if self.component_id is None:
+            return [self]
+        return list(Identifier.objects.filter(
+            component_id=self.component_id
+        ).select_related('scheme').order_by('scheme_id', 'value'))
 
     def as_json(self):
         return {
@@ -48,6 +190,19 @@ class EquivalenceClaim(models.Model):
     api_key = models.ForeignKey(APIKey, blank=True, null=True)
     comment = models.TextField(default='')
 
+    class Meta:
+        # For the claims about an identifier up to a point in time:
+        index_together = [('identifier_a', 'created'), ('identifier_b', 'created')]
+
+    def save(self, *args, **kwargs):
+        # Keep the resolved state of this pair of identifiers in step
+        # with the claim log, in the same transaction as the claim:
+        with transaction.atomic():
+            from .changes import reserve_transaction_id
+            reserve_transaction_id()
+            super(EquivalenceClaim, self).save(*args, **kwargs)
+            ResolvedEquivalence.objects.record_claims([self])
+
     def other_identifier(self, not_this_identifier):
         if self.identifier_b == not_this_identifier:
             return self.identifier_a
@@ -71,3 +226,370 @@ class EquivalenceClaim(models.Model):
             deprecated=(' DEPRECATED' if self.deprecated else ''),
             comment=(' comment="{0}"'.format(self.comment) if self.comment else '')
         )
+
+
+# The normalised key of the pair of identifiers a claim is about, with
+# the lower identifier ID first. The claims table has an index on this
+# key followed by created DESC, id DESC (see migration 0013), so the
+# latest claim about a pair can be found without sorting its history:
+PAIR_LOW_SQL = 'LEAST(identifier_a_id, identifier_b_id)'
+PAIR_HIGH_SQL = 'GREATEST(identifier_a_id, identifier_b_id)'
+
+
+def latest_claims_sql(where='', claims=None):
+    '''Return SQL for the most recent claim about each pair of identifiers
+
+    The rows have the columns identifier_a_id, identifier_b_id (the
+    pair normalised so the lower ID comes first), deprecated, created
+    and latest_claim_id, and are in order of the pair. If where is
+    given, only the claims matching that condition are considered;
+    it can use PAIR_LOW_SQL and PAIR_HIGH_SQL to pick pairs. claims
+    can be a subquery to read claims from instead of the claim log,
+    with at least the columns of claim_columns_sql.'''
+    return '''
+        SELECT DISTINCT ON ({low}, {high})
+            {low} AS identifier_a_id,
+            {high} AS identifier_b_id,
+            deprecated, created, id AS latest_claim_id
+        FROM {claims}
+        {where}
+        ORDER BY {low}, {high}, created DESC, id DESC
+    '''.format(
+        low=PAIR_LOW_SQL, high=PAIR_HIGH_SQL,
+        claims=claims or EquivalenceClaim._meta.db_table,
+        where='WHERE {0}'.format(where) if where else '')
+
+
+def claim_columns_sql(table):
+    return 'SELECT identifier_a_id, identifier_b_id, deprecated, created, id FROM {0}'.format(
+        table)
+
+
+def all_claims_sql():
+    '''Return a subquery of every claim, including those that have been archived
+
+    This is for resolving the state of pairs at a past time, which
+    claims that have since been superseded (and so might have been
+    archived) can decide. A condition on it is applied to each table.'''
+    return '({0} UNION ALL {1}) AS claim'.format(
+        claim_columns_sql(EquivalenceClaim._meta.db_table),
+        claim_columns_sql(ArchivedEquivalenceClaim._meta.db_table))
+
+
+class ResolvedEquivalenceManager(models.Manager):
+
+    def upsert(self, latest_sql, params, update_components=True):
+        '''Update the resolved state from the rows of latest_sql
+
+        That query should return at most one row per normalised pair,
+        in the same columns as latest_claims_sql() returns. A row is only
+        overwritten by a claim that is at least as recent as the
+        claim it was last resolved from, so claims can be recorded in
+        any order.
+
+        Each identifier in those rows has its last_claim_id raised to
+        at least the ID of the claim, whether or not the resolved
+        state changes, since its history has.
+
+        Pairs that are newly linked or unlinked by this are passed on
+        to update the identifiers' components, unless
+        update_components is False (e.g. because they're about to be
+        rebuilt from scratch). Returns the number of rows changed.'''
+        sql = '''
+            WITH latest AS ({latest_claims}),
+            touched AS (
+                UPDATE {identifier_table} AS identifier
+                SET last_claim_id = bumped.claim_id
+                FROM (
+                    SELECT identifier_id, MAX(claim_id) AS claim_id FROM (
+                        SELECT identifier_a_id AS identifier_id,
+                            latest_claim_id AS claim_id
+                        FROM latest
+                        UNION ALL
+                        SELECT identifier_b_id, latest_claim_id FROM latest
+                    ) AS sides
+                    GROUP BY identifier_id
+                ) AS bumped
+                WHERE identifier.id = bumped.identifier_id
+                AND identifier.last_claim_id < bumped.claim_id
+            ),
+            previous AS (
+                SELECT resolved.identifier_a_id, resolved.identifier_b_id,
+                    resolved.deprecated
+                FROM {table} AS resolved
+                JOIN latest ON latest.identifier_a_id = resolved.identifier_a_id
+                    AND latest.identifier_b_id = resolved.identifier_b_id
+            )
+            INSERT INTO {table} AS resolved
+                (identifier_a_id, identifier_b_id, deprecated, created,
+                 latest_claim_id)
+            SELECT * FROM latest
+            ON CONFLICT (identifier_a_id, identifier_b_id) DO UPDATE
+            SET deprecated = EXCLUDED.deprecated,
+                created = EXCLUDED.created,
+                latest_claim_id = EXCLUDED.latest_claim_id
+            WHERE (resolved.created, resolved.latest_claim_id)
+                <= (EXCLUDED.created, EXCLUDED.latest_claim_id)
+            RETURNING resolved.identifier_a_id, resolved.identifier_b_id,
+                resolved.deprecated, (
+                    SELECT previous.deprecated FROM previous
+                    WHERE previous.identifier_a_id = resolved.identifier_a_id
+                    AND previous.identifier_b_id = resolved.identifier_b_id)
+        '''.format(
+            table=self.model._meta.db_table,
+            identifier_table=Identifier._meta.db_table,
+            latest_claims=latest_sql)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            changed = cursor.fetchall()
+        if update_components:
+            from .components import update_components_for_changes
+            update_components_for_changes(changed)
+        return len(changed)
+
+    def record_claims(self, claims):
+        '''Update the resolved state of each pair mentioned in claims'''
+        if not claims:
+            return
+        rows = []
+        params = []
+        for claim in claims:
+            id_low, id_high = sorted(
+                [claim.identifier_a_id, claim.identifier_b_id])
+            rows.append('(%s, %s, %s, %s::timestamptz, %s)')
+            params += [
+                id_low, id_high, claim.deprecated, claim.created, claim.pk]
+        from .changes import claims_recorded
+        from .lookup_cache import invalidate_identifiers
+        invalidate_identifiers(
+            identifier_id
+            for claim in claims
+            for identifier_id in (claim.identifier_a_id, claim.identifier_b_id))
+        claims_recorded()
+        self.upsert(
+            '''
+            SELECT DISTINCT ON (identifier_a_id, identifier_b_id) *
+            FROM (VALUES {rows}) AS incoming
+                (identifier_a_id, identifier_b_id, deprecated, created,
+                 latest_claim_id)
+            ORDER BY identifier_a_id, identifier_b_id,
+                created DESC, latest_claim_id DESC
+            '''.format(rows=', '.join(rows)),
+            params)
+
+    def record_claims_after(self, claim_id, update_components=True):
+        '''Update the resolved state from every claim with a higher ID'''
+        from .changes import claims_recorded
+        from .lookup_cache import invalidate_all
+        invalidate_all()
+        claims_recorded()
+        self.upsert(
+            latest_claims_sql('id > %s'), [claim_id],
+            update_components=update_components)
+
+    def rebuild(self):
+        '''Replace every row with state recomputed from the claim log
+
+        This also recomputes every identifier's component. Returns the
+        number of rows in the rebuilt table.'''
+        from .lookup_cache import invalidate_all
+        with transaction.atomic():
+            invalidate_all()
+            self.all().delete()
+            count = self.upsert(
+                latest_claims_sql(), [],
+                update_components=False)
+            from .components import rebuild_components
+            rebuild_components()
+            return count
+
+    def discrepancies(self):
+        '''Return pairs whose stored state disagrees with the claim log
+
+        Each item is a tuple of (identifier_a_id, identifier_b_id,
+        expected_claim_id, stored_claim_id), where either claim ID is
+        None if the pair is missing from that side.'''
+        sql = '''
+            SELECT
+                COALESCE(latest.identifier_a_id, resolved.identifier_a_id),
+                COALESCE(latest.identifier_b_id, resolved.identifier_b_id),
+                latest.latest_claim_id,
+                resolved.latest_claim_id
+            FROM ({latest_claims}) AS latest
+            FULL OUTER JOIN {table} AS resolved
+                ON resolved.identifier_a_id = latest.identifier_a_id
+                AND resolved.identifier_b_id = latest.identifier_b_id
+            WHERE latest.latest_claim_id IS NULL
+                OR resolved.latest_claim_id IS NULL
+                OR latest.latest_claim_id <> resolved.latest_claim_id
+                OR latest.deprecated <> resolved.deprecated
+                OR latest.created <> resolved.created
+            ORDER BY 1, 2
+        '''.format(
+            table=self.model._meta.db_table,
+            latest_claims=latest_claims_sql())
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            return cursor.fetchall()
+
+
+class ResolvedEquivalence(models.Model):
+    '''The current state of the link between a pair of identifiers
+
+    There is one row for each pair of identifiers that has ever been
+    the subject of an EquivalenceClaim, with the deprecation status
+    and timestamp of the most recent claim about that pair.
+    identifier_a is always the identifier with the lower primary key,
+    whichever way round the claims were made.'''
+
+    identifier_a = models.ForeignKey(Identifier, related_name='resolved_via_a')
+    identifier_b = models.ForeignKey(Identifier, related_name='resolved_via_b')
+    deprecated = models.BooleanField(default=False)
+    created = models.DateTimeField()
+    latest_claim = models.ForeignKey(EquivalenceClaim, related_name='+')
+
+    objects = ResolvedEquivalenceManager()
+
+    class Meta:
+        unique_together = ('identifier_a', 'identifier_b')
+
+    def other_identifier(self, not_this_identifier):
+        if self.identifier_b == not_this_identifier:
+            return self.identifier_a
+        elif self.identifier_a == not_this_identifier:
+            return self.identifier_b
+        else:
+            raise Exception('Neither identifier in {re} was {i}'.format(
+                re=repr(self), i=not_this_identifier
+            ))
+
+    def __repr__(self):
+        return '{class_}<({a}) <-> ({b}){deprecated}>'.format(
+            class_=self.__class__.__name__,
+            a=self.identifier_a_id,
+            b=self.identifier_b_id,
+            deprecated=(' DEPRECATED' if self.deprecated else ''),
+        )
+
+
+class ArchivedEquivalenceClaimManager(models.Manager):
+
+    def archive_superseded(self, before, batch_size=10000):
+        '''Move claims made before a time that are no longer their pair's latest
+
+        Such a claim can't affect the resolved state of its pair (see
+        latest_claims_sql), so it only matters as history. The claims
+        are moved a batch at a time, each in its own transaction, in
+        order of ID; returns the number moved. Each claim's identifiers
+        have their archived_claim_count increased in the same
+        transaction, so that every process sees that their lookups
+        have changed.'''
+        sql = '''
+            WITH moved AS (
+                DELETE FROM {claim_table}
+                WHERE id IN (
+                    SELECT claim.id FROM {claim_table} AS claim
+                    WHERE claim.id > %s AND claim.created < %s
+                    AND NOT EXISTS (
+                        SELECT 1 FROM {resolved_table} AS resolved
+                        WHERE resolved.latest_claim_id = claim.id)
+                    ORDER BY claim.id
+                    LIMIT %s)
+                RETURNING id, identifier_a_id, identifier_b_id, created, deprecated,
+                    api_key_id, comment
+            ),
+            counted AS (
+                UPDATE {identifier_table} AS identifier
+                SET archived_claim_count = identifier.archived_claim_count + sides.claim_count
+                FROM (
+                    SELECT identifier_id, COUNT(*) AS claim_count FROM (
+                        SELECT identifier_a_id AS identifier_id FROM moved
+                        UNION ALL
+                        SELECT identifier_b_id FROM moved
+                    ) AS moved_sides
+                    GROUP BY identifier_id
+                ) AS sides
+                WHERE identifier.id = sides.identifier_id
+            )
+            INSERT INTO {table}
+                (id, identifier_a_id, identifier_b_id, created, deprecated,
+                 api_key_id, comment, archived)
+            SELECT moved.*, %s FROM moved
+            RETURNING id
+        '''.format(
+            table=self.model._meta.db_table,
+            identifier_table=Identifier._meta.db_table,
+            claim_table=EquivalenceClaim._meta.db_table,
+            resolved_table=ResolvedEquivalence._meta.db_table)
+        moved_count = 0
+        last_id = 0
+        while True:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(sql, [last_id, before, batch_size, timezone.now()])
+                moved = cursor.fetchall()
+                if not moved:
+                    return moved_count
+            moved_count += len(moved)
+            last_id = max(claim_id for claim_id, in moved)
+
+
+class ArchivedEquivalenceClaim(models.Model):
+    '''A superseded EquivalenceClaim, moved out of the claim log
+
+    These keep the ID they had as claims, and are only read for the
+    history of an identifier when it's asked for with include_archived;
+    see the compact_claims command.'''
+
+    id = models.IntegerField(primary_key=True)
+    identifier_a = models.ForeignKey(Identifier, related_name='archived_claims_via_a')
+    identifier_b = models.ForeignKey(Identifier, related_name='archived_claims_via_b')
+    created = models.DateTimeField()
+    deprecated = models.BooleanField(default=False)
+    api_key = models.ForeignKey(APIKey, blank=True, null=True)
+    comment = models.TextField(default='')
+    archived = models.DateTimeField(default=timezone.now)
+
+    objects = ArchivedEquivalenceClaimManager()
+
+    class Meta:
+        index_together = [('identifier_a', 'created'), ('identifier_b', 'created')]
+
+
+class IdempotentRequestManager(models.Manager):
+
+    def start(self, api_key, key, request_hash):
+        '''Return the record of a request with an Idempotency-Key, and whether it's new
+
+        This should be called in the transaction that makes the
+        request's changes and saves its response, so a concurrent
+        request with the same key waits for that transaction and then
+        finds the saved response. A record older than
+        IDEMPOTENCY_KEY_EXPIRY seconds is replaced.'''
+        self.expired().filter(api_key=api_key, key=key).delete()
+        return self.get_or_create(
+            api_key=api_key, key=key, defaults={'request_hash': request_hash})
+
+    def expired(self):
+        return self.filter(
+            created__lt=timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_EXPIRY))
+
+
+class IdempotentRequest(models.Model):
+    '''The response to a request made with an Idempotency-Key header
+
+    A retry of the request with the same key (and API key) gets the
+    same response back rather than making its changes again.
+    request_hash identifies the request's body, so a key can't be
+    reused for a different request.'''
+
+    api_key = models.ForeignKey(APIKey)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    created = models.DateTimeField(default=timezone.now)
+    status = models.IntegerField(blank=True, null=True)
+    response = models.TextField(default='')
+
+    objects = IdempotentRequestManager()
+
+    class Meta:
+        unique_together = ('api_key', 'key')
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from itertools import groupby
+from operator import itemgetter
+
+from django.db import connections, router
+from django.db.models import Q
+
+from .graph import mapping_graph
+from .models import (
+    ArchivedEquivalenceClaim, EquivalenceClaim, Identifier, ResolvedEquivalence, Scheme,
+    all_claims_sql, latest_claims_sql)
+
+
+# Each resolved pair with an identifier from the scheme on one side,
+# seen from that side; a pair with the scheme on both sides appears
+# once from each side.
+SCHEME_MAPPINGS_SQL = '''
+    SELECT this.value, other.value, other.scheme_id, other_scheme.name,
+        resolved.deprecated, resolved.id
+    FROM {resolved_table} AS resolved
+    JOIN {identifier_table} AS this ON this.id = resolved.identifier_{this}_id
+    JOIN {identifier_table} AS other ON other.id = resolved.identifier_{other}_id
+    JOIN {scheme_table} AS other_scheme ON other_scheme.id = other.scheme_id
+    WHERE this.scheme_id = %s
+'''
+
+# The values of identifiers from the scheme on one side of each pair:
+SCHEME_VALUES_SQL = '''
+    SELECT DISTINCT this.value
+    FROM {identifier_table} AS this
+    JOIN {resolved_table} AS resolved ON resolved.identifier_{this}_id = this.id
+    JOIN {identifier_table} AS other ON other.id = resolved.identifier_{other}_id
+    WHERE this.scheme_id = %s
+'''
+
+# The claims (in one table) about identifiers from the scheme on one
+# side, up to a point in time; each is read from the end of the claims'
+# (identifier, created) index:
+SCHEME_CLAIMS_AS_OF_SQL = '''
+    SELECT claim.identifier_a_id, claim.identifier_b_id, claim.deprecated,
+        claim.created, claim.id
+    FROM {identifier_table} AS this
+    JOIN {claim_table} AS claim ON claim.identifier_{this}_id = this.id
+    WHERE this.scheme_id = %s {filters}
+    AND claim.created <= %s
+'''
+
+# The values of identifiers from a scheme that had been the subject of
+# claims by a point in time (as the pairs in the resolved equivalence
+# table have), in order; the scan stops once there are enough:
+SCHEME_VALUES_AS_OF_SQL = '''
+    SELECT this.value
+    FROM {identifier_table} AS this
+    WHERE this.scheme_id = %s {filters}
+    AND EXISTS (
+        SELECT 1 FROM {claims}
+        JOIN {identifier_table} AS other ON other.id = CASE
+            WHEN claim.identifier_a_id = this.id THEN claim.identifier_b_id
+            ELSE claim.identifier_a_id END
+        WHERE (claim.identifier_a_id = this.id OR claim.identifier_b_id = this.id)
+        AND claim.created <= %s {target_filter})
+    ORDER BY 1 LIMIT %s
+'''
+
+
+def read_connection():
+    '''Return the connection that reads should use (see replicas.py)'''
+    return connections[router.db_for_read(ResolvedEquivalence)]
+
+
+def graph_for_scheme(scheme_id):
+    '''Return the mapping graph if it's up to date with a scheme, or None'''
+    graph = mapping_graph(ordered=True)
+    if graph is None:
+        return None
+    version = Scheme.objects.with_last_claim_ids().filter(
+        pk=scheme_id).values_list('last_claim_id', flat=True).first()
+    return graph if graph.covers(version) else None
+
+
+def scheme_pairs_sql(scheme_id, as_of=None, after=None, up_to=None, values=None):
+    '''Return SQL and parameters for the pairs to read a scheme's mappings from
+
+    This is the resolved equivalence table, unless as_of is given. In
+    that case it's a subquery with the same columns, with the state
+    of each pair involving an identifier from the scheme (restricted
+    to values as in scheme_filters_sql) resolved from the claims made
+    up to then, including those that have since been archived.'''
+    if as_of is None:
+        return ResolvedEquivalence._meta.db_table, []
+    filters, filter_params = scheme_filters_sql(after=after, up_to=up_to, values=values)
+    branches = []
+    params = []
+    for model in (EquivalenceClaim, ArchivedEquivalenceClaim):
+        for this in ('a', 'b'):
+            branches.append(SCHEME_CLAIMS_AS_OF_SQL.format(
+                identifier_table=Identifier._meta.db_table,
+                claim_table=model._meta.db_table,
+                this=this,
+                filters=filters))
+            params += [scheme_id] + filter_params + [as_of]
+    sql = '''(
+        SELECT identifier_a_id, identifier_b_id, deprecated, latest_claim_id AS id
+        FROM ({latest_claims}) AS latest
+    )'''.format(latest_claims=latest_claims_sql(
+        claims='({0}) AS claim'.format(' UNION ALL '.join(branches))))
+    return sql, params
+
+
+def scheme_filters_sql(after=None, up_to=None, target_scheme_id=None, values=None):
+    '''Return extra WHERE conditions and parameters for one side'''
+    conditions = []
+    params = []
+    if values is not None:
+        conditions.append('AND this.value = ANY(%s)')
+        params.append(list(values))
+    if after is not None:
+        conditions.append('AND this.value > %s')
+        params.append(after)
+    if up_to is not None:
+        conditions.append('AND this.value <= %s')
+        params.append(up_to)
+    if target_scheme_id is not None:
+        conditions.append('AND other.scheme_id = %s')
+        params.append(target_scheme_id)
+    return '\n'.join(conditions), params
+
+
+def scheme_page_values(scheme_id, limit, after=None, target_scheme_id=None, as_of=None):
+    '''Return the values of the next limit + 1 mapped identifiers
+
+    These are the distinct values, in order, of identifiers in the
+    scheme after the value after; an extra value is fetched so that
+    the caller can tell whether there are any more pages. Each side
+    is an index range scan on the identifier's scheme and value, cut
+    off by the LIMIT. With as_of, these are the identifiers that were
+    mapped at that time.'''
+    graph = graph_for_scheme(scheme_id) if as_of is None else None
+    if graph is not None:
+        return graph.scheme_page_values(
+            scheme_id, limit, after=after, target_scheme_id=target_scheme_id)
+    filters, filter_params = scheme_filters_sql(
+        after=after, target_scheme_id=target_scheme_id)
+    if as_of is not None:
+        return scheme_page_values_as_of(scheme_id, limit, after, target_scheme_id, as_of)
+    sql = '''
+        SELECT value FROM (
+            ({a_side} {filters} ORDER BY 1 LIMIT %s)
+            UNION
+            ({b_side} {filters} ORDER BY 1 LIMIT %s)
+        ) AS page
+        ORDER BY 1 LIMIT %s
+    '''.format(
+        a_side=scheme_values_side_sql('a', 'b'),
+        b_side=scheme_values_side_sql('b', 'a'),
+        filters=filters,
+    )
+    side_params = [scheme_id] + filter_params + [limit + 1]
+    with read_connection().cursor() as cursor:
+        cursor.execute(sql, side_params + side_params + [limit + 1])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def scheme_page_values_as_of(scheme_id, limit, after, target_scheme_id, as_of):
+    filters, filter_params = scheme_filters_sql(after=after)
+    target_filter, target_params = scheme_filters_sql(target_scheme_id=target_scheme_id)
+    sql = SCHEME_VALUES_AS_OF_SQL.format(
+        identifier_table=Identifier._meta.db_table,
+        claims=all_claims_sql(),
+        filters=filters,
+        target_filter=target_filter)
+    with read_connection().cursor() as cursor:
+        cursor.execute(
+            sql, [scheme_id] + filter_params + [as_of] + target_params + [limit + 1])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def scheme_mappings(scheme_id, chunked=False, after=None, up_to=None,
+                    target_scheme_id=None, values=None, as_of=None):
+    '''Yield the current mappings of each identifier in a scheme
+
+    This generates (value, mapped_identifiers) tuples in order of
+    identifier value, where mapped_identifiers is a list of the
+    identifiers (as JSON-ready dictionaries) that the identifier is
+    currently believed to be equivalent to. If chunked is True, the
+    rows are fetched through a server-side cursor, so memory use
+    doesn't depend on the size of the scheme.
+
+    The identifiers can be restricted to those with values greater
+    than after and no greater than up_to, or to those with particular
+    values, and the mappings to those into the scheme with ID
+    target_scheme_id. If as_of is given, the mappings are those there
+    were at that time.
+
+    The connection to use is chosen straight away, so that a response
+    streamed after the view has returned reads from the same database
+    as the rest of the request.'''
+    graph = graph_for_scheme(scheme_id) if as_of is None else None
+    if graph is not None:
+        return graph.scheme_mappings(
+            scheme_id, after=after, up_to=up_to, target_scheme_id=target_scheme_id,
+            values=values)
+    return _scheme_mappings(
+        read_connection(), scheme_id, chunked=chunked, after=after,
+        up_to=up_to, target_scheme_id=target_scheme_id, values=values, as_of=as_of)
+
+
+def _scheme_mappings(connection, scheme_id, chunked, after, up_to,
+                     target_scheme_id, values, as_of):
+    filters, filter_params = scheme_filters_sql(
+        after=after, up_to=up_to, target_scheme_id=target_scheme_id,
+        values=values)
+    pairs, pairs_params = scheme_pairs_sql(
+        scheme_id, as_of=as_of, after=after, up_to=up_to, values=values)
+    sql = '''
+        {a_side} {filters}
+        UNION ALL
+        {b_side} {filters}
+        ORDER BY 1, 6
+    '''.format(
+        a_side=scheme_mappings_side_sql('a', 'b', pairs),
+        b_side=scheme_mappings_side_sql('b', 'a', pairs),
+        filters=filters,
+    )
+    side_params = pairs_params + [scheme_id] + filter_params
+    cursor = connection.chunked_cursor() if chunked else connection.cursor()
+    try:
+        cursor.execute(sql, side_params + side_params)
+        for value, rows in groupby(cursor, key=itemgetter(0)):
+            yield value, [
+                {
+                    'value': other_value,
+                    'scheme_id': other_scheme_id,
+                    'scheme_name': other_scheme_name,
+                }
+                for _, other_value, other_scheme_id, other_scheme_name, deprecated, _
+                in rows if not deprecated
+            ]
+    finally:
+        cursor.close()
+
+
+def scheme_mappings_side_sql(this, other, pairs=None):
+    return SCHEME_MAPPINGS_SQL.format(
+        resolved_table=pairs or ResolvedEquivalence._meta.db_table,
+        identifier_table=Identifier._meta.db_table,
+        scheme_table=Scheme._meta.db_table,
+        this=this,
+        other=other,
+    )
+
+
+def scheme_values_side_sql(this, other):
+    return SCHEME_VALUES_SQL.format(
+        resolved_table=ResolvedEquivalence._meta.db_table,
+        identifier_table=Identifier._meta.db_table,
+        this=this,
+        other=other,
+    )
+
+
+def identifier_ids_for_pairs(scheme_id_value_pairs):
+    '''Return a dictionary mapping (scheme ID, value) pairs to identifier IDs
+
+    This is a single query, joining the identifiers to a VALUES list
+    of the pairs; pairs with no identifier are left out.'''
+    pairs = set(scheme_id_value_pairs)
+    if not pairs:
+        return {}
+    params = []
+    for scheme_id, value in pairs:
+        params += [scheme_id, value]
+    sql = '''
+        SELECT identifier.id, identifier.scheme_id, identifier.value
+        FROM {identifier_table} AS identifier
+        JOIN (VALUES {rows}) AS wanted (scheme_id, value)
+            ON identifier.scheme_id = wanted.scheme_id
+            AND identifier.value = wanted.value
+    '''.format(
+        identifier_table=Identifier._meta.db_table,
+        rows=', '.join(['(%s, %s)'] * len(pairs)))
+    with read_connection().cursor() as cursor:
+        cursor.execute(sql, params)
+        return {
+            (scheme_id, value): identifier_id
+            for identifier_id, scheme_id, value in cursor.fetchall()
+        }
+
+
+# Both identifiers of a claim or resolved pair, with their schemes' names:
+PAIR_FIELDS = (
+    'identifier_a_id', 'identifier_a__value', 'identifier_a__scheme_id',
+    'identifier_a__scheme__name',
+    'identifier_b_id', 'identifier_b__value', 'identifier_b__scheme_id',
+    'identifier_b__scheme__name',
+)
+
+
+def identifier_json(value, scheme_id, scheme_name):
+    '''Return what Identifier.as_json would for an identifier'''
+    return {'value': value, 'scheme_id': scheme_id, 'scheme_name': scheme_name}
+
+
+def sides(row):
+    '''Return each (this ID, other identifier's JSON) way of looking at a pair
+
+    row should start with the values of PAIR_FIELDS.'''
+    a_id, b_id = row[0], row[4]
+    if a_id == b_id:
+        return [(a_id, identifier_json(*row[5:8]))]
+    return [(a_id, identifier_json(*row[5:8])), (b_id, identifier_json(*row[1:4]))]
+
+
+def pairs_involving(model, identifier_ids):
+    return model.objects.filter(
+        Q(identifier_a__in=identifier_ids) | Q(identifier_b__in=identifier_ids))
+
+
+def lookup_results(identifier_ids):
+    '''Return a dictionary of the identifiers each identifier is mapped to
+
+    This is one query, however many identifiers there are, and rows
+    are read as tuples rather than as model instances.'''
+    results = {identifier_id: [] for identifier_id in identifier_ids}
+    if not results:
+        return results
+    for row in pairs_involving(ResolvedEquivalence, list(results)).filter(
+            deprecated=False).order_by('id').values_list(*PAIR_FIELDS):
+        for this_id, other in sides(row):
+            if this_id in results:
+                results[this_id].append(other)
+    return results
+
+
+def lookup_results_as_of(identifier_ids, as_of):
+    '''Return what lookup_results would have returned at a past time
+
+    The state of each pair involving the identifiers is resolved from
+    the claims made up to as_of, including those that have since been
+    archived, which are found through the claims' (identifier,
+    created) indexes. This is one query.'''
+    results = {identifier_id: [] for identifier_id in identifier_ids}
+    if not results:
+        return results
+    sql = '''
+        SELECT a.id, a.value, a.scheme_id, a_scheme.name,
+            b.id, b.value, b.scheme_id, b_scheme.name
+        FROM ({latest_claims}) AS latest
+        JOIN {identifier_table} AS a ON a.id = latest.identifier_a_id
+        JOIN {scheme_table} AS a_scheme ON a_scheme.id = a.scheme_id
+        JOIN {identifier_table} AS b ON b.id = latest.identifier_b_id
+        JOIN {scheme_table} AS b_scheme ON b_scheme.id = b.scheme_id
+        WHERE NOT latest.deprecated
+        ORDER BY latest.latest_claim_id
+    '''.format(
+        latest_claims=latest_claims_sql(
+            '''created <= %s
+            AND (identifier_a_id = ANY(%s) OR identifier_b_id = ANY(%s))''',
+            claims=all_claims_sql()),
+        identifier_table=Identifier._meta.db_table,
+        scheme_table=Scheme._meta.db_table)
+    ids = list(results)
+    with read_connection().cursor() as cursor:
+        cursor.execute(sql, [as_of, ids, ids])
+        for row in cursor.fetchall():
+            for this_id, other in sides(row):
+                if this_id in results:
+                    results[this_id].append(other)
+    return results
+
+
+def lookup_history(identifier_ids, include_archived=False, as_of=None):
+    '''Return a dictionary of the history of claims about each identifier
+
+    Like lookup_results, this is one query, or two if claims moved to
+    the archive by compact_claims are to be included. With as_of, only
+    claims made up to then are included.'''
+    history = {identifier_id: [] for identifier_id in identifier_ids}
+    if not history:
+        return history
+    fields = PAIR_FIELDS + ('created', 'id', 'deprecated', 'comment')
+    querysets = [pairs_involving(EquivalenceClaim, list(history))]
+    if include_archived:
+        querysets.append(pairs_involving(ArchivedEquivalenceClaim, list(history)))
+    if as_of is not None:
+        querysets = [queryset.filter(created__lte=as_of) for queryset in querysets]
+    rows = querysets[0].order_by('created', 'id').values_list(*fields)
+    if include_archived:
+        rows = sorted(
+            list(rows) + list(querysets[1].values_list(*fields)),
+            key=itemgetter(8, 9))
+    for row in rows:
+        created, _, deprecated, comment = row[8:]
+        for this_id, other in sides(row):
+            if this_id in history:
+                history[this_id].append({
+                    'identifier': other,
+                    'created': created.isoformat(),
+                    'deprecated': deprecated,
+                    'comment': comment,
+                })
+    return history
+
+
+def lookup_data(identifier_ids):
+    '''Return the results and history for each of a set of identifiers
+
+    This returns a dictionary mapping each identifier ID to data in
+    the form returned by IdentifierLookupView, using two queries
+    however many identifiers there are.'''
+    results = lookup_results(identifier_ids)
+    history = lookup_history(identifier_ids)
+    return {
+        identifier_id: {'results': results[identifier_id], 'history': history[identifier_id]}
+        for identifier_id in results
+    }
+
+
+def translate_values(from_scheme_id, to_scheme_id, values=None, chunked=False, as_of=None):
+    '''Generate (value, target_values) for identifiers mapped between schemes
+
+    target_values is a list of the values of the identifiers in the
+    scheme with ID to_scheme_id that the identifier with that value
+    in the scheme with ID from_scheme_id is currently mapped to. This
+    is a single query, restricted to the given values if there are
+    any; identifiers whose mappings into the target scheme have all
+    been deprecated are left out. With as_of, the mappings are those
+    there were at that time.'''
+    mappings = scheme_mappings(
+        from_scheme_id, chunked=chunked, target_scheme_id=to_scheme_id,
+        values=values, as_of=as_of)
+    return (
+        (value, [identifier['value'] for identifier in mapped_identifiers])
+        for value, mapped_identifiers in mappings
+        if mapped_identifiers
+    )
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+'''Serialization of API responses in the format the client asked for
+
+The format can be chosen with a format parameter in the query string
+or with the Accept header:
+
+json
+    Compact JSON; add pretty=1 to the query string to indent it.
+columnar
+    JSON in which each identifier is a [scheme_id, value] pair, and
+    the name of each scheme mentioned is given once in "schemes".
+csv, tsv
+    Rows of a crosswalk, for the views that return one.'''
+
+from __future__ import unicode_literals
+
+import csv
+import io
+import json
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import six
+
+from .metrics import serializing
+
+
+# When streaming, aim to produce output in pieces of about this many
+# characters:
+STREAM_BUFFER_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'columnar': 'application/vnd.id-mapping-store.columnar+json',
+    'csv': 'text/csv; charset=utf-8',
+    'tsv': 'text/tab-separated-values; charset=utf-8',
+}
+
+JSON_FORMATS = ('json', 'columnar')
+
+IDENTIFIER_KEYS = frozenset(['value', 'scheme_id', 'scheme_name'])
+
+
+class NotAcceptable(ValueError):
+    pass
+
+
+def parse_qualities(header):
+    '''Return (value, quality) for each item in an Accept-style header'''
+    qualities = []
+    for item in header.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for parameter in parts[1:]:
+            if parameter.startswith('q='):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    pass
+        if parts[0]:
+            qualities.append((parts[0].lower(), quality))
+    return qualities
+
+
+def parse_accept(accept_header):
+    '''Return the media types in an Accept header, most preferred first'''
+    media_types = [
+        (-quality, position, media_type)
+        for position, (media_type, quality) in enumerate(parse_qualities(accept_header))
+        if quality > 0
+    ]
+    return [media_type for _, _, media_type in sorted(media_types)]
+
+
+def accepts_encoding(request, coding):
+    '''Return whether the request's Accept-Encoding allows a content coding
+
+    A coding listed with q=0 is refused, even if "*" is acceptable.'''
+    qualities = dict(parse_qualities(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+    quality = qualities.get(coding, qualities.get('*', 0))
+    return quality > 0
+
+
+def negotiate_format(request, formats):
+    '''Return the first of formats that the request asks for
+
+    An explicit format in the query string has to be one of formats;
+    otherwise the Accept header is used, falling back to JSON.'''
+    requested = request.GET.get('format')
+    if requested:
+        if requested not in formats:
+            raise NotAcceptable('format must be one of: {0}'.format(', '.join(formats)))
+        return requested
+    for media_type in parse_accept(request.META.get('HTTP_ACCEPT', '')):
+        if media_type in ('*/*', 'application/*'):
+            break
+        for format_name in formats:
+            if CONTENT_TYPES[format_name].split(';')[0] == media_type:
+                return format_name
+    return 'json'
+
+
+def dumps(data, pretty=False):
+    if pretty:
+        return json.dumps(data, indent=4)
+    return json.dumps(data, separators=(',', ':'))
+
+
+def columnar(data, schemes=None):
+    '''Return a copy of data with identifiers as [scheme_id, value] pairs
+
+    Each scheme's name is added to schemes, keyed by its ID as a
+    string, if it's given.'''
+    if schemes is None:
+        schemes = {}
+    if isinstance(data, dict):
+        if frozenset(data) == IDENTIFIER_KEYS:
+            schemes['{0}'.format(data['scheme_id'])] = data['scheme_name']
+            return [data['scheme_id'], data['value']]
+        return type(data)(
+            (key, columnar(value, schemes)) for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        return [columnar(item, schemes) for item in data]
+    return data
+
+
+def render_json(data, response_format='json', pretty=False, status=200):
+    '''Return a response with data in one of the JSON formats'''
+    with serializing():
+        if response_format == 'columnar':
+            schemes = {}
+            data = columnar(data, schemes)
+            data['schemes'] = schemes
+        content = dumps(data, pretty=pretty)
+    return HttpResponse(
+        content,
+        content_type=CONTENT_TYPES[response_format],
+        status=status)
+
+
+def stream_json_results(items, extra=(), buffer_size=STREAM_BUFFER_SIZE,
+                        response_format='json'):
+    '''Generate a JSON object of results, a piece at a time
+
+    items should be an iterable of (key, value) pairs to go in the
+    "results" object, and extra any other (key, value) pairs to add
+    after it. In the columnar format, the schemes of the identifiers
+    in the results are added at the end.'''
+    schemes = {}
+    buffered = ['{"results":{']
+    buffered_size = 0
+    separator = ''
+    for key, value in items:
+        if response_format == 'columnar':
+            value = columnar(value, schemes)
+        item = '{separator}{key}:{value}'.format(
+            separator=separator,
+            key=json.dumps(key),
+            value=json.dumps(value, separators=(',', ':')),
+        )
+        buffered.append(item)
+        buffered_size += len(item)
+        separator = ','
+        if buffered_size >= buffer_size:
+            yield ''.join(buffered)
+            buffered = []
+            buffered_size = 0
+    buffered.append('}')
+    extra = list(extra)
+    if response_format == 'columnar':
+        extra.append(('schemes', schemes))
+    for key, value in extra:
+        buffered.append(',{0}:{1}'.format(json.dumps(key), dumps(value)))
+    buffered.append('}')
+    yield ''.join(buffered)
+
+
+def stream_rows(header, rows, response_format='csv', buffer_size=STREAM_BUFFER_SIZE):
+    '''Generate CSV or TSV text of a header and rows, a piece at a time'''
+    buf = io.StringIO() if six.PY3 else io.BytesIO()
+    writer = csv.writer(
+        buf, delimiter=(str('\t') if response_format == 'tsv' else str(',')),
+        lineterminator=str('\n'))
+    if header:
+        writer.writerow(header)
+    for row in rows:
+        if six.PY2:
+            row = [six.text_type(v).encode('utf-8') for v in row]
+        writer.writerow(row)
+        if buf.tell() >= buffer_size:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def render_rows(header, rows, response_format='csv', streaming=False):
+    '''Return a response with a crosswalk as CSV or TSV'''
+    pieces = stream_rows(header, rows, response_format)
+    if streaming:
+        return StreamingHttpResponse(
+            pieces, content_type=CONTENT_TYPES[response_format])
+    with serializing():
+        return HttpResponse(pieces, content_type=CONTENT_TYPES[response_format])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+'''Sending the queries of lookup requests to replicas of the database
+
+If REPLICA_DATABASES lists the aliases of replicas in DATABASES,
+views that use ReadFromReplicaMixin send their queries to one of
+them, chosen at random for each request; everything else, and every
+write, goes to the default (primary) database.
+
+Replicas lag a little behind the primary, so a client that has just
+made a claim might not see it in a lookup straight afterwards. To
+avoid that, the stickiness is carried by the client rather than kept
+on the server: the response to a claim gives the ID of the claim in
+an X-Last-Claim-Id header, and sets a signed cookie holding it that
+lasts for REPLICA_STICKINESS seconds. A request that sends either of
+them back reads from the replica chosen for it only if that replica
+already has the claim, and otherwise from the primary.'''
+
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import random
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+LAST_CLAIM_HEADER = 'X-Last-Claim-Id'
+
+LAST_CLAIM_COOKIE = 'last_claim_id'
+
+_state = threading.local()
+
+
+def replica_aliases():
+    return list(getattr(settings, 'REPLICA_DATABASES', []))
+
+
+def record_write(response, claim_id):
+    '''Let the client that made a claim read it back on its next requests'''
+    if claim_id is None:
+        return
+    response[LAST_CLAIM_HEADER] = '{0}'.format(claim_id)
+    timeout = getattr(settings, 'REPLICA_STICKINESS', 0)
+    if replica_aliases() and timeout:
+        response.set_signed_cookie(
+            LAST_CLAIM_COOKIE, '{0}'.format(claim_id), salt=LAST_CLAIM_COOKIE,
+            max_age=timeout, httponly=True)
+
+
+def last_claim_id(request):
+    '''Return the ID of the last claim the client made, if it gave one'''
+    claim_ids = [
+        request.META.get('HTTP_X_LAST_CLAIM_ID'),
+        request.get_signed_cookie(
+            LAST_CLAIM_COOKIE, default=None, salt=LAST_CLAIM_COOKIE,
+            max_age=getattr(settings, 'REPLICA_STICKINESS', 0)),
+    ]
+    claim_ids = [
+        int(claim_id) for claim_id in claim_ids
+        if claim_id and claim_id.isdigit()]
+    return max(claim_ids) if claim_ids else None
+
+
+def has_claim(alias, claim_id):
+    '''Return whether a database has a claim, whether or not it's been archived
+
+    Archived claims keep their IDs, so a client whose last claim has
+    been archived isn't kept reading from the primary.'''
+    from .models import ArchivedEquivalenceClaim, EquivalenceClaim
+    with connections[alias].cursor() as cursor:
+        cursor.execute(
+            '''
+            SELECT EXISTS (
+                SELECT 1 FROM {claim_table} WHERE id = %s
+                UNION ALL
+                SELECT 1 FROM {archived_table} WHERE id = %s)
+            '''.format(
+                claim_table=EquivalenceClaim._meta.db_table,
+                archived_table=ArchivedEquivalenceClaim._meta.db_table),
+            [claim_id, claim_id])
+        return cursor.fetchone()[0]
+
+
+def choose_database(request):
+    '''Return the alias of the database to read from for a request'''
+    aliases = replica_aliases()
+    if not aliases:
+        return DEFAULT_DB_ALIAS
+    alias = random.choice(aliases)
+    claim_id = last_claim_id(request)
+    if claim_id is not None and not has_claim(alias, claim_id):
+        return DEFAULT_DB_ALIAS
+    return alias
+
+
+@contextmanager
+def reading_from(alias):
+    '''Send reads in this thread to the database alias inside the block'''
+    previous = getattr(_state, 'alias', None)
+    _state.alias = alias
+    try:
+        yield
+    finally:
+        _state.alias = previous
+
+
+def reading_from_replica():
+    return getattr(_state, 'alias', None) in replica_aliases()
+
+
+class ReplicaRouter(object):
+    '''Route reads as chosen by reading_from, and writes to the primary'''
+
+    def db_for_read(self, model, **hints):
+        return getattr(_state, 'alias', None)
+
+    def db_for_write(self, model, **hints):
+        # Without this, saving an object that was read from a replica
+        # would try to write it back there:
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = [DEFAULT_DB_ALIAS] + replica_aliases()
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replica_aliases():
+            return False
+        return None
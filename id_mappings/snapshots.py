@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+'''Precomputed files of each scheme's current mappings
+
+A snapshot of a scheme is the same JSON as a full (unpaginated,
+unfiltered) dump of the scheme, written both as it is and gzipped to
+the SCHEME_SNAPSHOT_DIR directory. Its filenames include the
+scheme's version, which is the highest last_claim_id of any
+identifier in the scheme together with a hash of the ID and name of
+every scheme with identifiers (since the names of the schemes it
+maps to are in the file too), so a snapshot is current exactly when
+a file for the scheme's current version exists, and only the schemes
+with new claims need to be rebuilt unless a scheme in use is renamed
+or deleted.'''
+
+from __future__ import unicode_literals
+
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+
+from .models import Identifier, Scheme
+from .queries import scheme_mappings
+from .renderers import stream_json_results
+
+
+def snapshot_dir():
+    return getattr(settings, 'SCHEME_SNAPSHOT_DIR', None)
+
+
+def scheme_names_version():
+    '''Return a short hash of the ID and name of every scheme in use
+
+    A scheme without identifiers can't be in any snapshot, so adding
+    one doesn't change this.'''
+    names = list(
+        Scheme.objects.annotate(
+            in_use=Exists(Identifier.objects.filter(scheme=OuterRef('pk')))
+        ).filter(in_use=True).order_by('id').values_list('id', 'name'))
+    return hashlib.md5(json.dumps(names).encode('utf-8')).hexdigest()[:12]
+
+
+def scheme_version(scheme, names_version=None):
+    '''Return the version of a scheme annotated by with_last_claim_ids
+
+    names_version is scheme_names_version(), which is found if it
+    isn't given.'''
+    if names_version is None:
+        names_version = scheme_names_version()
+    return '{0}-{1}'.format(scheme.last_claim_id or 0, names_version)
+
+
+def snapshot_path(scheme_id, version, gzipped=False):
+    return os.path.join(
+        snapshot_dir(),
+        'scheme-{0}-{1}.json{2}'.format(scheme_id, version, '.gz' if gzipped else ''))
+
+
+def current_snapshot_path(scheme, gzipped=False, names_version=None):
+    '''Return the path of the scheme's current snapshot, or None
+
+    scheme should have been annotated by with_last_claim_ids.'''
+    if not snapshot_dir():
+        return None
+    path = snapshot_path(
+        scheme.id, scheme_version(scheme, names_version), gzipped=gzipped)
+    return path if os.path.exists(path) else None
+
+
+def build_snapshot(scheme, names_version=None):
+    '''Write the snapshot files for the scheme's current version
+
+    The version is read before the mappings, so if claims are made
+    while the snapshot is being written it might include them, but
+    will then be rebuilt next time rather than being out of date.
+    Older snapshots of the scheme are removed afterwards.'''
+    version = scheme_version(scheme, names_version)
+    path = snapshot_path(scheme.id, version)
+    gzipped_path = snapshot_path(scheme.id, version, gzipped=True)
+    temporary_path = path + '.tmp'
+    temporary_gzipped_path = gzipped_path + '.tmp'
+    try:
+        with io.open(temporary_path, 'wb') as f, \
+                gzip.open(temporary_gzipped_path, 'wb') as gzipped_f:
+            for piece in stream_json_results(scheme_mappings(scheme.id, chunked=True)):
+                data = piece.encode('utf-8')
+                f.write(data)
+                gzipped_f.write(data)
+        os.rename(temporary_gzipped_path, gzipped_path)
+        os.rename(temporary_path, path)
+    finally:
+        for leftover in (temporary_path, temporary_gzipped_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    remove_old_snapshots(scheme.id, version)
+
+
+def remove_old_snapshots(scheme_id, current_version):
+    filename_re = re.compile(r'^scheme-(\d+)-([0-9a-f-]+)\.json(\.gz)?$')
+    for path in glob.glob(os.path.join(snapshot_dir(), 'scheme-{0}-*'.format(scheme_id))):
+        m = filename_re.search(os.path.basename(path))
+        if m and int(m.group(1)) == scheme_id and m.group(2) != current_version:
+            os.remove(path)
+
+
+def build_snapshots(scheme_ids=None):
+    '''Build a snapshot of each scheme that doesn't have a current one
+
+    Returns a list of the schemes that were rebuilt.'''
+    if not os.path.isdir(snapshot_dir()):
+        os.makedirs(snapshot_dir())
+    schemes = Scheme.objects.with_last_claim_ids().order_by('id')
+    if scheme_ids is not None:
+        schemes = schemes.filter(pk__in=scheme_ids)
+    names_version = scheme_names_version()
+    rebuilt = []
+    for scheme in schemes:
+        if current_snapshot_path(scheme, names_version=names_version) and \
+                current_snapshot_path(scheme, gzipped=True, names_version=names_version):
+            continue
+        build_snapshot(scheme, names_version)
+        rebuilt.append(scheme)
+    return rebuilt
@@ -1,13 +1,45 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from datetime import timedelta
+import gzip
+import io
 import json
+import os
+import shutil
+import socket
 import re
+import tempfile
+import threading
+import time
 
-from django.test import Client, TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+from django.test import (
+    Client, LiveServerTestCase, RequestFactory, TestCase, TransactionTestCase,
+    override_settings)
+from django.utils import timezone
+from django.utils.six import StringIO
+from django.utils.six.moves import http_client
 
-from id_mappings.models import EquivalenceClaim, Identifier, Scheme
+from id_mappings import benchmarks, changes, metrics, queries, replicas
+from id_mappings import graph as graph_module
+from id_mappings.graph import (
+    GraphSnapshot, MappingGraph, mapping_graph, pinned_mapping_graph, unload_mapping_graph,
+    write_snapshot)
+from id_mappings.cache_backends import LRULocMemCache
+from id_mappings.components import rebuild_components
+from id_mappings.lookup_cache import (
+    ALL_GENERATION_KEY, identifier_generation_key, lookup_cache)
+from id_mappings.management.commands import import_claims
+from id_mappings.models import (
+    PAIR_HIGH_SQL, PAIR_LOW_SQL, ArchivedEquivalenceClaim, EquivalenceClaim, IdempotentRequest, Identifier,
+    ResolvedEquivalence, Scheme, latest_claims_sql)
 from api_keys.models import APIKey
+from id_mappings_client import APIError, IDMappingClient, NotFound, claim_data
 
 ISO_TIMESTAMP_RE = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d.\d{6}[+-]\d\d:\d\d)$')
 
@@ -15,6 +47,12 @@ class FixtureMixin(object):
 
     def setUp(self):
         super(FixtureMixin, self).setUp()
+        lookup_cache().clear()
+        # Replicas (which are separate connections) wouldn't see the
+        # fixture inside each test's transaction:
+        no_replicas = override_settings(REPLICA_DATABASES=[])
+        no_replicas.enable()
+        self.addCleanup(no_replicas.disable)
         self.area_scheme = Scheme.objects.create(name='uk-area_id')
         self.wd_district_scheme = Scheme.objects.create(name='wikidata-district-item')
         self.area_identifier = Identifier.objects.create(
@@ -439,3 +477,2263 @@ class TestListIdentifiersForScheme(FixtureMixin, TestCase):
                'scheme_name': 'uk-area_id',
                'value': 'gss:S14000003'}])
         ]
+
+    def test_streamed_results_match_full_results(self):
+        gss_id = Identifier.objects.create(
+            value='gss:S14000003', scheme=self.area_scheme)
+        wd_id = Identifier.objects.create(
+            value='Q408547', scheme=self.wd_district_scheme)
+        EquivalenceClaim.objects.create(identifier_a=wd_id, identifier_b=gss_id)
+        EquivalenceClaim.objects.create(
+            identifier_a=gss_id, identifier_b=self.wd_identifier, deprecated=True)
+        c = Client()
+        path = '/scheme/{0}'.format(self.area_scheme.pk)
+        full_response = c.get(path)
+        streamed_response = c.get(path, {'stream': '1'})
+        assert streamed_response.status_code == 200
+        assert streamed_response.streaming
+        streamed_content = b''.join(streamed_response.streaming_content)
+        parsed_response = json.loads(streamed_content.decode('utf-8'))
+        assert parsed_response == json.loads(full_response.content)
+        # The identifiers should be streamed in order of value:
+        assert streamed_content.index(b'gss:S14000003') < streamed_content.index(b'gss:S17000017')
+
+    def test_streamed_results_for_unused_scheme(self):
+        unused_scheme = Scheme.objects.create(name='unused')
+        c = Client()
+        response = c.get('/scheme/{0}'.format(unused_scheme.pk), {'stream': '1'})
+        assert json.loads(b''.join(response.streaming_content).decode('utf-8')) == {
+            'results': {}
+        }
+
+
+class TestPaginateIdentifiersForScheme(FixtureMixin, TestCase):
+
+    def setUp(self):
+        super(TestPaginateIdentifiersForScheme, self).setUp()
+        self.other_scheme = Scheme.objects.create(name='mapit-area')
+        for gss_value, wd_value, mapit_value in (
+                ('gss:S14000001', 'Q100', '1'),
+                ('gss:S14000002', 'Q200', '2'),
+                ('gss:S14000003', 'Q300', None)):
+            gss_id = Identifier.objects.create(
+                value=gss_value, scheme=self.area_scheme)
+            EquivalenceClaim.objects.create(
+                identifier_a=gss_id,
+                identifier_b=Identifier.objects.create(
+                    value=wd_value, scheme=self.wd_district_scheme))
+            if mapit_value:
+                EquivalenceClaim.objects.create(
+                    identifier_a=Identifier.objects.create(
+                        value=mapit_value, scheme=self.other_scheme),
+                    identifier_b=gss_id)
+
+    def get_page(self, **params):
+        c = Client()
+        response = c.get('/scheme/{0}'.format(self.area_scheme.pk), params)
+        assert response.status_code == 200
+        return json.loads(response.content)
+
+    def test_follow_pages(self):
+        pages = []
+        params = {'limit': 2}
+        while True:
+            page = self.get_page(**params)
+            pages.append(list(page['results'].keys()))
+            if page['next'] is None:
+                break
+            params['after'] = page['next']
+        assert pages == [
+            ['gss:S14000001', 'gss:S14000002'],
+            ['gss:S14000003', 'gss:S17000017'],
+        ]
+
+    def test_page_includes_all_mappings_of_identifiers(self):
+        page = self.get_page(limit=1, after='gss:S14000001')
+        assert page == {
+            'results': {
+                'gss:S14000002': [
+                    {
+                        'value': 'Q200',
+                        'scheme_id': self.wd_district_scheme.id,
+                        'scheme_name': 'wikidata-district-item',
+                    },
+                    {
+                        'value': '2',
+                        'scheme_id': self.other_scheme.id,
+                        'scheme_name': 'mapit-area',
+                    },
+                ]
+            },
+            'next': 'gss:S14000002',
+        }
+
+    def test_filter_by_target_scheme(self):
+        page = self.get_page(target_scheme=self.other_scheme.id)
+        assert page == {
+            'results': {
+                'gss:S14000001': [
+                    {
+                        'value': '1',
+                        'scheme_id': self.other_scheme.id,
+                        'scheme_name': 'mapit-area',
+                    },
+                ],
+                'gss:S14000002': [
+                    {
+                        'value': '2',
+                        'scheme_id': self.other_scheme.id,
+                        'scheme_name': 'mapit-area',
+                    },
+                ],
+            }
+        }
+
+    def test_streamed_page(self):
+        c = Client()
+        response = c.get(
+            '/scheme/{0}'.format(self.area_scheme.pk),
+            {'limit': 3, 'stream': 1})
+        parsed_response = json.loads(
+            b''.join(response.streaming_content).decode('utf-8'))
+        assert len(parsed_response['results']) == 3
+        assert parsed_response['next'] == 'gss:S14000003'
+
+    def test_invalid_limit(self):
+        c = Client()
+        response = c.get(
+            '/scheme/{0}'.format(self.area_scheme.pk), {'limit': 'lots'})
+        assert response.status_code == 400
+
+
+class TestIdentifierUpsert(FixtureMixin, TestCase):
+
+    def test_duplicate_identifier_rejected(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Identifier.objects.create(
+                value='gss:S17000017', scheme=self.area_scheme)
+
+    def test_upsert_existing_identifier(self):
+        identifier, created = Identifier.objects.upsert(
+            self.area_scheme, 'gss:S17000017')
+        assert not created
+        assert identifier.pk == self.area_identifier.pk
+
+    def test_upsert_new_identifier(self):
+        identifier, created = Identifier.objects.upsert(
+            self.area_scheme, 'gss:S14000003')
+        assert created
+        assert identifier == Identifier.objects.get(
+            value='gss:S14000003', scheme=self.area_scheme)
+
+    def test_upsert_many(self):
+        pair_to_id, created_count = Identifier.objects.upsert_many([
+            (self.area_scheme.id, 'gss:S17000017'),
+            (self.area_scheme.id, 'gss:S14000003'),
+            (self.area_scheme.id, 'gss:S14000003'),
+        ])
+        assert created_count == 1
+        assert pair_to_id[(self.area_scheme.id, 'gss:S17000017')] == self.area_identifier.pk
+        assert 2 == Identifier.objects.filter(scheme=self.area_scheme).count()
+
+
+class TestComponents(FixtureMixin, TestCase):
+
+    def setUp(self):
+        super(TestComponents, self).setUp()
+        self.mapit_scheme = Scheme.objects.create(name='mapit-area')
+        self.mapit_identifier = Identifier.objects.create(
+            value='2544', scheme=self.mapit_scheme)
+        # Make a chain of MapIt <-> GSS <-> Wikidata:
+        EquivalenceClaim.objects.create(
+            identifier_a=self.mapit_identifier,
+            identifier_b=self.area_identifier)
+
+    def component_values(self, identifier):
+        identifier.refresh_from_db()
+        return sorted(i.value for i in identifier.component_identifiers())
+
+    def partition(self):
+        components = {}
+        for identifier in Identifier.objects.all():
+            key = identifier.component_id or ('singleton', identifier.id)
+            components.setdefault(key, set()).add(identifier.value)
+        return sorted(sorted(c) for c in components.values())
+
+    def test_chain_is_one_component(self):
+        assert self.component_values(self.mapit_identifier) == [
+            '2544', 'Q1529479', 'gss:S17000017']
+        assert self.component_values(self.wd_identifier) == [
+            '2544', 'Q1529479', 'gss:S17000017']
+
+    def test_cluster_endpoint(self):
+        c = Client()
+        response = c.get('/cluster/mapit-area/2544')
+        assert response.status_code == 200
+        assert json.loads(response.content) == {
+            'results': [
+                {
+                    'value': 'gss:S17000017',
+                    'scheme_id': self.area_scheme.id,
+                    'scheme_name': 'uk-area_id',
+                },
+                {
+                    'value': 'Q1529479',
+                    'scheme_id': self.wd_district_scheme.id,
+                    'scheme_name': 'wikidata-district-item',
+                },
+                {
+                    'value': '2544',
+                    'scheme_id': self.mapit_scheme.id,
+                    'scheme_name': 'mapit-area',
+                },
+            ]
+        }
+
+    def test_transitive_lookup(self):
+        c = Client()
+        response = c.get('/identifier/mapit-area/2544', {'transitive': '1'})
+        assert response.status_code == 200
+        assert [i['value'] for i in json.loads(response.content)['results']] == [
+            'gss:S17000017', 'Q1529479']
+        response = c.get('/identifier/mapit-area/2544')
+        assert [i['value'] for i in json.loads(response.content)['results']] == [
+            'gss:S17000017']
+
+    def test_deprecating_bridge_splits_component(self):
+        EquivalenceClaim.objects.create(
+            identifier_a=self.area_identifier,
+            identifier_b=self.wd_identifier,
+            deprecated=True)
+        assert self.component_values(self.mapit_identifier) == [
+            '2544', 'gss:S17000017']
+        # The Wikidata identifier has no live links left:
+        assert self.component_values(self.wd_identifier) == ['Q1529479']
+        assert self.wd_identifier.component_id is None
+
+    def test_deprecating_link_in_cycle_keeps_component(self):
+        EquivalenceClaim.objects.create(
+            identifier_a=self.wd_identifier,
+            identifier_b=self.mapit_identifier)
+        EquivalenceClaim.objects.create(
+            identifier_a=self.area_identifier,
+            identifier_b=self.wd_identifier,
+            deprecated=True)
+        assert self.component_values(self.wd_identifier) == [
+            '2544', 'Q1529479', 'gss:S17000017']
+
+    def test_bulk_deprecations_split_components(self):
+        other = Identifier.objects.create(value='Q1', scheme=self.wd_district_scheme)
+        EquivalenceClaim.objects.create(
+            identifier_a=self.mapit_identifier, identifier_b=other)
+        # Deprecate both links from the GSS identifier at once, which
+        # leaves MapIt <-> Q1 and the GSS and Wikidata identifiers on
+        # their own:
+        claims = EquivalenceClaim.objects.bulk_create([
+            EquivalenceClaim(
+                identifier_a=self.area_identifier,
+                identifier_b=self.wd_identifier,
+                deprecated=True),
+            EquivalenceClaim(
+                identifier_a=self.mapit_identifier,
+                identifier_b=self.area_identifier,
+                deprecated=True),
+        ])
+        ResolvedEquivalence.objects.record_claims(claims)
+        expected = [['2544', 'Q1'], ['Q1529479'], ['gss:S17000017']]
+        assert self.partition() == expected
+        rebuild_components()
+        assert self.partition() == expected
+
+
+class TestResolvedEquivalences(FixtureMixin, TestCase):
+
+    def test_claim_creates_resolved_equivalence(self):
+        resolved = ResolvedEquivalence.objects.get()
+        assert resolved.identifier_a == self.area_identifier
+        assert resolved.identifier_b == self.wd_identifier
+        assert not resolved.deprecated
+
+    def test_later_claim_updates_resolved_equivalence(self):
+        # Make the claim the other way round to check that the pair
+        # is normalised:
+        EquivalenceClaim.objects.create(
+            identifier_a=self.wd_identifier,
+            identifier_b=self.area_identifier,
+            deprecated=True)
+        resolved = ResolvedEquivalence.objects.get()
+        assert resolved.deprecated
+
+    def test_earlier_claim_does_not_update_resolved_equivalence(self):
+        EquivalenceClaim.objects.create(
+            identifier_a=self.area_identifier,
+            identifier_b=self.wd_identifier,
+            created=timezone.now() - timedelta(days=1),
+            deprecated=True)
+        resolved = ResolvedEquivalence.objects.get()
+        assert not resolved.deprecated
+
+    def test_check_command_passes(self):
+        out = StringIO()
+        call_command('rebuild_resolved_equivalences', check=True, stdout=out)
+        assert 'match the claim log' in out.getvalue()
+
+    def test_check_command_fails_and_rebuild_repairs(self):
+        ResolvedEquivalence.objects.update(deprecated=True)
+        with self.assertRaises(CommandError):
+            call_command(
+                'rebuild_resolved_equivalences', check=True, stdout=StringIO())
+        call_command('rebuild_resolved_equivalences', stdout=StringIO())
+        assert not ResolvedEquivalence.objects.get().deprecated
+
+
+class TestBulkCreateEquivalences(FixtureMixin, TestCase):
+
+    def post_lines(self, lines, **kwargs):
+        c = Client()
+        return c.post(
+            '/equivalence-claims/bulk',
+            '\n'.join(
+                line if isinstance(line, str) else json.dumps(line)
+                for line in lines),
+            content_type='application/x-ndjson',
+            **kwargs)
+
+    def claim_data(self, value_a, value_b, **kwargs):
+        data = {
+            'identifier_a': {
+                'scheme_id': self.area_scheme.id,
+                'value': value_a,
+            },
+            'identifier_b': {
+                'scheme_id': self.wd_district_scheme.id,
+                'value': value_b,
+            },
+        }
+        data.update(kwargs)
+        return data
+
+    def test_bulk_create_with_no_api_token_fails(self):
+        response = self.post_lines(
+            [self.claim_data('gss:S14000003', 'Q408547')])
+        assert response.status_code == 403
+
+    def test_bulk_create_claims(self):
+        response = self.post_lines(
+            [
+                self.claim_data('gss:S14000003', 'Q408547'),
+                self.claim_data('gss:S17000017', 'Q1529479', deprecated=True),
+                self.claim_data('gss:S14000004', 'Q408547', comment='Shared'),
+            ],
+            HTTP_X_API_KEY=self.api_key.key)
+        assert response.status_code == 201
+        assert json.loads(response.content) == {
+            'claims_created': 3,
+            'claims_skipped': 0,
+            'identifiers_created': 3,
+            'errors': [],
+        }
+        assert 4 == EquivalenceClaim.objects.count()
+        assert 'Shared' == EquivalenceClaim.objects.get(
+            identifier_a__value='gss:S14000004').comment
+        # The resolved state should reflect the new claims:
+        assert ResolvedEquivalence.objects.get(
+            identifier_a=self.area_identifier).deprecated
+        wd_identifier = Identifier.objects.get(value='Q408547')
+        assert 2 == ResolvedEquivalence.objects.filter(
+            Q(identifier_a=wd_identifier) | Q(identifier_b=wd_identifier),
+            deprecated=False).count()
+
+    def test_bulk_create_reports_errors_by_line(self):
+        response = self.post_lines(
+            [
+                self.claim_data('gss:S14000003', 'Q408547'),
+                '{not json',
+                '',
+                {
+                    'identifier_a': {'scheme_id': 999999, 'value': 'x'},
+                    'identifier_b': {'scheme_id': self.area_scheme.id, 'value': 'y'},
+                },
+                {'identifier_a': {'scheme_id': self.area_scheme.id}},
+            ],
+            HTTP_X_API_KEY=self.api_key.key)
+        assert response.status_code == 201
+        parsed_response = json.loads(response.content)
+        assert parsed_response['claims_created'] == 1
+        assert [e['line'] for e in parsed_response['errors']] == [2, 4, 5]
+        assert parsed_response['errors'][1]['error'] == 'Unknown scheme ID: 999999'
+
+
+class TestImportClaims(FixtureMixin, TestCase):
+
+    def write_input(self, suffix, contents):
+        f = tempfile.NamedTemporaryFile(mode='w', suffix=suffix, delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write(contents)
+        return f.name
+
+    def test_import_csv(self):
+        filename = self.write_input('.csv', '\n'.join([
+            'scheme_a,value_a,scheme_b,value_b,deprecated,comment,created',
+            'uk-area_id,gss:S14000003,{0},Q408547,,Imported,2017-06-08T10:00:00+00:00'.format(
+                self.wd_district_scheme.id),
+            'uk-area_id,gss:S17000017,wikidata-district-item,Q1529479,true,,2030-01-01T00:00:00Z',
+        ]))
+        call_command('import_claims', filename, stdout=StringIO())
+        assert 2 == Identifier.objects.filter(scheme=self.area_scheme).count()
+        imported = EquivalenceClaim.objects.get(comment='Imported')
+        assert imported.identifier_a.value == 'gss:S14000003'
+        assert imported.identifier_b.value == 'Q408547'
+        assert imported.created.isoformat() == '2017-06-08T10:00:00+00:00'
+        # The resolved state should include the imported claims:
+        assert ResolvedEquivalence.objects.get(
+            identifier_a=self.area_identifier).deprecated
+        assert not ResolvedEquivalence.objects.get(
+            latest_claim=imported).deprecated
+
+    def test_import_jsonl(self):
+        filename = self.write_input('.jsonl', json.dumps({
+            'scheme_a': self.area_scheme.id,
+            'value_a': 'gss:S14000003',
+            'scheme_b': self.wd_district_scheme.id,
+            'value_b': 'Q408547',
+            'deprecated': False,
+        }) + '\n')
+        call_command('import_claims', filename, stdout=StringIO())
+        assert 2 == EquivalenceClaim.objects.count()
+        assert 2 == ResolvedEquivalence.objects.filter(deprecated=False).count()
+
+    def test_import_unknown_scheme_fails(self):
+        filename = self.write_input('.csv', '\n'.join([
+            'scheme_a,value_a,scheme_b,value_b',
+            'made-up,1,uk-area_id,gss:S14000003',
+        ]))
+        with self.assertRaises(CommandError):
+            call_command('import_claims', filename, stdout=StringIO())
+        assert 1 == EquivalenceClaim.objects.count()
+
+
+class TestBatchLookup(FixtureMixin, TestCase):
+
+    def post_identifiers(self, identifiers):
+        return Client().post(
+            '/identifiers/lookup',
+            json.dumps({'identifiers': identifiers}),
+            content_type='application/json')
+
+    def test_results_match_single_lookups(self):
+        other_identifier = Identifier.objects.create(
+            scheme=self.wd_district_scheme, value='Q408547')
+        EquivalenceClaim.objects.create(
+            identifier_a=other_identifier,
+            identifier_b=self.area_identifier,
+            comment='Second')
+        identifiers = [
+            {'scheme': 'uk-area_id', 'value': 'gss:S17000017'},
+            {'scheme': self.wd_district_scheme.id, 'value': 'Q1529479'},
+            {'scheme_id': self.wd_district_scheme.id, 'value': 'Q408547'},
+        ]
+        response = self.post_identifiers(identifiers)
+        assert response.status_code == 200
+        results = json.loads(response.content)['results']
+        assert len(results) == 3
+        for result, path in zip(results, [
+                '/identifier/uk-area_id/gss:S17000017',
+                '/identifier/wikidata-district-item/Q1529479',
+                '/identifier/wikidata-district-item/Q408547']):
+            assert result == json.loads(Client().get(path).content)
+
+    def test_unknown_identifiers_and_schemes_are_null(self):
+        response = self.post_identifiers([
+            {'scheme': 'uk-area_id', 'value': 'gss:MADEUP'},
+            {'scheme': 'made-up', 'value': 'gss:S17000017'},
+            {'scheme': 'uk-area_id', 'value': 'gss:S17000017'},
+        ])
+        assert response.status_code == 200
+        results = json.loads(response.content)['results']
+        assert results[:2] == [None, None]
+        assert len(results[2]['results']) == 1
+
+    def test_query_count_is_constant(self):
+        identifiers = [{'scheme': 'uk-area_id', 'value': 'gss:S17000017'}]
+        for i in range(20):
+            identifier = Identifier.objects.create(
+                scheme=self.area_scheme, value='gss:{0}'.format(i))
+            EquivalenceClaim.objects.create(
+                identifier_a=identifier, identifier_b=self.wd_identifier)
+            identifiers.append({'scheme': self.area_scheme.id, 'value': identifier.value})
+        with self.assertNumQueries(4):
+            response = self.post_identifiers(identifiers)
+        results = json.loads(response.content)['results']
+        assert all(len(result['results']) == 1 for result in results)
+
+    def test_invalid_requests(self):
+        response = self.post_identifiers([{'scheme': 'uk-area_id'}])
+        assert response.status_code == 400
+        assert 'scheme and a value' in json.loads(response.content)['error']
+        response = Client().post(
+            '/identifiers/lookup', 'not JSON', content_type='application/json')
+        assert response.status_code == 400
+
+
+class TestTranslate(FixtureMixin, TestCase):
+
+    def setUp(self):
+        super(TestTranslate, self).setUp()
+        self.other_scheme = Scheme.objects.create(name='other')
+        for value_a, value_b, scheme_b in (
+                ('gss:S17000017', 'Q9', self.wd_district_scheme),
+                ('gss:S17000017', 'x', self.other_scheme),
+                ('gss:S14000003', 'Q408547', self.wd_district_scheme)):
+            EquivalenceClaim.objects.create(
+                identifier_a=Identifier.objects.upsert(self.area_scheme, value_a)[0],
+                identifier_b=Identifier.objects.upsert(scheme_b, value_b)[0])
+        EquivalenceClaim.objects.create(
+            identifier_a=Identifier.objects.get(value='Q9'),
+            identifier_b=self.area_identifier,
+            deprecated=True)
+
+    def test_translate_values_from_query_string(self):
+        response = Client().get(
+            '/translate/uk-area_id/{0}'.format(self.wd_district_scheme.id),
+            {'value': ['gss:S17000017', 'gss:S14000003', 'gss:MADEUP']})
+        assert response.status_code == 200
+        assert json.loads(response.content) == {
+            'results': {
+                'gss:S14000003': ['Q408547'],
+                'gss:S17000017': ['Q1529479'],
+            }
+        }
+
+    def test_translate_posted_values_in_reverse(self):
+        with self.assertNumQueries(2):
+            response = Client().post(
+                '/translate/wikidata-district-item/uk-area_id',
+                json.dumps({'values': ['Q408547', 'Q9']}),
+                content_type='application/json')
+        assert json.loads(response.content) == {
+            'results': {'Q408547': ['gss:S14000003']},
+        }
+
+    def test_stream_whole_crosswalk(self):
+        response = Client().get('/translate/uk-area_id/other')
+        assert response.streaming
+        assert json.loads(b''.join(response.streaming_content)) == {
+            'results': {'gss:S17000017': ['x']},
+        }
+
+    def test_invalid_requests(self):
+        response = Client().post(
+            '/translate/uk-area_id/other',
+            json.dumps({'values': [1]}),
+            content_type='application/json')
+        assert response.status_code == 400
+        response = Client().get('/translate/uk-area_id/made-up', {'value': 'x'})
+        assert response.status_code == 404
+
+
+class TestConditionalGet(FixtureMixin, TestCase):
+
+    def assert_revalidates(self, path):
+        c = Client()
+        response = c.get(path)
+        assert response.status_code == 200
+        etag = response['ETag']
+        response = c.get(path, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert response['ETag'] == etag
+        assert response.content == b''
+        return etag
+
+    def add_claim(self):
+        EquivalenceClaim.objects.create(
+            identifier_a=self.area_identifier,
+            identifier_b=self.wd_identifier,
+            deprecated=True)
+
+    def test_identifier_lookup(self):
+        path = '/identifier/uk-area_id/gss:S17000017'
+        etag = self.assert_revalidates(path)
+        self.add_claim()
+        response = Client().get(path, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response['ETag'] != etag
+
+    def test_scheme_revalidation_uses_one_query(self):
+        path = '/scheme/{0}'.format(self.area_scheme.id)
+        etag = self.assert_revalidates(path)
+        lookup_cache().clear()
+        with self.assertNumQueries(1):
+            Client().get(path, HTTP_IF_NONE_MATCH=etag)
+
+    def test_scheme_mappings_change_with_claims_about_either_scheme(self):
+        paths = [
+            '/scheme/{0}'.format(self.area_scheme.id),
+            '/scheme/{0}'.format(self.wd_district_scheme.id),
+        ]
+        etags = [self.assert_revalidates(path) for path in paths]
+        self.add_claim()
+        for path, etag in zip(paths, etags):
+            response = Client().get(path, HTTP_IF_NONE_MATCH=etag)
+            assert response.status_code == 200
+
+    def test_scheme_list(self):
+        etag = self.assert_revalidates('/scheme')
+        response = Client().get('/scheme')
+        assert response.has_header('Last-Modified')
+        Scheme.objects.create(name='new-scheme')
+        response = Client().get('/scheme', HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert len(json.loads(response.content)['results']) == 3
+
+    def test_renaming_a_scheme_changes_etags(self):
+        # The mapped identifiers in these responses include the name of
+        # their scheme:
+        paths = [
+            '/identifier/uk-area_id/gss:S17000017',
+            '/identifier/uk-area_id/gss:S17000017?transitive=1',
+            '/scheme/{0}'.format(self.area_scheme.id),
+        ]
+        etags = [self.assert_revalidates(path) for path in paths]
+        self.wd_district_scheme.name = 'renamed'
+        self.wd_district_scheme.save()
+        for path, etag in zip(paths, etags):
+            response = Client().get(path, HTTP_IF_NONE_MATCH=etag)
+            assert response.status_code == 200, path
+            assert '"renamed"' in response.content.decode('utf-8'), path
+
+    def test_migrated_identifiers_have_last_claim_ids(self):
+        claim = EquivalenceClaim.objects.get()
+        for identifier in (self.area_identifier, self.wd_identifier):
+            identifier.refresh_from_db()
+            assert identifier.last_claim_id == claim.id
+
+
+class TestLookupCache(FixtureMixin, TestCase):
+
+    def test_repeated_lookup_is_served_from_cache(self):
+        path = '/identifier/uk-area_id/gss:S17000017'
+        first = Client().get(path)
+        # Only the identifier's last_claim_id is checked:
+        with self.assertNumQueries(1):
+            second = Client().get(path)
+        assert second.content == first.content
+        assert second['ETag'] == first['ETag']
+        stats = json.loads(Client().get('/cache-stats').content)
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+
+    def test_new_claim_invalidates_both_identifiers_and_schemes(self):
+        paths = [
+            '/identifier/uk-area_id/gss:S17000017',
+            '/identifier/{0}/Q1529479'.format(self.wd_district_scheme.id),
+            '/scheme/{0}'.format(self.area_scheme.id),
+            '/scheme/{0}'.format(self.wd_district_scheme.id),
+        ]
+        before = [Client().get(path).content for path in paths]
+        Client().post(
+            '/equivalence-claim',
+            json.dumps({
+                'identifier_a': {
+                    'scheme_id': self.area_scheme.id, 'value': 'gss:S17000017'},
+                'identifier_b': {
+                    'scheme_id': self.wd_district_scheme.id, 'value': 'Q1529479'},
+                'deprecated': True,
+            }),
+            content_type='application/json',
+            HTTP_X_API_KEY=self.api_key.key)
+        for path, content in zip(paths, before):
+            assert Client().get(path).content != content, path
+
+    def test_unrelated_claim_keeps_cached_lookup(self):
+        path = '/identifier/uk-area_id/gss:S17000017'
+        other_scheme = Scheme.objects.create(name='other')
+        x = Identifier.objects.create(scheme=other_scheme, value='x')
+        y = Identifier.objects.create(scheme=other_scheme, value='y')
+        Client().get(path)
+        EquivalenceClaim.objects.create(identifier_a=x, identifier_b=y)
+        with self.assertNumQueries(1):
+            Client().get(path)
+        stats = json.loads(Client().get('/cache-stats').content)
+        assert stats['hits'] == 1
+
+    def test_claim_from_another_process_is_seen(self):
+        path = '/identifier/uk-area_id/gss:S17000017'
+        before = Client().get(path).content
+        # Another process's claim wouldn't bump the generations in this
+        # process's cache, so put them back as they were:
+        cache = lookup_cache()
+        generation_keys = [
+            ALL_GENERATION_KEY,
+            identifier_generation_key('uk-area_id', 'gss:S17000017'),
+        ]
+        generations = cache.get_many(generation_keys)
+        EquivalenceClaim.objects.create(
+            identifier_a=self.area_identifier,
+            identifier_b=self.wd_identifier,
+            deprecated=True)
+        cache.set_many(generations, None)
+        assert Client().get(path).content != before
+
+    def test_scheme_renamed_by_another_process_is_seen(self):
+        paths = [
+            '/identifier/uk-area_id/gss:S17000017',
+            '/scheme/{0}'.format(self.area_scheme.id),
+        ]
+        for path in paths:
+            Client().get(path)
+        # As Scheme.save() would in another process, without bumping
+        # the generations in this one's cache:
+        Scheme.objects.filter(pk=self.wd_district_scheme.id).update(
+            name='renamed', last_modified=timezone.now())
+        for path in paths:
+            assert '"renamed"' in Client().get(path).content.decode('utf-8'), path
+
+    def test_lru_eviction(self):
+        cache = LRULocMemCache('test-lru', {'OPTIONS': {'MAX_ENTRIES': 2}})
+        cache.clear()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+
+
+class TestSchemeSnapshots(FixtureMixin, TestCase):
+
+    def setUp(self):
+        super(TestSchemeSnapshots, self).setUp()
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.snapshot_dir)
+        settings_override = override_settings(SCHEME_SNAPSHOT_DIR=self.snapshot_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.path = '/scheme/{0}'.format(self.area_scheme.id)
+
+    def build(self):
+        out = StringIO()
+        call_command('build_scheme_snapshots', stdout=out)
+        return out.getvalue()
+
+    def test_snapshot_served_while_current(self):
+        expected = json.loads(Client().get(self.path).content)
+        assert 'Built a snapshot of scheme {0}'.format(self.area_scheme.id) in self.build()
+        response = Client().get(self.path)
+        assert response.streaming
+        assert json.loads(b''.join(response.streaming_content)) == expected
+        response = Client().get(self.path, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        assert response['Content-Encoding'] == 'gzip'
+        assert json.loads(gzip.GzipFile(
+            fileobj=io.BytesIO(b''.join(response.streaming_content))).read()) == expected
+        # Requests for part of the scheme aren't served from the snapshot:
+        assert not Client().get(self.path + '?limit=10').streaming
+
+    def test_only_changed_schemes_rebuilt(self):
+        self.build()
+        other_scheme = Scheme.objects.create(name='other')
+        assert self.build() == 'Built a snapshot of scheme {0} (other)\n'.format(
+            other_scheme.id)
+        EquivalenceClaim.objects.create(
+            identifier_a=self.area_identifier,
+            identifier_b=self.wd_identifier,
+            deprecated=True)
+        # The old snapshot is out of date, so it's not used:
+        response = Client().get(self.path)
+        assert not response.streaming
+        assert json.loads(response.content)['results'] == {'gss:S17000017': []}
+        output = self.build()
+        assert 'scheme {0} '.format(self.area_scheme.id) in output
+        assert 'scheme {0} '.format(self.wd_district_scheme.id) in output
+        assert 'scheme {0} '.format(other_scheme.id) not in output
+        # And it's been replaced by the new one:
+        assert len([
+            f for f in os.listdir(self.snapshot_dir)
+            if f.startswith('scheme-{0}-'.format(self.area_scheme.id))]) == 2
+
+    @override_settings(SCHEME_SNAPSHOT_SENDFILE=True)
+    def test_snapshot_sent_by_web_server(self):
+        self.build()
+        response = Client().get(self.path)
+        assert response.content == b''
+        assert os.path.exists(response['X-Sendfile'])
+
+
+class TestResponseFormats(FixtureMixin, TestCase):
+
+    def setUp(self):
+        super(TestResponseFormats, self).setUp()
+        self.scheme_path = '/scheme/{0}'.format(self.area_scheme.id)
+
+    def test_json_is_compact_unless_pretty_requested(self):
+        path = '/identifier/uk-area_id/gss:S17000017'
+        compact = Client().get(path)
+        assert compact['Content-Type'] == 'application/json'
+        assert b'\n' not in compact.content
+        pretty = Client().get(path, {'pretty': '1'})
+        assert b'\n    "results": [' in pretty.content
+        assert json.loads(pretty.content) == json.loads(compact.content)
+        assert pretty['ETag'] != compact['ETag']
+
+    def test_columnar_lookup(self):
+        response = Client().get(
+            '/identifier/uk-area_id/gss:S17000017',
+            HTTP_ACCEPT='application/vnd.id-mapping-store.columnar+json, */*;q=0.1')
+        data = json.loads(response.content)
+        assert data['results'] == [[self.wd_district_scheme.id, 'Q1529479']]
+        assert data['history'][0]['identifier'] == [
+            self.wd_district_scheme.id, 'Q1529479']
+        assert data['schemes'] == {
+            '{0}'.format(self.wd_district_scheme.id): 'wikidata-district-item'}
+
+    def test_columnar_scheme_dump_streamed_and_not(self):
+        expected = {
+            'results': {'gss:S17000017': [[self.wd_district_scheme.id, 'Q1529479']]},
+            'schemes': {'{0}'.format(self.wd_district_scheme.id): 'wikidata-district-item'},
+        }
+        response = Client().get(self.scheme_path, {'format': 'columnar'})
+        assert json.loads(response.content) == expected
+        response = Client().get(self.scheme_path, {'format': 'columnar', 'stream': '1'})
+        assert json.loads(b''.join(response.streaming_content)) == expected
+
+    def test_csv_and_tsv_scheme_dump(self):
+        response = Client().get(self.scheme_path, {'format': 'csv'})
+        assert response['Content-Type'] == 'text/csv; charset=utf-8'
+        assert response.content.decode('utf-8') == (
+            'value,scheme_id,scheme_name,mapped_value\n'
+            'gss:S17000017,{0},wikidata-district-item,Q1529479\n'.format(
+                self.wd_district_scheme.id))
+        response = Client().get(
+            self.scheme_path, {'stream': '1'}, HTTP_ACCEPT='text/tab-separated-values')
+        assert b''.join(response.streaming_content).decode('utf-8').splitlines()[1] == (
+            'gss:S17000017\t{0}\twikidata-district-item\tQ1529479'.format(
+                self.wd_district_scheme.id))
+
+    def test_paginated_csv_links_to_next_page(self):
+        Identifier.objects.create(scheme=self.area_scheme, value='gss:S14000003')
+        EquivalenceClaim.objects.create(
+            identifier_a=Identifier.objects.get(value='gss:S14000003'),
+            identifier_b=self.wd_identifier)
+        response = Client().get(self.scheme_path, {'format': 'csv', 'limit': '1'})
+        assert len(response.content.splitlines()) == 2
+        assert 'after=gss%3AS14000003' in response['Link']
+
+    def test_csv_translation(self):
+        response = Client().get(
+            '/translate/uk-area_id/wikidata-district-item',
+            {'value': 'gss:S17000017', 'format': 'csv'})
+        assert response.content.decode('utf-8') == (
+            'uk-area_id,wikidata-district-item\ngss:S17000017,Q1529479\n')
+
+    def test_unsupported_format(self):
+        response = Client().get('/identifier/uk-area_id/gss:S17000017', {'format': 'csv'})
+        assert response.status_code == 406
+        assert 'json, columnar' in json.loads(response.content)['error']
+
+
+@override_settings(CHANGES_LISTEN=False)
+class TestChanges(FixtureMixin, TransactionTestCase):
+
+    # The feed leaves out claims from transactions that haven't
+    # finished, so the fixture has to be committed
+
+    def get_changes(self, **params):
+        response = Client().get('/changes', params)
+        return response.status_code, json.loads(response.content)
+
+    def test_changes_are_paged_in_id_order(self):
+        first_claim = EquivalenceClaim.objects.get()
+        second_claim = EquivalenceClaim.objects.create(
+            identifier_a=self.wd_identifier,
+            identifier_b=self.area_identifier,
+            deprecated=True,
+            comment='Deprecated')
+        status, data = self.get_changes(limit=1)
+        assert status == 200
+        assert [c['id'] for c in data['results']] == [first_claim.id]
+        assert data['results'][0]['identifier_a'] == {
+            'value': 'gss:S17000017',
+            'scheme_id': self.area_scheme.id,
+            'scheme_name': 'uk-area_id',
+        }
+        assert data['next'] == first_claim.id
+        status, data = self.get_changes(since=data['next'])
+        assert [c['id'] for c in data['results']] == [second_claim.id]
+        assert data['results'][0]['deprecated']
+        assert data['results'][0]['comment'] == 'Deprecated'
+        status, data = self.get_changes(since=data['next'])
+        assert data == {'results': [], 'next': second_claim.id}
+
+    def test_claims_after_one_still_being_made_are_held_back(self):
+        first_claim = EquivalenceClaim.objects.get()
+        status, data = self.get_changes()
+        assert [c['id'] for c in data['results']] == [first_claim.id]
+        db = connections['default']
+        other_connection = db.get_new_connection(db.get_connection_params())
+        try:
+            with other_connection.cursor() as cursor:
+                cursor.execute('SELECT txid_current()')
+                cursor.execute(
+                    """INSERT INTO id_mappings_equivalenceclaim
+                       (identifier_a_id, identifier_b_id, created, deprecated, comment)
+                       VALUES (%s, %s, now(), false, '') RETURNING id""",
+                    [self.area_identifier.id, self.wd_identifier.id])
+                uncommitted_claim_id = cursor.fetchone()[0]
+            later_claim = EquivalenceClaim.objects.create(
+                identifier_a=self.wd_identifier, identifier_b=self.area_identifier)
+            status, data = self.get_changes()
+            assert [c['id'] for c in data['results']] == [first_claim.id]
+            other_connection.commit()
+        finally:
+            other_connection.close()
+        status, data = self.get_changes(since=data['next'])
+        assert [c['id'] for c in data['results']] == [
+            uncommitted_claim_id, later_claim.id]
+
+    def test_wait_times_out_with_no_changes(self):
+        since = EquivalenceClaim.objects.get().id
+        start = time.time()
+        status, data = self.get_changes(since=since, wait=1)
+        assert time.time() - start >= 1
+        assert data['results'] == []
+
+    def test_waiters_are_woken_by_new_claims(self):
+        generation = changes.current_generation()
+        timer = threading.Timer(0.1, changes.wake_waiters)
+        timer.start()
+        start = time.time()
+        assert changes.wait_for_claims(generation, 10)
+        assert time.time() - start < 5
+
+    def test_invalid_parameters(self):
+        status, data = self.get_changes(limit=0)
+        assert status == 400
+        assert data['error'] == 'limit must be between 1 and 10000'
+        status, data = self.get_changes(since='x')
+        assert status == 400
+
+
+class TestReadReplicas(FixtureMixin, TransactionTestCase):
+
+    # The replica is a second connection to the test database, so the
+    # fixture has to be committed for it to see it
+
+    def setUp(self):
+        super(TestReadReplicas, self).setUp()
+        connections.databases['replica'] = dict(connections.databases['default'])
+        self.addCleanup(self.remove_replica)
+        with_replica = override_settings(REPLICA_DATABASES=['replica'], REPLICA_STICKINESS=5)
+        with_replica.enable()
+        self.addCleanup(with_replica.disable)
+
+    def remove_replica(self):
+        connections['replica'].close()
+        del connections.databases['replica']
+        del connections._connections.replica
+
+    def get_counting_queries(self, path, **extra):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = Client().get(path, **extra)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        assert response.status_code == 200
+        return len(primary), len(replica)
+
+    def post_claim(self, client=None):
+        response = (client or Client()).post(
+            '/equivalence-claim',
+            json.dumps({
+                'identifier_a': {
+                    'scheme_id': self.area_scheme.id, 'value': 'gss:S17000017'},
+                'identifier_b': {
+                    'scheme_id': self.wd_district_scheme.id, 'value': 'Q1529479'},
+                'deprecated': True,
+            }),
+            content_type='application/json',
+            HTTP_X_API_KEY=self.api_key.key)
+        assert response.status_code == 201
+        return response
+
+    def test_lookups_read_from_the_replica(self):
+        for path in [
+                '/identifier/uk-area_id/gss:S17000017',
+                '/scheme',
+                '/scheme/{0}'.format(self.area_scheme.id),
+                '/scheme/{0}?stream=1'.format(self.area_scheme.id),
+                '/translate/uk-area_id/wikidata-district-item',
+        ]:
+            primary, replica = self.get_counting_queries(path)
+            assert primary == 0, path
+            assert replica > 0, path
+
+    def test_claims_are_written_to_the_primary(self):
+        with CaptureQueriesContext(connections['replica']) as replica:
+            self.post_claim()
+        assert len(replica) == 0
+        assert EquivalenceClaim.objects.using('default').count() == 2
+
+    def test_objects_read_from_the_replica_are_saved_to_the_primary(self):
+        with replicas.reading_from('replica'):
+            scheme = Scheme.objects.get(pk=self.area_scheme.id)
+        assert scheme._state.db == 'replica'
+        scheme.name = 'renamed'
+        with CaptureQueriesContext(connections['replica']) as replica:
+            scheme.save()
+        assert len(replica) == 0
+        assert Scheme.objects.get(pk=self.area_scheme.id).name == 'renamed'
+
+    def test_client_reads_its_own_writes_from_the_primary(self):
+        claim_id = int(self.post_claim()['X-Last-Claim-Id'])
+        path = '/identifier/uk-area_id/gss:S17000017'
+        # The replica has the claim, so it can still be used:
+        primary, replica = self.get_counting_queries(
+            path, HTTP_X_LAST_CLAIM_ID=str(claim_id))
+        assert primary == 0
+        assert replica > 0
+        # But not if it's behind:
+        primary, replica = self.get_counting_queries(
+            path, HTTP_X_LAST_CLAIM_ID=str(claim_id + 1))
+        assert primary > 0
+        assert replica == 1
+
+    def test_archived_last_claim_still_lets_the_replica_be_used(self):
+        claim_id = int(self.post_claim()['X-Last-Claim-Id'])
+        EquivalenceClaim.objects.exclude(pk=claim_id).update(
+            created=timezone.now() - timedelta(days=1))
+        self.post_claim()
+        call_command('compact_claims', older_than=0, stdout=StringIO())
+        assert ArchivedEquivalenceClaim.objects.filter(pk=claim_id).exists()
+        primary, replica = self.get_counting_queries(
+            '/identifier/uk-area_id/gss:S17000017', HTTP_X_LAST_CLAIM_ID=str(claim_id))
+        assert primary == 0
+        assert replica > 0
+
+    def test_claim_cookie_is_sent_back(self):
+        client = Client()
+        response = self.post_claim(client)
+        cookie = client.cookies[replicas.LAST_CLAIM_COOKIE]
+        assert cookie['max-age'] == 5
+        request = RequestFactory().get('/')
+        request.COOKIES[replicas.LAST_CLAIM_COOKIE] = cookie.value
+        assert replicas.last_claim_id(request) == int(response['X-Last-Claim-Id'])
+        # A cookie that's been tampered with is ignored:
+        request.COOKIES[replicas.LAST_CLAIM_COOKIE] = '999999' + cookie.value[1:]
+        assert replicas.last_claim_id(request) is None
+
+    def test_stickiness_expires(self):
+        client = Client()
+        with override_settings(REPLICA_STICKINESS=1):
+            self.post_claim(client)
+        request = RequestFactory().get('/')
+        request.COOKIES.update(
+            (name, morsel.value) for name, morsel in client.cookies.items())
+        time.sleep(1.1)
+        with override_settings(REPLICA_STICKINESS=1):
+            assert replicas.last_claim_id(request) is None
+
+    def test_cached_responses_are_checked_against_the_replica(self):
+        self.post_claim()
+        path = '/identifier/uk-area_id/gss:S17000017'
+        self.get_counting_queries(path)
+        primary, replica = self.get_counting_queries(path)
+        assert replica > 0
+
+
+@override_settings(CHANGES_LISTEN=False, MAPPING_GRAPH_REFRESH_INTERVAL=0)
+class TestMappingGraph(FixtureMixin, TransactionTestCase):
+
+    # This is a TransactionTestCase because the graph reads claims
+    # from the change feed, which leaves out those from transactions
+    # that haven't finished, as a TestCase's never do.
+
+    def setUp(self):
+        super(TestMappingGraph, self).setUp()
+        self.addCleanup(unload_mapping_graph)
+        self.other_scheme = Scheme.objects.create(name='other')
+        for value, other_value, deprecated in [
+                ('Q1529479', 'x', False),
+                ('Q1529479', 'y', True),
+                ('Q42', 'z', True),
+        ]:
+            EquivalenceClaim.objects.create(
+                identifier_a=Identifier.objects.get_or_create(
+                    scheme=self.wd_district_scheme, value=value)[0],
+                identifier_b=Identifier.objects.get_or_create(
+                    scheme=self.other_scheme, value=other_value)[0],
+                deprecated=deprecated)
+        self.paths = [
+            '/identifier/uk-area_id/gss:S17000017',
+            '/identifier/wikidata-district-item/Q1529479',
+            '/identifier/other/z',
+            '/scheme/{0}'.format(self.wd_district_scheme.id),
+            '/scheme/{0}?limit=1'.format(self.wd_district_scheme.id),
+            '/scheme/{0}?limit=1&after=Q1529479'.format(self.wd_district_scheme.id),
+            '/scheme/{0}?target_scheme={1}'.format(
+                self.wd_district_scheme.id, self.other_scheme.id),
+            '/translate/wikidata-district-item/other',
+            '/translate/wikidata-district-item/other?value=Q42&value=Q1529479&value=Q1',
+        ]
+
+    def get_all(self):
+        lookup_cache().clear()
+        contents = []
+        for path in self.paths:
+            response = Client().get(path)
+            if response.streaming:
+                contents.append(b''.join(response.streaming_content))
+            else:
+                contents.append(response.content)
+        return contents
+
+    def test_responses_are_the_same_from_the_graph(self):
+        from_database = self.get_all()
+        with override_settings(MAPPING_GRAPH=True):
+            assert mapping_graph() is not None
+            assert self.get_all() == from_database
+
+    def test_mappings_are_answered_from_memory(self):
+        with override_settings(MAPPING_GRAPH=True):
+            graph = mapping_graph()
+            assert graph.ordered
+            # Take the resolved state away from the database:
+            with connections['default'].cursor() as cursor:
+                cursor.execute('UPDATE id_mappings_resolvedequivalence SET deprecated = true')
+            data = json.loads(Client().get('/scheme/{0}'.format(self.area_scheme.id)).content)
+            assert data['results'] == {
+                'gss:S17000017': [{
+                    'value': 'Q1529479',
+                    'scheme_id': self.wd_district_scheme.id,
+                    'scheme_name': 'wikidata-district-item',
+                }]
+            }
+
+    def test_new_claims_are_picked_up(self):
+        with override_settings(MAPPING_GRAPH=True):
+            mapping_graph()
+            EquivalenceClaim.objects.create(
+                identifier_a=self.area_identifier, identifier_b=self.wd_identifier,
+                deprecated=True)
+            new_identifier = Identifier.objects.create(
+                scheme=self.other_scheme, value='new')
+            EquivalenceClaim.objects.create(
+                identifier_a=self.area_identifier, identifier_b=new_identifier)
+            from_graph = self.get_all()
+        assert from_graph == self.get_all()
+        data = json.loads(from_graph[0])
+        assert data['results'] == [new_identifier.as_json()]
+
+    def test_compacting_keeps_the_same_mappings(self):
+        graph = MappingGraph()
+        graph.load()
+        before = [
+            list(graph.scheme_mappings(scheme.id)) for scheme in Scheme.objects.all()]
+        new_identifier = Identifier.objects.create(scheme=self.other_scheme, value='new')
+        EquivalenceClaim.objects.create(
+            identifier_a=self.wd_identifier, identifier_b=new_identifier)
+        graph = graph.refresh()
+        assert graph.added_count == 2
+        after = [
+            list(graph.scheme_mappings(scheme.id)) for scheme in Scheme.objects.all()]
+        assert after != before
+        graph.compact()
+        graph.build_scheme_order()
+        assert graph.added_count == 0
+        assert graph.scheme_extra == {}
+        assert [
+            list(graph.scheme_mappings(scheme.id)) for scheme in Scheme.objects.all()
+        ] == after
+
+    @override_settings(MAPPING_GRAPH_REFRESH_INTERVAL=0)
+    def test_scheme_renamed_by_another_process_is_seen(self):
+        paths = [
+            '/identifier/wikidata-district-item/Q1529479',
+            '/scheme/{0}'.format(self.wd_district_scheme.id),
+        ]
+        with override_settings(MAPPING_GRAPH=True):
+            mapping_graph()
+            # As Scheme.save() would in another process, without
+            # touching this one's lookup cache:
+            Scheme.objects.filter(pk=self.area_scheme.id).update(
+                name='renamed', last_modified=timezone.now())
+            from_graph = [Client().get(path).content for path in paths]
+        assert from_graph == [Client().get(path).content for path in paths]
+        for content in from_graph:
+            assert b'"renamed"' in content
+
+    def test_unknown_identifiers_fall_back_to_the_database(self):
+        with override_settings(MAPPING_GRAPH=True):
+            graph = mapping_graph()
+            unlinked = Identifier.objects.create(scheme=self.other_scheme, value='unlinked')
+            assert graph.mapped_identifiers(unlinked.id) is None
+            response = Client().get('/identifier/other/unlinked')
+            assert json.loads(response.content) == {'results': [], 'history': []}
+
+    def test_stats(self):
+        out = StringIO()
+        call_command('mapping_graph_stats', stdout=out)
+        assert 'Loaded 6 identifiers and 4 pairs' in out.getvalue()
+        assert 'Bytes per million pairs: ' in out.getvalue()
+
+
+@override_settings(CHANGES_LISTEN=False, MAPPING_GRAPH_REFRESH_INTERVAL=0)
+class TestGraphSnapshot(FixtureMixin, TransactionTestCase):
+
+    def setUp(self):
+        super(TestGraphSnapshot, self).setUp()
+        self.addCleanup(unload_mapping_graph)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'graph')
+        self.other_scheme = Scheme.objects.create(name='other')
+        EquivalenceClaim.objects.create(
+            identifier_a=self.wd_identifier,
+            identifier_b=Identifier.objects.create(scheme=self.other_scheme, value='x'))
+        EquivalenceClaim.objects.create(
+            identifier_a=self.wd_identifier,
+            identifier_b=Identifier.objects.create(scheme=self.other_scheme, value='y'),
+            deprecated=True)
+        self.paths = [
+            '/identifier/uk-area_id/gss:S17000017',
+            '/identifier/wikidata-district-item/Q1529479',
+            '/identifier/other/y',
+            '/scheme/{0}'.format(self.wd_district_scheme.id),
+            '/scheme/{0}?limit=1&after=x'.format(self.other_scheme.id),
+            '/translate/wikidata-district-item/other',
+        ]
+
+    def get_all(self):
+        lookup_cache().clear()
+        contents = []
+        for path in self.paths:
+            response = Client().get(path)
+            if response.streaming:
+                contents.append(b''.join(response.streaming_content))
+            else:
+                contents.append(response.content)
+        return contents
+
+    def build(self):
+        out = StringIO()
+        with override_settings(MAPPING_GRAPH_SNAPSHOT=self.path):
+            call_command('build_graph_snapshot', stdout=out)
+        return out.getvalue()
+
+    def test_build_command(self):
+        assert 'Wrote a snapshot of 4 identifiers and 3 pairs' in self.build()
+        assert os.path.exists(self.path)
+        assert not os.path.exists(self.path + '.tmp')
+
+    def test_build_command_needs_a_path(self):
+        with self.assertRaises(CommandError):
+            call_command('build_graph_snapshot', stdout=StringIO())
+
+    def test_snapshot_matches_the_graph_it_was_written_from(self):
+        graph = MappingGraph()
+        graph.load()
+        write_snapshot(graph, self.path)
+        for cast in (True, False):
+            snapshot = GraphSnapshot(self.path, cast=cast)
+            assert snapshot.last_claim_id == graph.last_claim_id
+            for scheme in Scheme.objects.all():
+                assert list(snapshot.scheme_mappings(scheme.id)) == \
+                    list(graph.scheme_mappings(scheme.id))
+            for identifier in Identifier.objects.all():
+                assert snapshot.mapped_identifiers(identifier.id) == \
+                    graph.mapped_identifiers(identifier.id)
+
+    def test_nodes_added_out_of_order_are_found_in_the_snapshot(self):
+        unlinked = Identifier.objects.create(scheme=self.other_scheme, value='unlinked')
+        later = Identifier.objects.create(scheme=self.other_scheme, value='later')
+        EquivalenceClaim.objects.create(identifier_a=self.wd_identifier, identifier_b=later)
+        graph = MappingGraph()
+        graph.load()
+        # This identifier has a lower ID than the last node, so it's
+        # added after it out of order:
+        EquivalenceClaim.objects.create(identifier_a=self.area_identifier, identifier_b=unlinked)
+        graph = graph.refresh()
+        assert graph.sorted_node_count < graph.node_count
+        write_snapshot(graph, self.path)
+        for cast in (True, False):
+            snapshot = GraphSnapshot(self.path, cast=cast)
+            for identifier in Identifier.objects.all():
+                assert snapshot.node(identifier.id) is not None
+                assert snapshot.mapped_identifiers(identifier.id) == \
+                    graph.mapped_identifiers(identifier.id)
+            for scheme in Scheme.objects.all():
+                assert list(snapshot.scheme_mappings(scheme.id)) == \
+                    list(graph.scheme_mappings(scheme.id))
+
+    def test_responses_are_the_same_from_the_snapshot(self):
+        from_database = self.get_all()
+        self.build()
+        with override_settings(MAPPING_GRAPH_SNAPSHOT=self.path):
+            assert isinstance(mapping_graph(), GraphSnapshot)
+            assert self.get_all() == from_database
+
+    def test_no_snapshot_yet(self):
+        with override_settings(MAPPING_GRAPH_SNAPSHOT=self.path):
+            assert mapping_graph() is None
+            assert json.loads(Client().get('/identifier/other/x').content)['results'] == [
+                self.wd_identifier.as_json()]
+
+    def test_newer_claims_are_read_from_the_database(self):
+        self.build()
+        with override_settings(MAPPING_GRAPH_SNAPSHOT=self.path):
+            snapshot = mapping_graph()
+            EquivalenceClaim.objects.create(
+                identifier_a=self.area_identifier, identifier_b=self.wd_identifier,
+                deprecated=True)
+            assert mapping_graph() is snapshot
+            self.area_identifier.refresh_from_db()
+            assert not snapshot.covers(self.area_identifier.last_claim_id)
+            data = json.loads(Client().get('/identifier/uk-area_id/gss:S17000017').content)
+            assert data['results'] == []
+            # Schemes that weren't changed are still answered from the snapshot:
+            assert queries.graph_for_scheme(self.other_scheme.id) is snapshot
+            assert queries.graph_for_scheme(self.area_scheme.id) is None
+
+    def test_a_new_snapshot_is_switched_to(self):
+        self.build()
+        with override_settings(MAPPING_GRAPH_SNAPSHOT=self.path):
+            snapshot = mapping_graph()
+            new_identifier = Identifier.objects.create(scheme=self.other_scheme, value='new')
+            EquivalenceClaim.objects.create(
+                identifier_a=self.area_identifier, identifier_b=new_identifier)
+            self.build()
+            new_snapshot = mapping_graph()
+            assert new_snapshot is not snapshot
+            self.area_identifier.refresh_from_db()
+            assert new_snapshot.covers(self.area_identifier.last_claim_id)
+            from_snapshot = self.get_all()
+        assert from_snapshot == self.get_all()
+
+
+class CountingClient(IDMappingClient):
+
+    def __init__(self, *args, **kwargs):
+        super(CountingClient, self).__init__(*args, **kwargs)
+        self.requests = []
+
+    def send(self, method, path, *args, **kwargs):
+        self.requests.append((method, path))
+        response = super(CountingClient, self).send(method, path, *args, **kwargs)
+        self.requests[-1] += (response.status,)
+        return response
+
+
+class TestClient(FixtureMixin, LiveServerTestCase):
+
+    def setUp(self):
+        super(TestClient, self).setUp()
+        self.client = CountingClient(self.live_server_url, api_key=self.api_key.key)
+        self.addCleanup(self.client.close)
+
+    def test_lookup(self):
+        data = self.client.lookup('uk-area_id', 'gss:S17000017')
+        assert data['results'] == [self.wd_identifier.as_json()]
+        assert self.client.lookup(self.area_scheme.id, 'gss:MADEUP') is None
+
+    def test_lookups_are_revalidated_with_etags(self):
+        first = self.client.lookup(self.area_scheme.id, 'gss:S17000017')
+        second = self.client.lookup(self.area_scheme.id, 'gss:S17000017')
+        assert first == second
+        assert [status for _, _, status in self.client.requests] == [200, 304]
+        self.client.claim(
+            (self.area_scheme.id, 'gss:S17000017'),
+            (self.wd_district_scheme.id, 'Q1529479'),
+            deprecated=True)
+        assert self.client.lookup(self.area_scheme.id, 'gss:S17000017')['results'] == []
+        assert self.client.requests[-1][2] == 200
+
+    def test_lookup_many_is_batched(self):
+        identifiers = [('uk-area_id', 'gss:S17000017'), (self.wd_district_scheme.id, 'Q1')]
+        results = self.client.lookup_many(identifiers * 3)
+        assert [r and r['results'] for r in results] == [
+            [self.wd_identifier.as_json()], None] * 3
+        assert self.client.requests == [('POST', '/identifiers/lookup', 200)]
+
+    def test_claims_are_batched(self):
+        self.client.claim_batch_size = 2
+        with self.client.claim_batch() as batch:
+            for value in ('a', 'b', 'c'):
+                batch.add((self.area_scheme.id, value), (self.wd_district_scheme.id, 'Q1'))
+            batch.add((self.area_scheme.id, 'd'), (12345, 'Q1'))
+        assert batch.totals == {
+            'claims_created': 3,
+            'claims_skipped': 0,
+            'identifiers_created': 4,
+            'errors': [{'line': 4, 'error': 'Unknown scheme ID: 12345'}],
+        }
+        assert [path for _, path, _ in self.client.requests] == [
+            '/equivalence-claims/bulk'] * 2
+        assert len(self.client.translate('uk-area_id', 'wikidata-district-item', [
+            'a', 'b', 'c', 'd'])) == 3
+
+    def test_unchanged_claims_are_skipped(self):
+        existing = (
+            (self.area_scheme.id, 'gss:S17000017'), (self.wd_district_scheme.id, 'Q1529479'))
+        assert not self.client.claim(*existing, skip_unchanged=True)['claim_created']
+        with self.client.claim_batch(skip_unchanged=True) as batch:
+            batch.add(*existing)
+            batch.add(*existing, deprecated=True)
+        assert (batch.totals['claims_created'], batch.totals['claims_skipped']) == (1, 1)
+        assert self.client.claim(*existing, idempotency_key='k')['claim_created']
+        assert self.client.claim(*existing, idempotency_key='k')['claim_created']
+        assert EquivalenceClaim.objects.count() == 3
+
+    def test_claims_need_an_api_key(self):
+        client = IDMappingClient(self.live_server_url)
+        self.addCleanup(client.close)
+        with self.assertRaises(APIError) as context:
+            client.claim((self.area_scheme.id, 'a'), (self.wd_district_scheme.id, 'b'))
+        assert context.exception.status == 403
+
+    def test_scheme_mappings_are_fetched_a_page_at_a_time(self):
+        self.client.create_claims(
+            claim_data((self.wd_district_scheme.id, 'Q{0}'.format(i)), (self.area_scheme.id, 'x'))
+            for i in range(5))
+        del self.client.requests[:]
+        mappings = self.client.scheme_mappings(self.wd_district_scheme.id, page_size=2)
+        assert next(mappings)[0] == 'Q0'
+        assert len(self.client.requests) == 1
+        assert [value for value, _ in mappings] == ['Q1', 'Q1529479', 'Q2', 'Q3', 'Q4']
+        assert len(self.client.requests) == 3
+        with self.assertRaises(NotFound):
+            list(self.client.scheme_mappings(12345))
+
+    def test_connections_are_reused(self):
+        for i in range(3):
+            self.client.schemes()
+        assert len(self.client.pool.idle) == 1
+
+    def test_async_client(self):
+        import asyncio
+        from id_mappings_client.aio import AsyncIDMappingClient
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        client = AsyncIDMappingClient(
+            self.live_server_url, api_key=self.api_key.key, concurrency=2)
+        requests = []
+        send = client.client.send
+        client.client.send = lambda method, path, *args, **kwargs: (
+            requests.append(path) or send(method, path, *args, **kwargs))
+        claim_results = loop.run_until_complete(asyncio.gather(*[
+            client.claim((self.area_scheme.id, 'a{0}'.format(i)),
+                         (self.wd_district_scheme.id, 'Q1'))
+            for i in range(10)
+        ] + [client.claim((self.area_scheme.id, 'b'), (12345, 'Q1'))],
+            return_exceptions=True))
+        assert claim_results[:10] == [None] * 10
+        assert 'Unknown scheme ID' in '{0}'.format(claim_results[10])
+        results = loop.run_until_complete(asyncio.gather(*[
+            client.lookup(self.area_scheme.id, 'a{0}'.format(i)) for i in range(10)
+        ] + [client.lookup(self.area_scheme.id, 'unknown')]))
+        assert [r and r['results'][0]['value'] for r in results] == ['Q1'] * 10 + [None]
+        assert requests == ['/equivalence-claims/bulk', '/identifiers/lookup']
+        mappings = client.scheme_mappings(self.wd_district_scheme.id, page_size=1)
+        values = []
+        while True:
+            try:
+                values.append(loop.run_until_complete(mappings.__anext__())[0])
+            except StopAsyncIteration:
+                break
+        assert values == ['Q1', 'Q1529479']
+        loop.run_until_complete(client.close())
+
+
+class TestBenchmarks(FixtureMixin, TestCase):
+
+    def setUp(self):
+        super(TestBenchmarks, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def run_benchmarks(self, filename, **kwargs):
+        path = os.path.join(self.directory, filename)
+        call_command(
+            'benchmark', sizes=[20, 40], schemes=3, repeat=2, output=path,
+            benchmark=['scheme_list', 'scheme_page', 'equivalence_claim_create'],
+            stdout=StringIO(), **kwargs)
+        with io.open(path) as f:
+            return json.load(f)
+
+    def test_data_is_topped_up(self):
+        schemes = benchmarks.generate_data(3, 10)
+        assert benchmarks.entity_count(schemes) == 10
+        first_claims = EquivalenceClaim.objects.count()
+        assert first_claims >= 20
+        benchmarks.generate_data(3, 25)
+        assert benchmarks.entity_count(schemes) == 25
+        assert Identifier.objects.filter(scheme__in=schemes).count() == 75
+        # Every first-scheme identifier has been linked to the others:
+        assert ResolvedEquivalence.objects.filter(
+            Q(identifier_a__scheme=schemes[0]) | Q(identifier_b__scheme=schemes[0])
+        ).count() >= 50
+
+    def test_results_are_written_as_json(self):
+        results = self.run_benchmarks('results.json')
+        assert [run['entities'] for run in results['runs']] == [20, 40]
+        for run in results['runs']:
+            assert sorted(run['benchmarks']) == [
+                'equivalence_claim_create', 'scheme_list', 'scheme_page']
+            for result in run['benchmarks'].values():
+                assert result['queries'] <= result['max_queries']
+                assert result['min_ms'] <= result['median_ms'] <= result['max_ms']
+                assert result['repeat'] == 2
+
+    def test_query_budgets_are_checked(self):
+        results = {'runs': [{'entities': 10, 'benchmarks': {
+            'identifier_lookup': {'queries': 40, 'max_queries': 5},
+            'scheme_list': {'queries': 2, 'max_queries': 2},
+        }}]}
+        assert benchmarks.over_budget(results) == [
+            'identifier_lookup with 10 entities made 40 queries (budget 5)']
+
+    def test_regressions_are_reported(self):
+        old = self.run_benchmarks('old.json')
+        for run in old['runs']:
+            for result in run['benchmarks'].values():
+                result['median_ms'] = 0.0001
+        old_path = os.path.join(self.directory, 'old.json')
+        with io.open(old_path, 'w') as f:
+            f.write(json.dumps(old))
+        with self.assertRaises(CommandError) as context:
+            self.run_benchmarks('new.json', compare=old_path)
+        # The data for 20 entities has been passed, so that size is skipped:
+        assert '{0}'.format(context.exception).split('\n') == [
+            'equivalence_claim_create with 40 entities is slower',
+            'scheme_list with 40 entities is slower',
+            'scheme_page with 40 entities is slower',
+        ]
+
+
+@override_settings(METRICS=True)
+class TestMetrics(FixtureMixin, TestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        metrics.registry.clear()
+        self.addCleanup(metrics.registry.clear)
+
+    def server_timing(self, response):
+        return dict(
+            (entry.split(';')[0], entry.split(';')[1:])
+            for entry in response['Server-Timing'].split(', '))
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = Client().get('/identifier/uk-area_id/gss:S17000017')
+        timings = self.server_timing(response)
+        assert sorted(timings) == ['db', 'serialize', 'total', 'view']
+        assert timings['db'][1] == 'desc="{0} queries"'.format(len(queries))
+        durations = dict(
+            (name, float(entry[0].split('=')[1])) for name, entry in timings.items())
+        assert abs(durations['db'] + durations['serialize'] + durations['view'] -
+                   durations['total']) < 0.5
+
+    def test_cursors_are_restored(self):
+        Client().get('/identifier/uk-area_id/gss:S17000017')
+        for alias in connections:
+            assert 'make_cursor' not in connections[alias].__dict__
+            assert 'make_debug_cursor' not in connections[alias].__dict__
+
+    def test_histograms(self):
+        for _ in range(2):
+            Client().get('/identifier/uk-area_id/gss:S17000017')
+        Client().get('/identifier/uk-area_id/gss:MADEUP')
+        Client().get('/scheme/{0}'.format(self.area_scheme.id))
+        text = Client().get('/metrics').content.decode('utf-8')
+        lines = text.splitlines()
+        labels = 'route="identifier-lookup",method="GET"'
+        assert '# TYPE id_mappings_request_duration_seconds histogram' in lines
+        assert 'id_mappings_request_duration_seconds_count{{{0}}} 3'.format(labels) in lines
+        assert 'id_mappings_request_duration_seconds_bucket{{{0},le="+Inf"}} 3'.format(
+            labels) in lines
+        assert 'id_mappings_requests_total{{{0},status="404"}} 1'.format(labels) in lines
+        assert 'id_mappings_requests_total{{{0},status="200"}} 2'.format(labels) in lines
+        assert ('id_mappings_request_duration_seconds_count{'
+                'route="IdentifiersForSchemeView",method="GET"} 1') in lines
+        bucket_counts = [
+            int(line.split()[-1]) for line in lines
+            if line.startswith('id_mappings_request_duration_seconds_bucket{' + labels)]
+        assert bucket_counts == sorted(bucket_counts)
+        queries = [
+            line for line in lines
+            if line.startswith('id_mappings_request_db_queries_total{' + labels)]
+        assert int(queries[0].split()[-1]) > 0
+
+    @override_settings(METRICS=False)
+    def test_disabled(self):
+        response = Client().get('/identifier/uk-area_id/gss:S17000017')
+        assert 'Server-Timing' not in response
+        assert Client().get('/metrics').status_code == 404
+        assert metrics.registry.routes == {}
+
+
+class TestLookupQueryCount(FixtureMixin, TestCase):
+
+    def add_history(self, identifier, length):
+        schemes = [self.wd_district_scheme, Scheme.objects.create(name='other')]
+        for i in range(length):
+            EquivalenceClaim.objects.create(
+                identifier_a=identifier,
+                identifier_b=Identifier.objects.get_or_create(
+                    scheme=schemes[i % 2], value='Q{0}'.format(i // 4))[0],
+                deprecated=(i % 4 == 3),
+                comment='Claim {0}'.format(i))
+
+    def count_queries(self, path):
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = Client().get(path)
+        assert response.status_code == 200
+        return len(queries), json.loads(response.content)
+
+    def test_query_count_is_constant_as_history_grows(self):
+        short = Identifier.objects.create(scheme=self.area_scheme, value='short')
+        self.add_history(short, 2)
+        long_history = Identifier.objects.create(scheme=self.area_scheme, value='long')
+        self.add_history(long_history, 60)
+        for suffix in ('', '?transitive=1'):
+            lookup_cache().clear()
+            short_count, short_data = self.count_queries(
+                '/identifier/uk-area_id/short' + suffix)
+            long_count, long_data = self.count_queries(
+                '/identifier/uk-area_id/long' + suffix)
+            assert len(short_data['history']) == 2
+            assert len(long_data['history']) == 60
+            # The scheme is read with the identifier:
+            assert long_count == short_count
+        lookup_cache().clear()
+        assert self.count_queries('/identifier/uk-area_id/long')[0] == 3
+
+    def test_history_is_unchanged(self):
+        self.add_history(self.area_identifier, 5)
+        data = json.loads(Client().get('/identifier/uk-area_id/gss:S17000017').content)
+        claims = EquivalenceClaim.objects.filter(
+            Q(identifier_a=self.area_identifier) | Q(identifier_b=self.area_identifier)
+        ).order_by('created', 'id')
+        assert data['history'] == [
+            {
+                'identifier': claim.other_identifier(self.area_identifier).as_json(),
+                'created': claim.created.isoformat(),
+                'deprecated': claim.deprecated,
+                'comment': claim.comment,
+            }
+            for claim in claims
+        ]
+        assert data['results'] == [
+            Identifier.objects.get(value=value, scheme__name=scheme).as_json()
+            for scheme, value in [
+                ('wikidata-district-item', 'Q1529479'),
+                ('wikidata-district-item', 'Q0'),
+                ('wikidata-district-item', 'Q1'),
+            ]
+        ]
+
+    def test_renamed_schemes_are_not_found_by_their_old_names(self):
+        assert Client().get('/identifier/uk-area_id/gss:S17000017').status_code == 200
+        self.area_scheme.name = 'renamed'
+        self.area_scheme.save()
+        assert Client().get('/identifier/uk-area_id/gss:S17000017').status_code == 404
+        data = json.loads(Client().get('/identifier/renamed/gss:S17000017').content)
+        assert data['results'] == [self.wd_identifier.as_json()]
+
+    def test_lookup_benchmarks_are_within_budget(self):
+        schemes = benchmarks.generate_data(3, 30, history_depth=8)
+        run = benchmarks.run_benchmarks(schemes, repeat=1, names=[
+            'identifier_lookup', 'identifier_lookup_by_name',
+            'identifier_lookup_transitive'])
+        assert benchmarks.over_budget({'runs': [run]}) == []
+
+
+class TestLatestClaims(FixtureMixin, TestCase):
+
+    def latest_claims(self, where='', params=()):
+        with connections['default'].cursor() as cursor:
+            cursor.execute(latest_claims_sql(where), params)
+            return cursor.fetchall()
+
+    def test_one_row_for_each_normalised_pair(self):
+        other = Identifier.objects.create(scheme=self.wd_district_scheme, value='Q2')
+        EquivalenceClaim.objects.create(
+            identifier_a=self.wd_identifier, identifier_b=self.area_identifier,
+            deprecated=True)
+        # Made later, but saying it was made earlier:
+        EquivalenceClaim.objects.create(
+            identifier_a=self.area_identifier, identifier_b=self.wd_identifier,
+            created=timezone.now() - timedelta(days=1))
+        latest_other = EquivalenceClaim.objects.create(
+            identifier_a=other, identifier_b=self.area_identifier)
+        rows = [row[:3] + row[4:] for row in self.latest_claims()]
+        deprecating = EquivalenceClaim.objects.get(
+            identifier_a=self.wd_identifier, deprecated=True)
+        assert rows == sorted([
+            (self.area_identifier.id, self.wd_identifier.id, True, deprecating.id),
+            (min(self.area_identifier.id, other.id), max(self.area_identifier.id, other.id),
+             False, latest_other.id),
+        ])
+        assert ResolvedEquivalence.objects.discrepancies() == []
+
+    def test_claims_can_be_restricted(self):
+        deprecating = EquivalenceClaim.objects.create(
+            identifier_a=self.wd_identifier, identifier_b=self.area_identifier,
+            deprecated=True)
+        rows = self.latest_claims('id < %s', [deprecating.id])
+        assert [row[2] for row in rows] == [False]
+
+    def test_latest_claim_about_a_pair_is_read_from_the_index(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + latest_claims_sql(
+                '{0} = %s AND {1} = %s'.format(PAIR_LOW_SQL, PAIR_HIGH_SQL)),
+                [self.area_identifier.id, self.wd_identifier.id])
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        assert 'id_mappings_equivalenceclaim_pair_latest' in plan
+        assert 'Sort' not in plan
+
+
+class TestIdempotentClaims(FixtureMixin, TestCase):
+
+    def post_claim(self, path='/equivalence-claim', deprecated=False, value_b='Q1529479',
+                   **headers):
+        return Client().post(
+            path,
+            json.dumps(claim_data(
+                (self.area_scheme.id, 'gss:S17000017'),
+                (self.wd_district_scheme.id, value_b), deprecated)),
+            content_type='application/json',
+            HTTP_X_API_KEY=self.api_key.key,
+            **headers)
+
+    def test_retry_with_the_same_key_is_not_recorded_again(self):
+        first = self.post_claim(value_b='Q2', HTTP_IDEMPOTENCY_KEY='sync-1')
+        retry = self.post_claim(value_b='Q2', HTTP_IDEMPOTENCY_KEY='sync-1')
+        assert first.status_code == retry.status_code == 201
+        assert json.loads(retry.content) == json.loads(first.content) == {
+            'identifier_a': {'created': False},
+            'identifier_b': {'created': True},
+            'claim_created': True,
+        }
+        assert retry['Idempotent-Replayed'] == 'true'
+        assert 'Idempotent-Replayed' not in first
+        assert EquivalenceClaim.objects.filter(identifier_b__value='Q2').count() == 1
+        self.post_claim(value_b='Q2', HTTP_IDEMPOTENCY_KEY='sync-2')
+        assert EquivalenceClaim.objects.filter(identifier_b__value='Q2').count() == 2
+
+    def test_key_cannot_be_reused_for_a_different_request(self):
+        self.post_claim(HTTP_IDEMPOTENCY_KEY='sync-1')
+        response = self.post_claim(deprecated=True, HTTP_IDEMPOTENCY_KEY='sync-1')
+        assert response.status_code == 422
+        assert not ResolvedEquivalence.objects.get().deprecated
+
+    def test_expired_keys_are_replaced_and_cleared(self):
+        self.post_claim(HTTP_IDEMPOTENCY_KEY='sync-1')
+        IdempotentRequest.objects.update(created=timezone.now() - timedelta(days=2))
+        response = self.post_claim(HTTP_IDEMPOTENCY_KEY='sync-1')
+        assert 'Idempotent-Replayed' not in response
+        assert EquivalenceClaim.objects.count() == 3
+        IdempotentRequest.objects.update(created=timezone.now() - timedelta(days=2))
+        call_command('clear_idempotency_keys', stdout=StringIO())
+        assert not IdempotentRequest.objects.exists()
+
+    def test_skip_unchanged_claims(self):
+        path = '/equivalence-claim?skip_unchanged=1'
+        response = self.post_claim(path)
+        assert response.status_code == 200
+        assert not json.loads(response.content)['claim_created']
+        assert EquivalenceClaim.objects.count() == 1
+        response = self.post_claim(path, deprecated=True)
+        assert response.status_code == 201
+        assert json.loads(response.content)['claim_created']
+        assert ResolvedEquivalence.objects.get().deprecated
+        # A new pair is always recorded:
+        assert self.post_claim(path, value_b='Q2').status_code == 201
+        # ... and so is an unchanged claim without the option:
+        assert self.post_claim(value_b='Q2').status_code == 201
+        assert EquivalenceClaim.objects.count() == 4
+
+    def test_bulk_skip_unchanged_claims(self):
+        lines = [
+            claim_data(
+                (self.area_scheme.id, 'gss:S17000017'),
+                (self.wd_district_scheme.id, value_b), deprecated)
+            for value_b, deprecated in [
+                ('Q1529479', False), ('Q1529479', True), ('Q1529479', True),
+                ('Q2', False), ('Q2', False),
+            ]
+        ]
+        response = Client().post(
+            '/equivalence-claims/bulk?skip_unchanged=1',
+            ''.join(json.dumps(line) + '\n' for line in lines),
+            content_type='application/x-ndjson',
+            HTTP_X_API_KEY=self.api_key.key)
+        data = json.loads(response.content)
+        assert (data['claims_created'], data['claims_skipped']) == (2, 3)
+        assert EquivalenceClaim.objects.count() == 3
+        assert ResolvedEquivalence.objects.discrepancies() == []
+
+
+class TestCompactClaims(FixtureMixin, TestCase):
+
+    def setUp(self):
+        super(TestCompactClaims, self).setUp()
+        old = timezone.now() - timedelta(days=100)
+        EquivalenceClaim.objects.update(created=old - timedelta(days=7))
+        ResolvedEquivalence.objects.rebuild()
+        self.other = Identifier.objects.create(scheme=self.wd_district_scheme, value='Q2')
+        for days, deprecated in ((6, True), (3, False), (2, True)):
+            EquivalenceClaim.objects.create(
+                identifier_a=self.area_identifier, identifier_b=self.other,
+                created=old - timedelta(days=days), deprecated=deprecated)
+        # The latest claim about the fixture's pair is also old, and a
+        # recent one about the other pair supersedes the old ones:
+        EquivalenceClaim.objects.create(
+            identifier_a=self.area_identifier, identifier_b=self.other)
+
+    def lookup(self, path='/identifier/uk-area_id/gss:S17000017'):
+        response = Client().get(path)
+        assert response.status_code == 200
+        return response, json.loads(response.content)
+
+    def test_superseded_claims_are_archived(self):
+        before_response, before = self.lookup()
+        resolved = list(ResolvedEquivalence.objects.order_by('id').values_list(
+            'identifier_a', 'identifier_b', 'deprecated', 'latest_claim'))
+        out = StringIO()
+        call_command('compact_claims', batch_size=2, stdout=out)
+        assert 'Archived 3 superseded claims' in out.getvalue()
+        assert EquivalenceClaim.objects.count() == 2
+        assert set(ArchivedEquivalenceClaim.objects.values_list('deprecated', flat=True)) == \
+            {True, False}
+        # The state of each pair is unchanged, and still matches the
+        # remaining claims:
+        assert list(ResolvedEquivalence.objects.order_by('id').values_list(
+            'identifier_a', 'identifier_b', 'deprecated', 'latest_claim')) == resolved
+        assert ResolvedEquivalence.objects.discrepancies() == []
+        # Neither the cached lookup nor its ETag is still used, in this
+        # process or any other:
+        self.area_identifier.refresh_from_db()
+        assert self.area_identifier.archived_claim_count == 3
+        response, after = self.lookup()
+        assert after['results'] == before['results']
+        assert len(after['history']) == 2
+        assert Client().get(
+            '/identifier/uk-area_id/gss:S17000017',
+            HTTP_IF_NONE_MATCH=before_response['ETag']).status_code == 200
+        archived_response, archived = self.lookup(
+            '/identifier/uk-area_id/gss:S17000017?include_archived=1')
+        assert archived == before
+        assert archived_response['ETag'] != response['ETag']
+
+    def test_recent_claims_are_kept(self):
+        call_command('compact_claims', older_than=105, stdout=StringIO())
+        assert ArchivedEquivalenceClaim.objects.count() == 1
+        call_command('compact_claims', stdout=StringIO())
+        assert ArchivedEquivalenceClaim.objects.count() == 3
+        call_command('compact_claims', stdout=StringIO())
+        assert ArchivedEquivalenceClaim.objects.count() == 3
+
+
+class TestAsOf(FixtureMixin, TestCase):
+
+    def setUp(self):
+        super(TestAsOf, self).setUp()
+        self.now = timezone.now()
+        self.q1 = Identifier.objects.create(scheme=self.wd_district_scheme, value='Q1')
+        for days, deprecated in ((10, False), (5, True)):
+            EquivalenceClaim.objects.create(
+                identifier_a=self.q1, identifier_b=self.area_identifier,
+                created=self.now - timedelta(days=days), deprecated=deprecated)
+
+    def get(self, path, as_of, **params):
+        response = Client().get(path, dict(params, as_of=as_of.isoformat()))
+        assert response.status_code == 200
+        if response.streaming:
+            return json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        return json.loads(response.content)
+
+    def test_lookup_as_of(self):
+        path = '/identifier/uk-area_id/gss:S17000017'
+        data = self.get(path, self.now - timedelta(days=7))
+        assert data['results'] == [self.q1.as_json()]
+        assert [claim['identifier'] for claim in data['history']] == [self.q1.as_json()]
+        assert self.get(path, self.now - timedelta(days=1))['results'] == []
+        assert self.get(path, timezone.now()) == json.loads(Client().get(path).content)
+        # A date means the end of that day:
+        response = Client().get(path, {
+            'as_of': (self.now - timedelta(days=10)).date().isoformat()})
+        assert json.loads(response.content)['results'] == [self.q1.as_json()]
+
+    def test_archived_claims_are_used(self):
+        call_command('compact_claims', older_than=1, stdout=StringIO())
+        assert ArchivedEquivalenceClaim.objects.count() == 1
+        data = self.get(
+            '/identifier/uk-area_id/gss:S17000017', self.now - timedelta(days=7))
+        assert data['results'] == [self.q1.as_json()]
+        assert len(data['history']) == 0
+        data = self.get(
+            '/scheme/{0}'.format(self.area_scheme.id), self.now - timedelta(days=7))
+        assert data['results'] == {'gss:S17000017': [self.q1.as_json()]}
+
+    def test_scheme_as_of(self):
+        path = '/scheme/{0}'.format(self.wd_district_scheme.id)
+        assert self.get(path, self.now - timedelta(days=7))['results'] == {
+            'Q1': [self.area_identifier.as_json()],
+        }
+        assert self.get(path, self.now - timedelta(days=1))['results'] == {'Q1': []}
+        assert self.get(path, self.now - timedelta(days=11))['results'] == {}
+        page = Client().get(path, {
+            'limit': 1, 'as_of': (self.now - timedelta(days=7)).isoformat()})
+        assert json.loads(page.content) == {
+            'results': {'Q1': [self.area_identifier.as_json()]},
+            'next': None,
+        }
+        current = json.loads(Client().get(path).content)['results']
+        assert self.get(path, timezone.now())['results'] == current
+
+    def test_translate_as_of(self):
+        path = '/translate/wikidata-district-item/uk-area_id'
+        data = self.get(path, self.now - timedelta(days=7), value=['Q1', 'Q1529479'])
+        assert data['results'] == {'Q1': ['gss:S17000017']}
+        data = self.get(path, timezone.now())
+        assert data['results'] == {'Q1529479': ['gss:S17000017']}
+
+    def test_as_of_responses_are_not_cached(self):
+        as_of = self.now - timedelta(days=7)
+        scheme_path = '/scheme/{0}'.format(self.wd_district_scheme.id)
+        for path, params in [
+                ('/identifier/uk-area_id/gss:S17000017', {}),
+                (scheme_path, {}),
+                (scheme_path, {'limit': 1}),
+        ]:
+            self.get(path, as_of, **params)
+            self.get(path, as_of, **params)
+        stats = json.loads(Client().get('/cache-stats').content)
+        assert (stats['hits'], stats['misses']) == (0, 0)
+
+    def test_invalid_as_of(self):
+        response = Client().get('/identifier/uk-area_id/gss:S17000017?as_of=yesterday')
+        assert response.status_code == 400
+        assert 'as_of' in json.loads(response.content)['error']
+        response = Client().get(
+            '/identifier/uk-area_id/gss:S17000017?transitive=1&as_of=2018-01-01')
+        assert response.status_code == 400
+
+    def test_as_of_benchmarks_are_within_budget(self):
+        schemes = benchmarks.generate_data(3, 30, history_depth=8)
+        run = benchmarks.run_benchmarks(schemes, repeat=1, names=[
+            'identifier_lookup_as_of', 'scheme_page_as_of'])
+        assert benchmarks.over_budget({'runs': [run]}) == []
+
+
+class TestImportClaimsFailure(FixtureMixin, TestCase):
+
+    def test_claims_from_earlier_partitions_are_resolved(self):
+        real_create_claims = import_claims.create_claims_for_scheme
+        calls = []
+
+        def failing_create_claims(staging_table, scheme_id):
+            if calls:
+                raise RuntimeError('Partition failed')
+            calls.append(scheme_id)
+            return real_create_claims(staging_table, scheme_id)
+
+        import_claims.create_claims_for_scheme = failing_create_claims
+        self.addCleanup(
+            setattr, import_claims, 'create_claims_for_scheme', real_create_claims)
+        f = tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write('\n'.join([
+                'scheme_a,value_a,scheme_b,value_b',
+                'uk-area_id,gss:S14000003,wikidata-district-item,Q408547',
+                'wikidata-district-item,Q1529479,uk-area_id,gss:S17000017',
+            ]))
+        with self.assertRaises(RuntimeError):
+            call_command('import_claims', f.name, stdout=StringIO())
+        # Whichever partition ran first, its claim should be resolved:
+        imported = EquivalenceClaim.objects.order_by('-id')[0]
+        assert 2 == EquivalenceClaim.objects.count()
+        assert ResolvedEquivalence.objects.filter(latest_claim=imported).exists()
+
+    def write_claims(self):
+        f = tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write('\n'.join([
+                'scheme_a,value_a,scheme_b,value_b',
+                'uk-area_id,gss:S14000003,wikidata-district-item,Q408547',
+            ]))
+        return f.name
+
+    def fail_resolving(self):
+        real_rebuild_components = import_claims.rebuild_components
+
+        def failing_rebuild_components():
+            raise RuntimeError('Resolving failed')
+
+        import_claims.rebuild_components = failing_rebuild_components
+        self.addCleanup(
+            setattr, import_claims, 'rebuild_components', real_rebuild_components)
+
+    def test_partition_error_is_not_replaced_by_resolving_error(self):
+        real_create_claims = import_claims.create_claims_for_scheme
+
+        def failing_create_claims(staging_table, scheme_id):
+            real_create_claims(staging_table, scheme_id)
+            raise RuntimeError('Partition failed')
+
+        import_claims.create_claims_for_scheme = failing_create_claims
+        self.addCleanup(
+            setattr, import_claims, 'create_claims_for_scheme', real_create_claims)
+        self.fail_resolving()
+        err = StringIO()
+        with self.assertRaises(RuntimeError) as context:
+            call_command('import_claims', self.write_claims(), stdout=StringIO(), stderr=err)
+        assert str(context.exception) == 'Partition failed'
+        assert 'Resolving the imported claims failed (Resolving failed)' in err.getvalue()
+
+    def test_resolving_error_fails_a_successful_import(self):
+        self.fail_resolving()
+        with self.assertRaises(CommandError) as context:
+            call_command('import_claims', self.write_claims(), stdout=StringIO())
+        assert 'rebuild_resolved_equivalences' in str(context.exception)
+
+
+class TestSchemeSnapshotVersions(FixtureMixin, TestCase):
+
+    def setUp(self):
+        super(TestSchemeSnapshotVersions, self).setUp()
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.snapshot_dir)
+        settings_override = override_settings(SCHEME_SNAPSHOT_DIR=self.snapshot_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.path = '/scheme/{0}'.format(self.area_scheme.id)
+        call_command('build_scheme_snapshots', stdout=StringIO())
+
+    def test_renaming_a_target_scheme_makes_snapshot_stale(self):
+        self.wd_district_scheme.name = 'wikidata-item'
+        self.wd_district_scheme.save()
+        response = Client().get(self.path)
+        assert not response.streaming
+        mapped = json.loads(response.content)['results']['gss:S17000017']
+        assert mapped[0]['scheme_name'] == 'wikidata-item'
+
+    def test_gzip_refused_with_zero_quality(self):
+        response = Client().get(self.path, HTTP_ACCEPT_ENCODING='gzip;q=0, deflate')
+        assert not response.has_header('Content-Encoding')
+        response = Client().get(self.path, HTTP_ACCEPT_ENCODING='*, gzip; q=0')
+        assert not response.has_header('Content-Encoding')
+        response = Client().get(self.path, HTTP_ACCEPT_ENCODING='*;q=0.5')
+        assert response['Content-Encoding'] == 'gzip'
+
+
+class TestChangesMaxWait(FixtureMixin, TestCase):
+
+    @override_settings(CHANGES_MAX_WAIT=5)
+    def test_wait_is_capped(self):
+        response = Client().get('/changes', {'wait': 6})
+        assert response.status_code == 400
+        assert 'between 0 and 5' in json.loads(response.content)['error']
+
+
+class TestClientReadsItsOwnWrites(FixtureMixin, LiveServerTestCase):
+
+    def test_last_claim_id_is_sent_back(self):
+        client = IDMappingClient(self.live_server_url, api_key=self.api_key.key)
+        self.addCleanup(client.close)
+        assert client.last_claim_id is None
+        client.claim(
+            (self.area_scheme.id, 'gss:S17000017'),
+            (self.wd_district_scheme.id, 'Q1529479'),
+            deprecated=True)
+        assert client.last_claim_id == EquivalenceClaim.objects.latest('id').id
+        client.create_claims([claim_data(
+            (self.area_scheme.id, 'gss:S17000017'), (self.wd_district_scheme.id, 'Q1'))])
+        assert client.last_claim_id == EquivalenceClaim.objects.latest('id').id
+        sent = []
+        original_request = http_client.HTTPConnection.request
+
+        def recording_request(conn, method, url, body=None, headers={}):
+            sent.append(headers.get('X-Last-Claim-Id'))
+            return original_request(conn, method, url, body, headers)
+
+        http_client.HTTPConnection.request = recording_request
+        self.addCleanup(setattr, http_client.HTTPConnection, 'request', original_request)
+        client.lookup('uk-area_id', 'gss:S17000017')
+        assert sent == ['{0}'.format(client.last_claim_id)]
+
+
+@override_settings(CHANGES_LISTEN=False, MAPPING_GRAPH_REFRESH_INTERVAL=0)
+class TestMappingGraphSwap(FixtureMixin, TransactionTestCase):
+
+    def setUp(self):
+        super(TestMappingGraphSwap, self).setUp()
+        self.addCleanup(unload_mapping_graph)
+        self.other_scheme = Scheme.objects.create(name='other')
+
+    def all_mappings(self, graph):
+        return [
+            list(graph.scheme_mappings(scheme.id)) for scheme in Scheme.objects.order_by('id')]
+
+    def test_refreshing_leaves_the_old_graph_unchanged(self):
+        old = MappingGraph()
+        old.load()
+        old_mappings = self.all_mappings(old)
+        new_identifier = Identifier.objects.create(scheme=self.other_scheme, value='new')
+        EquivalenceClaim.objects.create(
+            identifier_a=self.area_identifier, identifier_b=self.wd_identifier,
+            deprecated=True)
+        EquivalenceClaim.objects.create(
+            identifier_a=self.wd_identifier, identifier_b=new_identifier)
+        new = old.refresh()
+        assert new is not old
+        assert self.all_mappings(old) == old_mappings
+        assert old.find(self.other_scheme.id, 'new') is None
+        new_mappings = self.all_mappings(new)
+        assert new_mappings != old_mappings
+        # Changing a link that was added to the new graph copies it:
+        EquivalenceClaim.objects.create(
+            identifier_a=new_identifier, identifier_b=self.wd_identifier,
+            deprecated=True)
+        newest = new.refresh()
+        assert self.all_mappings(new) == new_mappings
+        # A graph that's been replaced can still be refreshed, without
+        # disturbing the one that replaced it:
+        assert self.all_mappings(old.refresh()) == self.all_mappings(newest)
+        assert self.all_mappings(new) == new_mappings
+
+    def test_a_request_uses_one_graph(self):
+        with override_settings(MAPPING_GRAPH=True):
+            with pinned_mapping_graph():
+                graph = mapping_graph()
+                EquivalenceClaim.objects.create(
+                    identifier_a=self.area_identifier, identifier_b=self.wd_identifier,
+                    deprecated=True)
+                assert mapping_graph() is graph
+            assert mapping_graph() is not graph
+
+    def test_a_forked_process_loads_its_own_graph(self):
+        with override_settings(MAPPING_GRAPH=True):
+            graph = mapping_graph()
+            assert mapping_graph() is graph
+            # As if this were a worker forked from the process that
+            # loaded it:
+            graph_module._graph_pid[0] = -1
+            assert mapping_graph() is not graph
+
+
+class TestClientRetries(TestCase):
+
+    def setUp(self):
+        # A server that answers the first request on each connection,
+        # keeping it alive, and then reads the next one and hangs up
+        # without responding, as if it had failed after receiving it:
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.addCleanup(self.server.close)
+        self.requests = []
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+        self.client = IDMappingClient(
+            'http://127.0.0.1:{0}'.format(self.server.getsockname()[1]),
+            retries=2, retry_delay=0)
+        self.addCleanup(self.client.close)
+        # Leave a kept-alive connection in the pool:
+        assert self.client.schemes() == []
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except socket.error:
+                return
+            for answer in (True, False):
+                data = b''
+                while b'\r\n\r\n' not in data:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+                if not data:
+                    break
+                self.requests.append(data.split(b' ', 1)[0])
+                if answer:
+                    body = b'{"results": []}'
+                    conn.sendall(
+                        b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                        b'Content-Length: ' + str(len(body)).encode('ascii') +
+                        b'\r\n\r\n' + body)
+            conn.close()
+
+    def test_claims_sent_in_full_are_not_retried(self):
+        with self.assertRaises((http_client.HTTPException, socket.error)):
+            self.client.create_claims([claim_data((1, 'a'), (2, 'b'))])
+        assert self.requests == [b'GET', b'POST']
+
+    def test_idempotent_requests_are_retried(self):
+        assert self.client.schemes() == []
+        assert self.requests == [b'GET', b'GET', b'GET']
+
+    def test_claims_with_an_idempotency_key_are_retried(self):
+        with self.assertRaises(KeyError):
+            # (The server's answer isn't what a claim gets, but it's
+            # only given once the claim is sent again:)
+            self.client.claim((1, 'a'), (2, 'b'), idempotency_key='k')['claim_created']
+        assert self.requests == [b'GET', b'POST', b'POST']
+
+    def test_closed_idle_connections_are_not_used(self):
+        conn = self.client.pool.idle[0]
+        conn.sock.shutdown(socket.SHUT_WR)
+        time.sleep(0.1)
+        # The server has hung up, which is noticed before the connection
+        # is used:
+        assert self.client.schemes() == []
+        assert self.requests == [b'GET', b'GET']
+
+
+class TestAsyncClientSkipUnchanged(FixtureMixin, LiveServerTestCase):
+
+    def test_skip_unchanged_is_passed_through(self):
+        import asyncio
+        from id_mappings_client.aio import AsyncIDMappingClient
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        client = AsyncIDMappingClient(self.live_server_url, api_key=self.api_key.key)
+        existing = (
+            (self.area_scheme.id, 'gss:S17000017'), (self.wd_district_scheme.id, 'Q1529479'))
+        loop.run_until_complete(asyncio.gather(
+            client.claim(*existing, skip_unchanged=True),
+            client.claim((self.area_scheme.id, 'new'), existing[1], skip_unchanged=True),
+            client.claim(*existing)))
+        assert EquivalenceClaim.objects.count() == 3
+        result = loop.run_until_complete(client.create_claims(
+            [claim_data(*existing)], skip_unchanged=True))
+        assert (result['claims_created'], result['claims_skipped']) == (0, 1)
+        loop.run_until_complete(client.close())
+
+
+class TestSchemeReferences(FixtureMixin, TestCase):
+
+    def test_renamed_and_deleted_schemes_are_seen_straight_away(self):
+        path = '/identifier/uk-area_id/gss:S17000017'
+        assert Client().get(path).status_code == 200
+        # As another process would, without touching this one's cache:
+        Scheme.objects.filter(pk=self.area_scheme.id).update(name='renamed')
+        assert Client().get(path).status_code == 404
+        assert Client().get('/identifier/renamed/gss:S17000017').status_code == 200
+        response = Client().get('/translate/renamed/{0}'.format(self.wd_district_scheme.id), {
+            'value': 'gss:S17000017'})
+        assert json.loads(response.content)['results'] == {'gss:S17000017': ['Q1529479']}
+        Scheme.objects.filter(pk=self.wd_district_scheme.id).delete()
+        assert Client().get(
+            '/translate/renamed/{0}'.format(self.wd_district_scheme.id),
+            {'value': 'gss:S17000017'}).status_code == 404
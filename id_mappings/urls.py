@@ -7,9 +7,31 @@ urlpatterns = [
         r'^identifier/(?P<scheme>.+?)/(?P<value>.*)$',
         views.IdentifierLookupView.as_view(),
         name='identifier-lookup'),
+    url(r'^identifiers/lookup/?$',
+        views.BatchIdentifierLookupView.as_view(),
+        name='identifier-batch-lookup'),
+    url(
+        r'^cluster/(?P<scheme>.+?)/(?P<value>.*)$',
+        views.ClusterView.as_view(),
+        name='cluster'),
     url(r'^equivalence-claim/?$',
         views.EquivalenceClaimCreateView.as_view(),
         name='equivalence-create'),
+    url(r'^equivalence-claims/bulk/?$',
+        views.BulkEquivalenceClaimCreateView.as_view(),
+        name='equivalence-bulk-create'),
+    url(r'^translate/(?P<from_scheme>[^/]+)/(?P<to_scheme>[^/]+)/?$',
+        views.TranslateView.as_view(),
+        name='translate'),
+    url(r'^changes/?$',
+        views.ChangesView.as_view(),
+        name='changes'),
+    url(r'^metrics/?$',
+        views.MetricsView.as_view(),
+        name='metrics'),
+    url(r'^cache-stats/?$',
+        views.LookupCacheStatsView.as_view(),
+        name='cache-stats'),
     url(r'^scheme/?$',
         views.SchemeListView.as_view(),
         name='scheme-list'),
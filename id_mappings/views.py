@@ -1,91 +1,495 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from collections import defaultdict, namedtuple, OrderedDict
+import calendar
+from collections import OrderedDict
+from datetime import datetime
+from functools import reduce
+import hashlib
+import io
+from itertools import islice
+import operator
+from operator import itemgetter
 import json
 import re
+import time
 
-from django.db.models import Prefetch, Q
-from django.http import JsonResponse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Prefetch, Q
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import six
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers, quote_etag
+from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.functional import cached_property
+from django.utils.http import http_date
 from django.views.generic import View, DetailView, ListView
 
-from .models import EquivalenceClaim, Identifier, Scheme
+from . import changes, lookup_cache, metrics, replicas
+from .changes import reserve_transaction_id
+from .graph import mapping_graph, pinned_mapping_graph
+from .models import (
+    EquivalenceClaim, IdempotentRequest, Identifier, ResolvedEquivalence, Scheme,
+    names_version_sql)
+from .queries import (
+    identifier_ids_for_pairs, lookup_data, lookup_history, lookup_results, lookup_results_as_of,
+    scheme_mappings, scheme_page_values, translate_values)
+from .renderers import (
+    CONTENT_TYPES, JSON_FORMATS, STREAM_BUFFER_SIZE, NotAcceptable, accepts_encoding,
+    negotiate_format, render_json, render_rows, stream_json_results)
+from .snapshots import current_snapshot_path, snapshot_dir
 from api_keys.views import RequireAPIKeyMixin
 
 
-IdentifierFromClaim = namedtuple(
-    'IdentifierFromClaim',
-    ['identifier', 'deprecated', 'created', 'comment'])
+def scheme_lookup(scheme_kwarg, prefix=''):
+    '''Return the filter for the scheme given by ID or name in a URL
 
+    prefix is put before the field names, e.g. to filter identifiers
+    by their scheme.'''
+    if re.search(r'^\d+$', scheme_kwarg):
+        return {prefix + 'pk': int(scheme_kwarg)}
+    return {prefix + 'name': scheme_kwarg}
 
-class IdentifierLookupView(DetailView):
 
-    @cached_property
-    def scheme_object(self):
-        scheme_kwarg = self.kwargs['scheme']
-        if re.search('^\d+$', scheme_kwarg):
-            return Scheme.objects.get(pk=int(scheme_kwarg))
+def get_schemes_or_404(*scheme_kwargs):
+    '''Return the schemes given by ID or name in a URL, with one query
+
+    These aren't cached: a process couldn't tell when another one had
+    renamed or deleted a scheme.'''
+    lookups = [scheme_lookup(scheme_kwarg) for scheme_kwarg in scheme_kwargs]
+    schemes = list(Scheme.objects.filter(
+        reduce(operator.or_, (Q(**lookup) for lookup in lookups))))
+    result = []
+    for lookup in lookups:
+        field, wanted = list(lookup.items())[0]
+        for scheme in schemes:
+            if getattr(scheme, field) == wanted:
+                result.append(scheme)
+                break
         else:
-            return Scheme.objects.get(name=scheme_kwarg)
+            raise Http404('No such scheme')
+    return result
 
-    def get_object(self):
+
+def parse_as_of(value):
+    '''Return the time an as_of parameter gives, or raise ValueError
+
+    That's an ISO 8601 timestamp, which is in UTC unless it has an
+    offset, or a date, which means the end of that day in UTC.'''
+    try:
+        as_of = parse_datetime(value)
+        if as_of is None:
+            date = parse_date(value)
+            if date is not None:
+                as_of = datetime.combine(date, datetime.max.time())
+    except ValueError:
+        as_of = None
+    if as_of is None:
+        raise ValueError('as_of must be an ISO 8601 timestamp or date')
+    if timezone.is_naive(as_of):
+        as_of = timezone.make_aware(as_of, timezone.utc)
+    return as_of
+
+
+class NegotiatedFormatMixin(object):
+    '''Render responses in the format the client asked for
+
+    See renderers.py for the formats; views that can return more than
+    the JSON formats should list them in formats.'''
+
+    formats = JSON_FORMATS
+
+    stream_buffer_size = STREAM_BUFFER_SIZE
+
+    @cached_property
+    def response_format(self):
+        return negotiate_format(self.request, self.formats)
+
+    @cached_property
+    def pretty(self):
+        return bool(self.request.GET.get('pretty'))
+
+    @property
+    def representation(self):
+        '''A string that differs between each way a response can be rendered'''
+        return '{0}{1}'.format(self.response_format, '-pretty' if self.pretty else '')
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            self.response_format
+        except NotAcceptable as e:
+            return render_json({'error': six.text_type(e)}, status=406)
+        response = super(NegotiatedFormatMixin, self).dispatch(request, *args, **kwargs)
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    def render(self, data, status=200):
+        return render_json(data, self.response_format, self.pretty, status)
+
+    def render_error(self, message, status=400):
+        return render_json({'error': message}, pretty=self.pretty, status=status)
+
+    def stream_results(self, items, extra=()):
+        return StreamingHttpResponse(
+            stream_json_results(
+                items, extra, buffer_size=self.stream_buffer_size,
+                response_format=self.response_format),
+            content_type=CONTENT_TYPES[self.response_format])
+
+    def render_rows(self, header, rows, streaming=False):
+        return render_rows(header, rows, self.response_format, streaming=streaming)
+
+
+class AsOfMixin(object):
+    '''Let requests ask for the mappings there were at a past time
+
+    If the as_of parameter is given (see parse_as_of), self.as_of is
+    the time it gives, and views using this should resolve the claims
+    made up to then rather than read the current mappings; it's None
+    otherwise. An invalid as_of is a 400 error. This should come
+    before any mixins that need self.as_of.'''
+
+    @cached_property
+    def as_of(self):
+        value = self.request.GET.get('as_of')
+        return None if value is None else parse_as_of(value)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            self.as_of
+        except ValueError as e:
+            return self.render_error(six.text_type(e))
+        return super(AsOfMixin, self).dispatch(request, *args, **kwargs)
+
+
+class ReadFromReplicaMixin(object):
+    '''Send the queries made for this view to a replica, if there are any
+
+    This should come first in the view's bases, so that everything
+    done by the other mixins reads from the same database, and from
+    the same version of the mapping graph.'''
+
+    def dispatch(self, request, *args, **kwargs):
+        with replicas.reading_from(replicas.choose_database(request)), \
+                pinned_mapping_graph():
+            return super(ReadFromReplicaMixin, self).dispatch(request, *args, **kwargs)
+
+
+class ConditionalGetMixin(object):
+    '''Answer conditional GET requests without building the response
+
+    Views using this should define get_etag to return a string that
+    changes whenever the response might, and which is much cheaper
+    to find than the response itself, and can define
+    get_last_modified too. They should also use NegotiatedFormatMixin,
+    so that each format gets its own ETag. If the request's
+    validators match, a 304 Not Modified response is returned
+    straight away.'''
+
+    def get_etag(self):
+        raise NotImplementedError
+
+    def get_last_modified(self):
+        return None
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super(ConditionalGetMixin, self).dispatch(request, *args, **kwargs)
+        etag = quote_etag('{0}-{1}'.format(self.get_etag(), self.representation))
+        last_modified = self.get_last_modified()
+        last_modified_timestamp = None
+        if last_modified is not None:
+            last_modified_timestamp = calendar.timegm(last_modified.utctimetuple())
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified_timestamp)
+        if response is None:
+            response = super(ConditionalGetMixin, self).dispatch(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified_timestamp is not None:
+                response['Last-Modified'] = http_date(last_modified_timestamp)
+        return response
+
+
+class CachedResponseMixin(object):
+    '''Serve GET responses from the lookup cache where possible
+
+    Views using this should define get_cache_key to return the key
+    to cache their response under (see lookup_cache.response_key), or
+    None if it shouldn't be cached, and use ConditionalGetMixin too.
+    The key that's actually used also includes get_etag, which is
+    checked against the database on every request: the generations
+    are only bumped in the cache of the process that made a change,
+    so on their own they can't stop another process serving a
+    response that's out of date. Anything that can change a cached
+    response, including scheme names, must be in get_etag for that
+    reason. Successful responses are stored
+    with their ETag, so that conditional requests can be answered
+    from the cache too.'''
+
+    def get_cache_key(self):
+        raise NotImplementedError
+
+    def dispatch(self, request, *args, **kwargs):
+        cache_key = None
+        if request.method == 'GET':
+            cache_key = self.get_cache_key()
+        if cache_key is None:
+            return super(CachedResponseMixin, self).dispatch(request, *args, **kwargs)
+        cache_key = lookup_cache.make_key(cache_key, self.get_etag())
+        cache = lookup_cache.lookup_cache()
+        cached = cache.get(cache_key)
+        lookup_cache.record_hit(cached is not None)
+        if cached is not None:
+            etag, content_type, content = cached
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = HttpResponse(content, content_type=content_type)
+            response['ETag'] = etag
+            patch_vary_headers(response, ['Accept'])
+            return response
+        response = super(CachedResponseMixin, self).dispatch(request, *args, **kwargs)
+        # A response from a replica that's behind is cached under its
+        # older ETag, so it's only ever served to requests that would
+        # get the same response from that replica anyway:
+        if response.status_code == 200 and not response.streaming:
+            cache.set(
+                cache_key, (response['ETag'], response['Content-Type'], response.content))
+        return response
+
+
+class IdentifierFromURLMixin(object):
+    '''Find the identifier from the scheme and value in the URL
+
+    Its scheme, and the names_version of every scheme (for ETags),
+    are read in the same query.'''
+
+    @cached_property
+    def identifier(self):
         return get_object_or_404(
-            Identifier, scheme=self.scheme_object, value=self.kwargs['value'])
+            Identifier.objects.select_related('scheme').annotate(
+                scheme_names_version=names_version_sql()),
+            value=self.kwargs['value'],
+            **scheme_lookup(self.kwargs['scheme'], prefix='scheme__'))
+
+    def get_object(self):
+        return self.identifier
+
+
+class IdentifierLookupView(
+        ReadFromReplicaMixin, NegotiatedFormatMixin, AsOfMixin, CachedResponseMixin,
+        ConditionalGetMixin, IdentifierFromURLMixin, DetailView):
+
+    def get_cache_key(self):
+        # Transitive lookups depend on the whole component, which a
+        # claim about any identifier in it might change:
+        if self.request.GET.get('transitive') or self.as_of is not None:
+            return None
+        return lookup_cache.response_key(
+            lookup_cache.identifier_generation_key(
+                self.kwargs['scheme'], self.kwargs['value']),
+            'lookup-archived' if self.include_archived else 'lookup',
+            self.representation)
+
+    def get_etag(self):
+        # Claims moved to the archive don't change last_claim_id, but
+        # do change the history, so archived_claim_count is included.
+        # Claims made later can still be dated before as_of, so a
+        # response for a past time changes with last_claim_id too:
+        variant = '-archived' if self.include_archived else ''
+        if self.as_of is not None:
+            variant += '-as-of-{0}'.format(self.as_of.isoformat())
+        if self.request.GET.get('transitive'):
+            # A change to any identifier in the component might change
+            # which identifiers are in it:
+            component_id = self.identifier.component_id
+            last_claim_id = self.identifier.last_claim_id
+            if component_id is not None:
+                last_claim_id = Identifier.objects.filter(
+                    component_id=component_id
+                ).aggregate(Max('last_claim_id'))['last_claim_id__max']
+            return 'identifier-{0}-component-{1}-{2}-{3}-{4}{5}'.format(
+                self.identifier.id, component_id, last_claim_id,
+                self.identifier.archived_claim_count,
+                self.identifier.scheme_names_version, variant)
+        return 'identifier-{0}-{1}-{2}-{3}{4}'.format(
+            self.identifier.id, self.identifier.last_claim_id,
+            self.identifier.archived_claim_count,
+            self.identifier.scheme_names_version, variant)
 
     @cached_property
-    def equivalent_identifiers_from_claims(self):
-        return [
-            IdentifierFromClaim(
-                identifier=ec.other_identifier(self.get_object()),
-                deprecated=ec.deprecated,
-                created=ec.created,
-                comment=ec.comment,
-            )
-            for ec in EquivalenceClaim.objects.filter(
-                Q(identifier_a=self.object) |
-                Q(identifier_b=self.object)
-            ).order_by('created')
-        ]
+    def include_archived(self):
+        return bool(self.request.GET.get('include_archived'))
+
+    def get(self, request, *args, **kwargs):
+        if self.as_of is not None and request.GET.get('transitive'):
+            return self.render_error("Transitive lookups can't be made as_of a past time")
+        return super(IdentifierLookupView, self).get(request, *args, **kwargs)
 
     @cached_property
-    def best_equivalent_identifiers(self):
-        resolved = OrderedDict()
-        for ifc in self.equivalent_identifiers_from_claims:
-            resolved[ifc.identifier] = ifc.deprecated
-        return [identifier for identifier, deprecated in resolved.items()
-                if not deprecated]
+    def results(self):
+        if self.as_of is not None:
+            return lookup_results_as_of([self.object.id], self.as_of)[self.object.id]
+        if self.request.GET.get('transitive'):
+            # Include everything in the identifier's component, not
+            # just the identifiers it's directly linked to:
+            return [
+                identifier.as_json()
+                for identifier in self.object.component_identifiers()
+                if identifier != self.object
+            ]
+        graph = mapping_graph()
+        if graph is not None and graph.covers(self.object.last_claim_id):
+            results = graph.mapped_identifiers(self.object.id)
+            if results is not None:
+                return results
+        return lookup_results([self.object.id])[self.object.id]
 
     def get_context_data(self, **kwargs):
+        # The number of queries doesn't depend on the length of the
+        # identifier's history, which is read as tuples, with the
+        # other identifier and its scheme from the same query:
         context = super(IdentifierLookupView, self).get_context_data(**kwargs)
         context['data'] = {
-            'results': [i.as_json() for i in self.best_equivalent_identifiers],
-            'history': [
-                {
-                    'identifier': ifc.identifier.as_json(),
-                    'created': ifc.created.isoformat(),
-                    'deprecated': ifc.deprecated,
-                    'comment': ifc.comment,
-                }
-                for ifc in self.equivalent_identifiers_from_claims
-            ]
+            'results': self.results,
+            'history': lookup_history(
+                [self.object.id], self.include_archived, self.as_of)[self.object.id],
         }
         return context
 
     def render_to_response(self, context, **response_kwargs):
-        return JsonResponse(context['data'], json_dumps_params={'indent': 4})
+        return self.render(context['data'])
+
+
+class ClusterView(
+        ReadFromReplicaMixin, NegotiatedFormatMixin, IdentifierFromURLMixin, DetailView):
+    '''Return every identifier transitively equivalent to one identifier'''
+
+    def render_to_response(self, context, **response_kwargs):
+        return self.render({
+            'results': [
+                identifier.as_json()
+                for identifier in self.object.component_identifiers()
+            ]
+        })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class BatchIdentifierLookupView(ReadFromReplicaMixin, NegotiatedFormatMixin, View):
+    '''Look up many identifiers at once
+
+    The request body should be a JSON object whose "identifiers" are
+    a list of objects with a scheme (as an ID or name) and a value.
+    The response has an entry for each of them, in the same position,
+    which is in the form returned by IdentifierLookupView, or null if
+    there's no such identifier. The number of queries doesn't depend
+    on the number of identifiers.'''
+
+    http_method_names = 'post'
+
+    max_identifiers = 5000
+
+    def post(self, request, *args, **kwargs):
+        try:
+            wanted = self.parse_identifiers(request)
+        except ValueError as e:
+            return self.render_error(six.text_type(e))
+        schemes = self.scheme_ids(scheme for scheme, _ in wanted)
+        pair_to_id = identifier_ids_for_pairs(
+            (schemes[scheme], value) for scheme, value in wanted
+            if scheme in schemes)
+        identifier_ids = [
+            pair_to_id.get((schemes.get(scheme), value))
+            for scheme, value in wanted
+        ]
+        data = lookup_data(set(i for i in identifier_ids if i is not None))
+        return self.render({'results': [data.get(i) for i in identifier_ids]})
+
+    def parse_identifiers(self, request):
+        try:
+            posted_data = json.loads(request.body.decode('utf-8'))
+            identifiers = posted_data['identifiers']
+        except (ValueError, KeyError, TypeError):
+            raise ValueError('The body must be a JSON object with a list of identifiers')
+        if not isinstance(identifiers, list):
+            raise ValueError('identifiers must be a list')
+        if len(identifiers) > self.max_identifiers:
+            raise ValueError('At most {0} identifiers can be looked up at once'.format(
+                self.max_identifiers))
+        wanted = []
+        for position, id_data in enumerate(identifiers):
+            try:
+                scheme = id_data['scheme'] if 'scheme' in id_data else id_data['scheme_id']
+                value = id_data['value']
+            except (KeyError, TypeError):
+                raise ValueError(
+                    'Identifier {0} must have a scheme and a value'.format(position))
+            if not isinstance(value, six.string_types):
+                raise ValueError('Identifier {0} has a value that is not a string'.format(
+                    position))
+            wanted.append((six.text_type(scheme), value))
+        return wanted
+
+    def scheme_ids(self, schemes):
+        '''Return a dictionary mapping scheme IDs and names to scheme IDs'''
+        schemes = set(schemes)
+        numeric = [int(s) for s in schemes if re.search(r'^\d+$', s)]
+        result = {}
+        for scheme_id, name in Scheme.objects.filter(
+                Q(pk__in=numeric) | Q(name__in=schemes)).values_list('id', 'name'):
+            for key in (six.text_type(scheme_id), name):
+                if key in schemes:
+                    result[key] = scheme_id
+        return result
 
 
 @method_decorator(csrf_exempt, name='dispatch')
-class EquivalenceClaimCreateView(RequireAPIKeyMixin, View):
+class EquivalenceClaimCreateView(NegotiatedFormatMixin, RequireAPIKeyMixin, View):
+    '''Create an equivalence claim
+
+    With skip_unchanged=1, the claim isn't recorded if it wouldn't
+    change the state of the pair (i.e. it deprecates a deprecated pair
+    or adds a live one); claim_created in the response says whether it
+    was. If the request has an Idempotency-Key header, a retry of it
+    with the same key gets the first response back, with an
+    Idempotent-Replayed header, rather than recording the claim again.'''
 
     http_method_names = 'post'
 
     def post(self, request, *args, **kwargs):
-        posted_data = json.loads(request.body)
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        self.claim_id = None
+        if not key:
+            response = self.render(*self.create_claim())
+            replicas.record_write(response, self.claim_id)
+            return response
+        if len(key) > IdempotentRequest._meta.get_field('key').max_length:
+            return self.render_error('The Idempotency-Key header is too long')
+        request_hash = hashlib.sha256(
+            request.get_full_path().encode('utf-8') + b'\n' + request.body).hexdigest()
+        with transaction.atomic():
+            record, new = IdempotentRequest.objects.start(self.api_key, key, request_hash)
+            if new:
+                data, status = self.create_claim()
+                record.status = status
+                record.response = json.dumps(data)
+                record.save()
+        if record.request_hash != request_hash:
+            return self.render_error(
+                'The Idempotency-Key header was used for a different request', status=422)
+        response = self.render(json.loads(record.response), status=record.status)
+        if not new:
+            response['Idempotent-Replayed'] = 'true'
+        replicas.record_write(response, self.claim_id)
+        return response
+
+    def create_claim(self):
+        '''Record the posted claim, and return the response's data and status'''
+        posted_data = json.loads(self.request.body)
         deprecated = posted_data.get('deprecated', False)
         comment = posted_data.get('comment', '')
         id_data_a = posted_data['identifier_a']
@@ -94,14 +498,20 @@ class EquivalenceClaimCreateView(RequireAPIKeyMixin, View):
         scheme_b_id = id_data_b['scheme_id']
         scheme_a = get_object_or_404(Scheme, pk=scheme_a_id)
         scheme_b = get_object_or_404(Scheme, pk=scheme_b_id)
-        a, created_a = Identifier.objects.get_or_create(
-            scheme=scheme_a, value=id_data_a['value'])
-        b, created_b = Identifier.objects.get_or_create(
-            scheme=scheme_b, value=id_data_b['value'])
-        EquivalenceClaim.objects.create(
-            identifier_a=a, identifier_b=b, deprecated=deprecated, comment=comment
-        )
-        return JsonResponse(
+        a, created_a = Identifier.objects.upsert(scheme_a, id_data_a['value'])
+        b, created_b = Identifier.objects.upsert(scheme_b, id_data_b['value'])
+        if self.request.GET.get('skip_unchanged'):
+            # If the claim is skipped, the client can still read back
+            # the one that gave the pair its state:
+            self.claim_id = ResolvedEquivalence.objects.filter(
+                identifier_a_id=min(a.id, b.id), identifier_b_id=max(a.id, b.id),
+                deprecated=deprecated).values_list('latest_claim_id', flat=True).first()
+        unchanged = self.claim_id is not None
+        if not unchanged:
+            self.claim_id = EquivalenceClaim.objects.create(
+                identifier_a=a, identifier_b=b, deprecated=deprecated, comment=comment
+            ).id
+        return (
             {
                 'identifier_a': {
                     'created': created_a
@@ -109,69 +519,485 @@ class EquivalenceClaimCreateView(RequireAPIKeyMixin, View):
                 'identifier_b': {
                     'created': created_b
                 },
+                'claim_created': not unchanged,
             },
-            status=201,
-            json_dumps_params={'indent': 4},
+            200 if unchanged else 201,
         )
 
 
-class SchemeListView(ListView):
+@method_decorator(csrf_exempt, name='dispatch')
+class BulkEquivalenceClaimCreateView(NegotiatedFormatMixin, RequireAPIKeyMixin, View):
+    '''Create many equivalence claims from an NDJSON request body
 
-    queryset = Scheme.objects.order_by('id')
+    Each line of the body should be a JSON object in the same form as
+    is posted to EquivalenceClaimCreateView. The body is read and
+    processed a chunk of lines at a time, so it never has to be held
+    in memory in full. As with EquivalenceClaimCreateView,
+    skip_unchanged=1 leaves out claims that wouldn't change the state
+    of their pair, which are counted in claims_skipped.'''
 
-    def render_to_response(self, context, **response_kwargs):
-        return JsonResponse(
+    http_method_names = 'post'
+
+    chunk_size = 1000
+
+    def post(self, request, *args, **kwargs):
+        self.known_scheme_ids = set()
+        self.unknown_scheme_ids = set()
+        self.errors = []
+        self.claims_created = 0
+        self.claims_skipped = 0
+        self.identifiers_created = 0
+        self.last_claim_id = None
+        numbered_lines = enumerate(request, start=1)
+        while True:
+            chunk = list(islice(numbered_lines, self.chunk_size))
+            if not chunk:
+                break
+            self.process_chunk(chunk)
+        response = self.render(
             {
-                'results': [
-                    {
-                        'id': scheme.id,
-                        'name': scheme.name,
-                    }
-                    for scheme in context['object_list']
-                ]
+                'claims_created': self.claims_created,
+                'claims_skipped': self.claims_skipped,
+                'identifiers_created': self.identifiers_created,
+                'errors': self.errors,
             },
-            json_dumps_params={'indent': 4},
+            status=201,
         )
+        replicas.record_write(response, self.last_claim_id)
+        return response
+
+    def parse_line(self, line):
+        posted_data = json.loads(line.decode('utf-8'))
+        id_data_a = posted_data['identifier_a']
+        id_data_b = posted_data['identifier_b']
+        for id_data in (id_data_a, id_data_b):
+            if not isinstance(id_data['value'], six.string_types):
+                raise ValueError('identifier values must be strings')
+        return {
+            'scheme_a_id': int(id_data_a['scheme_id']),
+            'value_a': id_data_a['value'],
+            'scheme_b_id': int(id_data_b['scheme_id']),
+            'value_b': id_data_b['value'],
+            'deprecated': bool(posted_data.get('deprecated', False)),
+            'comment': posted_data.get('comment', ''),
+        }
+
+    def check_schemes(self, scheme_ids):
+        # Only check each scheme against the database once per request:
+        unchecked = set(scheme_ids) - self.known_scheme_ids - self.unknown_scheme_ids
+        if unchecked:
+            found = set(Scheme.objects.filter(
+                pk__in=unchecked).values_list('pk', flat=True))
+            self.known_scheme_ids.update(found)
+            self.unknown_scheme_ids.update(unchecked - found)
+
+    def process_chunk(self, chunk):
+        parsed = []
+        errors = []
+        for line_number, line in chunk:
+            if not line.strip():
+                continue
+            try:
+                parsed.append((line_number, self.parse_line(line)))
+            except (ValueError, KeyError, TypeError) as e:
+                errors.append({
+                    'line': line_number,
+                    'error': 'Malformed claim: {0}'.format(e),
+                })
+        self.check_schemes(
+            scheme_id
+            for _, claim_data in parsed
+            for scheme_id in (claim_data['scheme_a_id'], claim_data['scheme_b_id']))
+        valid = []
+        for line_number, claim_data in parsed:
+            for scheme_id in (claim_data['scheme_a_id'], claim_data['scheme_b_id']):
+                if scheme_id in self.unknown_scheme_ids:
+                    errors.append({
+                        'line': line_number,
+                        'error': 'Unknown scheme ID: {0}'.format(scheme_id),
+                    })
+                    break
+            else:
+                valid.append(claim_data)
+        self.errors += sorted(errors, key=itemgetter('line'))
+        if not valid:
+            return
+        with transaction.atomic():
+            pair_to_id, identifiers_created = Identifier.objects.upsert_many(
+                (claim_data[scheme_key], claim_data[value_key])
+                for claim_data in valid
+                for scheme_key, value_key in (
+                    ('scheme_a_id', 'value_a'), ('scheme_b_id', 'value_b'))
+            )
+            claims = [
+                EquivalenceClaim(
+                    identifier_a_id=pair_to_id[
+                        (claim_data['scheme_a_id'], claim_data['value_a'])],
+                    identifier_b_id=pair_to_id[
+                        (claim_data['scheme_b_id'], claim_data['value_b'])],
+                    deprecated=claim_data['deprecated'],
+                    comment=claim_data['comment'],
+                    api_key=self.api_key,
+                )
+                for claim_data in valid
+            ]
+            if self.request.GET.get('skip_unchanged'):
+                claims = self.changing_claims(claims)
+            if claims:
+                reserve_transaction_id()
+                EquivalenceClaim.objects.bulk_create(claims)
+                ResolvedEquivalence.objects.record_claims(claims)
+                self.last_claim_id = max(claim.id for claim in claims)
+        self.identifiers_created += identifiers_created
+        self.claims_skipped += len(valid) - len(claims)
+        self.claims_created += len(claims)
+
+    def changing_claims(self, claims):
+        '''Return the claims that change the state of their pair
+
+        Each is compared with the pair's resolved state, or with the
+        claim before it in the chunk about the same pair.'''
+        pairs = set(
+            (min(claim.identifier_a_id, claim.identifier_b_id),
+             max(claim.identifier_a_id, claim.identifier_b_id))
+            for claim in claims)
+        state = {
+            (a, b): deprecated
+            for a, b, deprecated in ResolvedEquivalence.objects.filter(reduce(
+                operator.or_, (
+                    Q(identifier_a_id=a, identifier_b_id=b) for a, b in pairs))
+            ).values_list('identifier_a_id', 'identifier_b_id', 'deprecated')
+        }
+        changing = []
+        for claim in claims:
+            pair = (min(claim.identifier_a_id, claim.identifier_b_id),
+                    max(claim.identifier_a_id, claim.identifier_b_id))
+            if state.get(pair) != claim.deprecated:
+                state[pair] = claim.deprecated
+                changing.append(claim)
+        return changing
+
 
+class SchemeListView(
+        ReadFromReplicaMixin, NegotiatedFormatMixin, ConditionalGetMixin, ListView):
 
-class IdentifiersForSchemeView(View):
+    queryset = Scheme.objects.order_by('id')
+
+    @cached_property
+    def scheme_summary(self):
+        return Scheme.objects.aggregate(
+            count=Count('id'), max_id=Max('id'), last_modified=Max('last_modified'))
+
+    def get_etag(self):
+        summary = self.scheme_summary
+        return 'schemes-{0}-{1}-{2}'.format(
+            summary['count'], summary['max_id'],
+            summary['last_modified'] and summary['last_modified'].isoformat())
+
+    def get_last_modified(self):
+        return self.scheme_summary['last_modified']
+
+    def render_to_response(self, context, **response_kwargs):
+        return self.render({
+            'results': [
+                {
+                    'id': scheme.id,
+                    'name': scheme.name,
+                }
+                for scheme in context['object_list']
+            ]
+        })
+
+
+class IdentifiersForSchemeView(
+        ReadFromReplicaMixin, NegotiatedFormatMixin, AsOfMixin, CachedResponseMixin,
+        ConditionalGetMixin, View):
+
+    formats = JSON_FORMATS + ('csv', 'tsv')
+
+    max_limit = 10000
+
+    def get_cache_key(self):
+        if self.request.GET.get('stream') or self.as_of is not None:
+            return None
+        if snapshot_dir() and self.is_snapshot_request():
+            # These are served from snapshot files instead:
+            return None
+        return lookup_cache.response_key(
+            lookup_cache.scheme_generation_key(self.kwargs['scheme']),
+            'scheme',
+            self.representation,
+            sorted(self.request.GET.items()))
+
+    @cached_property
+    def scheme(self):
+        # Any claim that changes the mappings from this scheme touches
+        # an identifier in it, and the highest last_claim_id of those
+        # comes from the end of the (scheme, last_claim_id) index. The
+        # names of the schemes they map to are in the response too:
+        return get_object_or_404(
+            Scheme.objects.with_last_claim_ids().annotate(
+                names_version=names_version_sql()),
+            pk=self.kwargs['scheme'])
+
+    def get_etag(self):
+        return 'scheme-{0}-{1}-{2}{3}'.format(
+            self.scheme.id, self.scheme.last_claim_id or 0, self.scheme.names_version,
+            '' if self.as_of is None else '-as-of-{0}'.format(self.as_of.isoformat()))
 
     def get(self, request, *args, **kwargs):
-        scheme = get_object_or_404(Scheme, pk=kwargs['scheme'])
-        identifier_to_resolved_identifiers = defaultdict(OrderedDict)
-        # Find any claims with identifiers from that scheme, in order
-        # of creation:
-        for ec in EquivalenceClaim.objects.filter(
-                Q(identifier_a__scheme=scheme) |
-                Q(identifier_b__scheme=scheme)
-            ).select_related('identifier_a__scheme', 'identifier_b__scheme').order_by('created'):
-            # There might be an identifier with this scheme on either
-            # or both sides of the equivalence claim, so try both:
-            for identifier in (ec.identifier_a, ec.identifier_b):
-                other_identifier = ec.other_identifier(identifier)
-                if identifier.scheme == scheme:
-                    other_ifc = IdentifierFromClaim(
-                        identifier=other_identifier,
-                        deprecated=ec.deprecated,
-                        created=ec.created,
-                        comment=ec.comment,
-                    )
-                    # The claims have been ordered by creation
-                    # timestamp, so this wil leave us with the latest
-                    # deprecation status:
-                    identifier_to_resolved_identifiers[identifier.value][other_ifc.identifier] = other_ifc.deprecated
-        # Filter out any deprecated relationships in the response:
-        return JsonResponse(
-            {
-                'results': {
-                    identifier:
-                    [
-                        other_scheme_identifier.as_json()
-                        for other_scheme_identifier, deprecated
-                        in mapped_identifiers.items() if not deprecated
-                    ]
-                    for identifier, mapped_identifiers
-                    in identifier_to_resolved_identifiers.items()
+        scheme = self.scheme
+        try:
+            self.parse_filters(request)
+        except ValueError as e:
+            return self.render_error(six.text_type(e))
+        if self.is_snapshot_request():
+            response = self.snapshot_response(scheme)
+            if response is not None:
+                return response
+        streaming = bool(request.GET.get('stream'))
+        mappings = self.page_mappings(scheme, chunked=streaming)
+        if self.response_format not in JSON_FORMATS:
+            response = self.render_rows(
+                ['value', 'scheme_id', 'scheme_name', 'mapped_value'],
+                (
+                    (value, identifier['scheme_id'], identifier['scheme_name'],
+                     identifier['value'])
+                    for value, mapped_identifiers in mappings
+                    for identifier in mapped_identifiers
+                ),
+                streaming=streaming)
+            if self.next_after is not None:
+                next_parameters = request.GET.copy()
+                next_parameters['after'] = self.next_after
+                response['Link'] = '<{0}>; rel="next"'.format(
+                    request.build_absolute_uri('?' + next_parameters.urlencode()))
+            return response
+        if streaming:
+            extra = [('next', self.next_after)] if self.limit is not None else []
+            return self.stream_results(mappings, extra)
+        # Deprecated relationships have already been filtered out of
+        # the mapped identifiers:
+        data = {'results': OrderedDict(mappings)}
+        if self.limit is not None:
+            data['next'] = self.next_after
+        return self.render(data)
+
+    def is_snapshot_request(self):
+        '''Return whether this is for a full dump in the snapshots' format'''
+        return (
+            self.response_format == 'json' and not self.pretty and
+            not any(
+                parameter in self.request.GET
+                for parameter in ('after', 'limit', 'target_scheme', 'as_of')))
+
+    def snapshot_response(self, scheme):
+        '''Return a response from the scheme's current snapshot, if it has one'''
+        accepts_gzip = accepts_encoding(self.request, 'gzip')
+        path = current_snapshot_path(scheme, gzipped=accepts_gzip)
+        if path is None:
+            return None
+        if settings.SCHEME_SNAPSHOT_SENDFILE:
+            response = HttpResponse(content_type='application/json')
+            response['X-Sendfile'] = path
+        else:
+            try:
+                response = FileResponse(io.open(path, 'rb'), content_type='application/json')
+            except IOError:
+                # It's been replaced by a newer snapshot since it was found:
+                return None
+        if accepts_gzip:
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ['Accept-Encoding'])
+        return response
+
+    def parse_filters(self, request):
+        self.after = request.GET.get('after')
+        self.limit = None
+        self.target_scheme_id = None
+        if 'limit' in request.GET:
+            try:
+                self.limit = int(request.GET['limit'])
+            except ValueError:
+                raise ValueError('limit must be an integer')
+            if not (1 <= self.limit <= self.max_limit):
+                raise ValueError('limit must be between 1 and {0}'.format(
+                    self.max_limit))
+        if 'target_scheme' in request.GET:
+            try:
+                self.target_scheme_id = int(request.GET['target_scheme'])
+            except ValueError:
+                raise ValueError('target_scheme must be a scheme ID')
+
+    def page_mappings(self, scheme, chunked):
+        '''Return an iterator over the requested page of mappings
+
+        If there's a limit, the range of identifier values in the page
+        is found first, so that the mappings query is bounded by it;
+        self.next_after is set to the value to pass as after to get
+        the next page, if there is one.'''
+        self.next_after = None
+        up_to = None
+        if self.limit is not None:
+            values = scheme_page_values(
+                scheme.id, self.limit, after=self.after,
+                target_scheme_id=self.target_scheme_id, as_of=self.as_of)
+            if not values:
+                return iter([])
+            if len(values) > self.limit:
+                self.next_after = values[self.limit - 1]
+            up_to = values[:self.limit][-1]
+        return scheme_mappings(
+            scheme.id, chunked=chunked, after=self.after, up_to=up_to,
+            target_scheme_id=self.target_scheme_id, as_of=self.as_of)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class TranslateView(ReadFromReplicaMixin, NegotiatedFormatMixin, AsOfMixin, View):
+    '''Translate values from one scheme into another
+
+    The values to translate can be given as value parameters in the
+    query string, or posted as a JSON object with a list of "values".
+    The results map each value that has current mappings into the
+    target scheme to a list of the values it maps to. A GET request
+    with no values streams the whole crosswalk between the schemes.
+    Either can be made as_of a past time.'''
+
+    http_method_names = ['get', 'post']
+
+    formats = JSON_FORMATS + ('csv', 'tsv')
+
+    max_values = 10000
+
+    def get(self, request, *args, **kwargs):
+        values = request.GET.getlist('value')
+        if not values:
+            return self.render_translations(None, streaming=True)
+        return self.translate(values)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            posted_data = json.loads(request.body.decode('utf-8'))
+            values = posted_data['values']
+        except (ValueError, KeyError, TypeError):
+            return self.render_error('The body must be a JSON object with a list of values')
+        return self.translate(values)
+
+    def get_schemes(self):
+        return get_schemes_or_404(self.kwargs['from_scheme'], self.kwargs['to_scheme'])
+
+    def translate(self, values):
+        if not (isinstance(values, list) and
+                all(isinstance(v, six.string_types) for v in values)):
+            return self.render_error('values must be a list of strings')
+        if len(values) > self.max_values:
+            return self.render_error('At most {0} values can be translated at once'.format(
+                self.max_values))
+        return self.render_translations(values)
+
+    def render_translations(self, values, streaming=False):
+        from_scheme, to_scheme = self.get_schemes()
+        translations = translate_values(
+            from_scheme.id, to_scheme.id, values=values, chunked=streaming,
+            as_of=self.as_of)
+        if self.response_format not in JSON_FORMATS:
+            return self.render_rows(
+                [from_scheme.name, to_scheme.name],
+                (
+                    (value, target_value)
+                    for value, target_values in translations
+                    for target_value in target_values
+                ),
+                streaming=streaming)
+        if streaming:
+            return self.stream_results(translations)
+        return self.render({'results': OrderedDict(translations)})
+
+
+class ChangesView(NegotiatedFormatMixin, View):
+    '''Return claims in the order they were made, after a given claim ID
+
+    Each claim includes both of its identifiers in full, and the
+    response gives the ID to pass as since to get the next page. With
+    wait, the request waits up to that many seconds for new claims if
+    there aren't any yet, at most CHANGES_MAX_WAIT seconds, since a
+    waiting request holds its worker all that time.'''
+
+    default_limit = 1000
+
+    max_limit = 10000
+
+    poll_interval = 1
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since = self.integer_parameter('since', 0, 0, None)
+            limit = self.integer_parameter('limit', self.default_limit, 1, self.max_limit)
+            wait = self.integer_parameter('wait', 0, 0, settings.CHANGES_MAX_WAIT)
+        except ValueError as e:
+            return self.render_error(six.text_type(e))
+        deadline = time.time() + wait
+        generation = changes.current_generation()
+        claims = self.claims(since, limit)
+        while not claims and time.time() < deadline:
+            # Claims that have already been made can also become safe
+            # to return without anyone being woken, when transactions
+            # that were in progress finish, so check again every so
+            # often:
+            changes.wait_for_claims(
+                generation, min(self.poll_interval, deadline - time.time()))
+            generation = changes.current_generation()
+            claims = self.claims(since, limit)
+        return self.render({
+            'results': [
+                {
+                    'id': claim.id,
+                    'identifier_a': claim.identifier_a.as_json(),
+                    'identifier_b': claim.identifier_b.as_json(),
+                    'created': claim.created.isoformat(),
+                    'deprecated': claim.deprecated,
+                    'comment': claim.comment,
                 }
-            }, json_dumps_params={'indent': 4}
-        )
+                for claim in claims
+            ],
+            'next': claims[-1].id if claims else since,
+        })
+
+    def integer_parameter(self, name, default, minimum, maximum):
+        if name not in self.request.GET:
+            return default
+        try:
+            value = int(self.request.GET[name])
+        except ValueError:
+            raise ValueError('{0} must be an integer'.format(name))
+        if value < minimum or (maximum is not None and value > maximum):
+            raise ValueError('{0} must be between {1} and {2}'.format(
+                name, minimum, maximum if maximum is not None else 'any higher number'))
+        return value
+
+    def claims(self, since, limit):
+        claim_ids = changes.changed_claim_ids(since, limit)
+        if not claim_ids:
+            return []
+        return list(EquivalenceClaim.objects.filter(
+            pk__in=claim_ids
+        ).select_related(
+            'identifier_a__scheme', 'identifier_b__scheme'
+        ).order_by('id'))
+
+
+class LookupCacheStatsView(NegotiatedFormatMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        return self.render(lookup_cache.stats())
+
+
+class MetricsView(View):
+    '''Return this process's request metrics for Prometheus to scrape'''
+
+    def get(self, request, *args, **kwargs):
+        if not settings.METRICS:
+            raise Http404('Metrics are not enabled')
+        return HttpResponse(
+            metrics.registry.prometheus_text(),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
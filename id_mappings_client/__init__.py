@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+'''A Python client for the ID mapping store's API
+
+IDMappingClient is a synchronous client; the asyncio one,
+AsyncIDMappingClient, is in id_mappings_client.aio.'''
+
+from __future__ import unicode_literals
+
+from .client import APIError, ClaimError, IDMappingClient, NotFound, claim_data
+
+__all__ = ['APIError', 'ClaimError', 'IDMappingClient', 'NotFound', 'claim_data']
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+'''An asyncio client for the ID mapping store's API (Python 3.6+)
+
+Requests are made by a synchronous client's pooled connections in a
+thread pool, with at most concurrency of them in progress at once.
+Lookups and claims made one at a time by concurrent tasks are
+collected for batch_delay seconds and sent to the bulk endpoints
+together, so e.g. gathering a thousand lookup coroutines makes one
+request rather than a thousand.'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+
+from .client import MAX_LOOKUP_BATCH, ClaimError, IDMappingClient, claim_data
+
+
+class AsyncIDMappingClient(object):
+
+    def __init__(self, base_url, api_key=None, concurrency=10, batch_delay=0.005,
+                 **kwargs):
+        self.client = IDMappingClient(
+            base_url, api_key=api_key, pool_size=concurrency, **kwargs)
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.batch_delay = batch_delay
+        self.pending_lookups = []
+        # Claims made with and without skip_unchanged go in separate
+        # batches:
+        self.pending_claims = {False: [], True: []}
+        self.batches = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        '''Send any lookups and claims still waiting, and close the connections'''
+        self.flush_lookups()
+        self.flush_claims()
+        if self.batches:
+            await asyncio.wait(self.batches)
+        self.executor.shutdown()
+        self.client.close()
+
+    async def run(self, function, *args, **kwargs):
+        # The thread pool has as many threads as there are connections,
+        # so other requests wait in its queue:
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs))
+
+    def enqueue(self, pending, item, flush, batch_size):
+        future = asyncio.get_event_loop().create_future()
+        pending.append((item, future))
+        if len(pending) >= batch_size:
+            flush()
+        elif len(pending) == 1:
+            asyncio.get_event_loop().call_later(self.batch_delay, flush)
+        return future
+
+    def start_batch(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.batches.add(task)
+        task.add_done_callback(self.batches.discard)
+
+    def flush_lookups(self):
+        if self.pending_lookups:
+            batch, self.pending_lookups = self.pending_lookups, []
+            self.start_batch(self.send_lookups(batch))
+
+    def flush_claims(self, skip_unchanged=None):
+        for skip in (False, True):
+            if skip_unchanged in (None, skip) and self.pending_claims[skip]:
+                batch, self.pending_claims[skip] = self.pending_claims[skip], []
+                self.start_batch(self.send_claims(batch, skip))
+
+    async def send_lookups(self, batch):
+        try:
+            results = await self.run(
+                self.client.lookup_many, [identifier for identifier, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def send_claims(self, batch, skip_unchanged=False):
+        try:
+            result = await self.run(
+                self.client.create_claims, [claim for claim, _ in batch], skip_unchanged)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        errors = {error['line']: error['error'] for error in result['errors']}
+        for line, (_, future) in enumerate(batch, start=1):
+            if future.done():
+                continue
+            if line in errors:
+                future.set_exception(ClaimError(errors[line]))
+            else:
+                future.set_result(None)
+
+    async def lookup(self, scheme, value):
+        '''Return the results and history for an identifier, or None
+
+        Lookups made at about the same time are sent together.'''
+        return await self.enqueue(
+            self.pending_lookups, (scheme, value), self.flush_lookups, MAX_LOOKUP_BATCH)
+
+    async def claim(self, a, b, deprecated=False, comment='', skip_unchanged=False):
+        '''Claim that two (scheme_id, value) pairs are equivalent (or not)
+
+        Claims made at about the same time are posted together; a
+        ClaimError is raised if the API couldn't use this one. With
+        skip_unchanged, it's only recorded if it changes the state of
+        the pair.'''
+        skip_unchanged = bool(skip_unchanged)
+        await self.enqueue(
+            self.pending_claims[skip_unchanged], claim_data(a, b, deprecated, comment),
+            functools.partial(self.flush_claims, skip_unchanged),
+            self.client.claim_batch_size)
+
+    async def lookup_many(self, identifiers):
+        return await self.run(self.client.lookup_many, list(identifiers))
+
+    async def create_claims(self, claims, skip_unchanged=False):
+        return await self.run(self.client.create_claims, list(claims), skip_unchanged)
+
+    async def schemes(self):
+        return await self.run(self.client.schemes)
+
+    async def cluster(self, scheme, value):
+        return await self.run(self.client.cluster, scheme, value)
+
+    async def translate(self, from_scheme, to_scheme, values):
+        return await self.run(self.client.translate, from_scheme, to_scheme, list(values))
+
+    async def scheme_mappings(self, scheme, page_size=None, target_scheme=None):
+        '''Generate (value, mapped identifiers) pairs a page at a time'''
+        kwargs = {'target_scheme': target_scheme}
+        if page_size is not None:
+            kwargs['page_size'] = page_size
+        after = None
+        while True:
+            items, after = await self.run(
+                self.client.scheme_page, scheme, after=after, **kwargs)
+            for item in items:
+                yield item
+            if after is None:
+                return
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+'''A synchronous client for the ID mapping store's API
+
+Connections are kept alive and reused from a pool, so a client should
+be created once and shared (it's safe to use from several threads).
+Lookups and claims are sent to the bulk endpoints in batches where
+there are any, responses with an ETag are remembered and revalidated
+rather than fetched again, and scheme dumps are fetched a page at a
+time as they're iterated over.'''
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import select
+import socket
+import threading
+import time
+
+try:
+    import http.client as httplib
+    from urllib.parse import quote, urlencode, urlsplit
+except ImportError:
+    import httplib
+    from urllib import quote, urlencode
+    from urlparse import urlsplit
+
+
+# The most identifiers /identifiers/lookup and values /translate accept
+# in one request:
+MAX_LOOKUP_BATCH = 5000
+MAX_TRANSLATE_BATCH = 10000
+MAX_SCHEME_PAGE = 10000
+
+# Responses to idempotent requests with these statuses are retried:
+RETRY_STATUSES = (502, 503, 504)
+
+
+class APIError(Exception):
+    '''An error response from the API'''
+
+    def __init__(self, status, message):
+        super(APIError, self).__init__('{0}: {1}'.format(status, message))
+        self.status = status
+        self.message = message
+
+
+class NotFound(APIError):
+    pass
+
+
+class ClaimError(ValueError):
+    '''A claim in a batch that the API couldn't use'''
+
+
+def identifier(scheme_id, value):
+    return {'scheme_id': scheme_id, 'value': value}
+
+
+def claim_data(a, b, deprecated=False, comment=''):
+    '''Return a claim in the form the API takes, from two (scheme_id, value) pairs'''
+    return {
+        'identifier_a': identifier(*a),
+        'identifier_b': identifier(*b),
+        'deprecated': deprecated,
+        'comment': comment,
+    }
+
+
+def loads(body):
+    # Scheme dumps and translations are in order of value:
+    return json.loads(body.decode('utf-8'), object_pairs_hook=OrderedDict)
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Response(object):
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return loads(self.body)
+
+
+def connection_dropped(conn):
+    '''Return whether the server has closed an idle keep-alive connection
+
+    Nothing should arrive on an idle connection, so if it's readable,
+    the server has closed it (or sent something that can't be used).'''
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, ValueError):
+        return True
+
+
+class ConnectionPool(object):
+    '''A pool of keep-alive connections to one server
+
+    At most size connections are open at once; a request that needs
+    one when they're all in use waits for one to be returned. Idle
+    connections that the server has closed are dropped rather than
+    used.'''
+
+    def __init__(self, base_url, size=10, timeout=30):
+        parts = urlsplit(base_url)
+        if parts.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        elif parts.scheme == 'http':
+            self.connection_class = httplib.HTTPConnection
+        else:
+            raise ValueError('The base URL must be an http or https URL')
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path_prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.available = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        '''Yield a connection, and whether it's been used before'''
+        self.available.acquire()
+        try:
+            conn = None
+            while conn is None:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    conn = self.idle.pop()
+                if connection_dropped(conn):
+                    conn.close()
+                    conn = None
+            reused = conn is not None
+            if conn is None:
+                conn = self.connection_class(self.host, self.port, timeout=self.timeout)
+            try:
+                yield conn, reused
+            except BaseException:
+                conn.close()
+                raise
+            with self.lock:
+                self.idle.append(conn)
+        finally:
+            self.available.release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+class IDMappingClient(object):
+    '''A client for one ID mapping store
+
+    api_key is only needed for making claims. Idempotent requests are
+    retried up to retries times if the connection fails or the server
+    is unavailable, waiting retry_delay seconds, then twice that, and
+    so on. Other claims are only retried if the request couldn't be
+    sent in full on a kept-alive connection that the server had
+    closed, since once it's been sent it might have been recorded
+    already. The ID of the last claim made is sent
+    with every request, so that a server with read replicas doesn't
+    answer from one that hasn't caught up with it yet.'''
+
+    def __init__(self, base_url, api_key=None, pool_size=10, timeout=30,
+                 retries=2, retry_delay=0.5, claim_batch_size=1000,
+                 etag_cache_size=1000):
+        self.pool = ConnectionPool(base_url, size=pool_size, timeout=timeout)
+        self.api_key = api_key
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.claim_batch_size = claim_batch_size
+        self.etag_cache_size = etag_cache_size
+        # Responses with ETags, by path, least recently used first:
+        self.etag_cache = OrderedDict()
+        self.etag_cache_lock = threading.Lock()
+        self.last_claim_id = None
+        self.last_claim_id_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+
+    def path(self, *parts, **params):
+        path = ''.join(
+            '/' + quote('{0}'.format(part).encode('utf-8'), safe=str(':'))
+            for part in parts)
+        params = [(k, v) for k, v in sorted(params.items()) if v is not None]
+        if params:
+            path += '?' + urlencode(params)
+        return path
+
+    def send(self, method, path, body=None, headers=None, idempotent=True):
+        '''Make a request, retrying it if that's safe, and return the Response'''
+        headers = dict(headers or {})
+        if self.api_key:
+            headers['X-Api-Key'] = self.api_key
+        if self.last_claim_id is not None:
+            headers['X-Last-Claim-Id'] = '{0}'.format(self.last_claim_id)
+        attempt = 0
+        retried_stale = False
+        while True:
+            try:
+                with self.pool.connection() as (conn, reused):
+                    try:
+                        conn.request(method, self.pool.path_prefix + path, body, headers)
+                    except (httplib.HTTPException, socket.error) as e:
+                        e.stale_connection = reused
+                        e.request_sent = False
+                        raise
+                    try:
+                        response = conn.getresponse()
+                        result = Response(
+                            response.status, dict(
+                                (k.lower(), v) for k, v in response.getheaders()),
+                            response.read())
+                    except (httplib.HTTPException, socket.error) as e:
+                        e.stale_connection = reused
+                        e.request_sent = True
+                        raise
+            except (httplib.HTTPException, socket.error) as e:
+                if getattr(e, 'stale_connection', False) and not retried_stale and (
+                        idempotent or not getattr(e, 'request_sent', True)):
+                    # The server closed a kept-alive connection before
+                    # it got all of this request; try again on a new one:
+                    retried_stale = True
+                    continue
+                if not idempotent or attempt >= self.retries:
+                    raise
+            else:
+                if not (idempotent and result.status in RETRY_STATUSES and
+                        attempt < self.retries):
+                    self.record_claim_id(result)
+                    return result
+            time.sleep(self.retry_delay * 2 ** attempt)
+            attempt += 1
+
+    def record_claim_id(self, response):
+        claim_id = response.headers.get('x-last-claim-id')
+        if claim_id and claim_id.isdigit():
+            with self.last_claim_id_lock:
+                self.last_claim_id = max(self.last_claim_id or 0, int(claim_id))
+
+    def get_json(self, path):
+        '''GET JSON, revalidating a response with an ETag if there is one'''
+        with self.etag_cache_lock:
+            cached = self.etag_cache.get(path)
+        headers = {'Accept': 'application/json'}
+        if cached:
+            headers['If-None-Match'] = cached[0]
+        response = self.send('GET', path, headers=headers)
+        if response.status == 304 and cached:
+            with self.etag_cache_lock:
+                if path in self.etag_cache:
+                    self.etag_cache[path] = self.etag_cache.pop(path)
+            return loads(cached[1])
+        data = self.check(response)
+        etag = response.headers.get('etag')
+        if etag and self.etag_cache_size:
+            with self.etag_cache_lock:
+                self.etag_cache.pop(path, None)
+                self.etag_cache[path] = (etag, response.body)
+                while len(self.etag_cache) > self.etag_cache_size:
+                    self.etag_cache.popitem(last=False)
+        return data
+
+    def post_json(self, path, data, idempotent=True):
+        return self.check(self.send(
+            'POST', path, body=json.dumps(data).encode('utf-8'),
+            headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
+            idempotent=idempotent))
+
+    def check(self, response):
+        '''Return the data in a response, or raise an APIError'''
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        if response.status >= 400:
+            message = data.get('error') if isinstance(data, dict) else None
+            error_class = NotFound if response.status == 404 else APIError
+            raise error_class(response.status, message or response.body[:200])
+        return data
+
+    def schemes(self):
+        '''Return a list of the schemes in the store'''
+        return self.get_json('/scheme')['results']
+
+    def lookup(self, scheme, value):
+        '''Return the results and history for an identifier, or None
+
+        scheme can be a scheme's ID or name.'''
+        try:
+            return self.get_json(self.path('identifier', scheme, value))
+        except NotFound:
+            return None
+
+    def lookup_many(self, identifiers):
+        '''Look up many (scheme, value) pairs, in as few requests as possible
+
+        Returns a list with what lookup would return for each one.'''
+        results = []
+        for chunk in chunks(identifiers, MAX_LOOKUP_BATCH):
+            results += self.post_json('/identifiers/lookup', {
+                'identifiers': [
+                    {'scheme': scheme, 'value': value} for scheme, value in chunk
+                ]
+            })['results']
+        return results
+
+    def cluster(self, scheme, value):
+        '''Return every identifier transitively equivalent to one, or None'''
+        try:
+            return self.get_json(self.path('cluster', scheme, value))['results']
+        except NotFound:
+            return None
+
+    def claim(self, a, b, deprecated=False, comment='', skip_unchanged=False,
+              idempotency_key=None):
+        '''Claim that two (scheme_id, value) pairs are equivalent (or not)
+
+        With skip_unchanged, the claim is only recorded if it changes
+        the state of the pair; claim_created in the result says
+        whether it was. A claim with an idempotency_key is retried
+        like other requests, since the server only records it once.'''
+        path = self.path('equivalence-claim', skip_unchanged=1 if skip_unchanged else None)
+        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+        return self.check(self.send(
+            'POST', path, body=json.dumps(claim_data(a, b, deprecated, comment)).encode('utf-8'),
+            headers=headers, idempotent=bool(idempotency_key)))
+
+    def create_claims(self, claims, skip_unchanged=False):
+        '''Post claims (in the form claim_data returns) in batches
+
+        Returns the totals of what was created (and, with
+        skip_unchanged, of the claims left out because they wouldn't
+        change their pairs), and the errors, with the number of each
+        claim that couldn't be used counting from 1 as its "line".'''
+        totals = {
+            'claims_created': 0, 'claims_skipped': 0, 'identifiers_created': 0, 'errors': []}
+        path = self.path(
+            'equivalence-claims', 'bulk', skip_unchanged=1 if skip_unchanged else None)
+        offset = 0
+        for chunk in chunks(claims, self.claim_batch_size):
+            body = ''.join(json.dumps(claim) + '\n' for claim in chunk)
+            result = self.check(self.send(
+                'POST', path, body=body.encode('utf-8'),
+                headers={'Content-Type': 'application/x-ndjson'},
+                idempotent=False))
+            totals['claims_created'] += result['claims_created']
+            totals['claims_skipped'] += result['claims_skipped']
+            totals['identifiers_created'] += result['identifiers_created']
+            for error in result['errors']:
+                totals['errors'].append(dict(error, line=error['line'] + offset))
+            offset += len(chunk)
+        return totals
+
+    @contextmanager
+    def claim_batch(self, skip_unchanged=False):
+        '''Collect claims made with the batch's add method, and post them in bulk
+
+        They're posted whenever claim_batch_size have been collected,
+        and when the block ends; the batch's totals are then those of
+        create_claims.'''
+        batch = ClaimBatch(self, skip_unchanged)
+        yield batch
+        batch.flush()
+
+    def scheme_mappings(self, scheme, page_size=MAX_SCHEME_PAGE, target_scheme=None):
+        '''Generate (value, mapped identifiers) pairs for a scheme
+
+        These are fetched a page at a time as they're needed, in order
+        of value.'''
+        after = None
+        while True:
+            items, after = self.scheme_page(scheme, page_size, after, target_scheme)
+            for item in items:
+                yield item
+            if after is None:
+                return
+
+    def scheme_page(self, scheme, page_size=MAX_SCHEME_PAGE, after=None,
+                    target_scheme=None):
+        '''Return a page of a scheme's mappings, and the value to get the next after'''
+        page = self.get_json(self.path(
+            'scheme', scheme, limit=page_size, after=after, target_scheme=target_scheme))
+        return list(page['results'].items()), page['next']
+
+    def translate(self, from_scheme, to_scheme, values):
+        '''Return a dictionary mapping values to those they map to in to_scheme'''
+        results = {}
+        path = self.path('translate', from_scheme, to_scheme)
+        for chunk in chunks(values, MAX_TRANSLATE_BATCH):
+            results.update(self.post_json(path, {'values': chunk})['results'])
+        return results
+
+
+class ClaimBatch(object):
+
+    def __init__(self, client, skip_unchanged=False):
+        self.client = client
+        self.skip_unchanged = skip_unchanged
+        self.pending = []
+        self.totals = {
+            'claims_created': 0, 'claims_skipped': 0, 'identifiers_created': 0, 'errors': []}
+        self.added = 0
+
+    def add(self, a, b, deprecated=False, comment=''):
+        self.pending.append(claim_data(a, b, deprecated, comment))
+        if len(self.pending) >= self.client.claim_batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        result = self.client.create_claims(pending, self.skip_unchanged)
+        self.totals['claims_created'] += result['claims_created']
+        self.totals['claims_skipped'] += result['claims_skipped']
+        self.totals['identifiers_created'] += result['identifiers_created']
+        for error in result['errors']:
+            self.totals['errors'].append(dict(error, line=error['line'] + self.added))
+        self.added += len(pending)
@@ -48,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'id_mappings.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -92,6 +93,88 @@ DATABASES = {
     }
 }
 
+# Lookups can be served from read replicas of the database, each given
+# in ID_MAPPING_STORE_DB_REPLICAS as the settings that differ from the
+# primary's (see id_mappings/replicas.py). A client that makes a claim
+# is given its ID in a header and a cookie lasting REPLICA_STICKINESS
+# seconds, and while it sends either back it only reads from replicas
+# that have the claim.
+REPLICA_DATABASES = []
+for i, replica in enumerate(conf.get('ID_MAPPING_STORE_DB_REPLICAS') or [], 1):
+    alias = 'replica{0}'.format(i)
+    DATABASES[alias] = dict(
+        DATABASES['default'],
+        NAME=replica.get('NAME', DATABASES['default']['NAME']),
+        USER=replica.get('USER', DATABASES['default']['USER']),
+        PASSWORD=replica.get('PASS', DATABASES['default']['PASSWORD']),
+        HOST=replica.get('HOST', DATABASES['default']['HOST']),
+        PORT=replica.get('PORT', DATABASES['default']['PORT']),
+        TEST={'MIRROR': 'default'},
+    )
+    REPLICA_DATABASES.append(alias)
+REPLICA_STICKINESS = conf.get('REPLICA_STICKINESS', 5)
+
+DATABASE_ROUTERS = ['id_mappings.replicas.ReplicaRouter']
+
+
+# Rendered lookup responses are cached here (see id_mappings/lookup_cache.py);
+# the default is a per-process in-memory cache, but LOOKUP_CACHE_BACKEND
+# can be set to id_mappings.cache_backends.LRUFileBasedCache with a
+# directory as LOOKUP_CACHE_LOCATION to share the cache between processes.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'lookups': {
+        'BACKEND': conf.get(
+            'LOOKUP_CACHE_BACKEND', 'id_mappings.cache_backends.LRULocMemCache'),
+        'LOCATION': conf.get('LOOKUP_CACHE_LOCATION', 'lookups'),
+        'TIMEOUT': conf.get('LOOKUP_CACHE_TIMEOUT', 24 * 60 * 60),
+        'OPTIONS': {
+            'MAX_ENTRIES': conf.get('LOOKUP_CACHE_MAX_ENTRIES', 10000),
+        },
+    },
+}
+
+# If this is set, snapshots of each scheme's mappings are written here by
+# the build_scheme_snapshots command, and full scheme dumps are served
+# from them while they're current; if SCHEME_SNAPSHOT_SENDFILE is set,
+# that's left to the web server through an X-Sendfile header.
+SCHEME_SNAPSHOT_DIR = conf.get('SCHEME_SNAPSHOT_DIR')
+SCHEME_SNAPSHOT_SENDFILE = bool(int(conf.get('SCHEME_SNAPSHOT_SENDFILE', 0)))
+
+# Requests to /changes that wait for new claims are woken by claims made
+# in other processes through PostgreSQL's LISTEN/NOTIFY, which needs a
+# database connection per process; set this to 0 to only be woken by
+# claims made in the same process.
+CHANGES_LISTEN = bool(int(conf.get('CHANGES_LISTEN', 1)))
+# The longest, in seconds, that a request to /changes can wait for new
+# claims. Each waiting request holds a worker (and a thread or greenlet)
+# for that long, so raise this only if /changes is served by its own
+# pool of threaded or asynchronous workers.
+CHANGES_MAX_WAIT = conf.get('CHANGES_MAX_WAIT', 10)
+
+# If this is set, each process holds the current mappings in memory and
+# answers lookups from them (see id_mappings/graph.py), checking for new
+# claims at most every MAPPING_GRAPH_REFRESH_INTERVAL seconds unless it
+# hears about them sooner.
+MAPPING_GRAPH = bool(int(conf.get('MAPPING_GRAPH', 0)))
+MAPPING_GRAPH_REFRESH_INTERVAL = conf.get('MAPPING_GRAPH_REFRESH_INTERVAL', 1)
+# Alternatively, processes can share a snapshot of the mappings, written
+# to this file by the build_graph_snapshot command; each process checks
+# for a new one every MAPPING_GRAPH_REFRESH_INTERVAL seconds.
+MAPPING_GRAPH_SNAPSHOT = conf.get('MAPPING_GRAPH_SNAPSHOT')
+
+# Whether to time each request's queries, view and serialization, send
+# them back in a Server-Timing header and keep per-route histograms of
+# them for Prometheus to scrape from /metrics.
+METRICS = bool(int(conf.get('METRICS', 0)))
+
+# How long, in seconds, the response to a claim made with an
+# Idempotency-Key header is kept to be returned to retries of it.
+IDEMPOTENCY_KEY_EXPIRY = conf.get('IDEMPOTENCY_KEY_EXPIRY', 86400)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators